@@ -1,38 +1,58 @@
-import aiohttp
 import asyncio
 import logging
+import os
 from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
+from cache import content_key, formatted_text_cache, audio_cache
+from progress import ProgressMessage
+from api_client import api_client, CircuitOpenError, STREAM_CHUNK_SIZE
+from metrics import timed, AI_REQUEST_SECONDS
+from utils import iter_text_parts
 
-TEXT_API_URL = "https://text.pollinations.ai/"
-AUDIO_API_URL = "https://text.pollinations.ai/"
+# Адреса API можно переопределить, например, для benchmarks/fake_services.py
+TEXT_API_URL = os.getenv('POLLINATIONS_TEXT_URL', "https://text.pollinations.ai/")
+AUDIO_API_URL = os.getenv('POLLINATIONS_AUDIO_URL', "https://text.pollinations.ai/")
 
-async def format_text_with_ai(text, chat_id, bot):
-    msg = await bot.send_message(chat_id, "Подождите пожалуйста, готовим лучший формат текста для вас... (10 сек)")
-    last_text = "Подождите пожалуйста, готовим лучший формат текста для вас... (10 сек)"
-    for i in range(9, -1, -1):
-        new_text = f"Подождите пожалуйста, готовим лучший формат текста для вас... ({i} сек)"
-        if new_text != last_text:
-            try:
-                await asyncio.sleep(1)
-                await bot.edit_message_text(
-                    text=new_text,
-                    chat_id=chat_id,
-                    message_id=msg.message_id
-                )
-                last_text = new_text
-            except TelegramBadRequest as e:
-                if "message is not modified" in str(e):
-                    logging.warning(f"Пропущено редактирование сообщения: текст не изменился ({i} сек)")
-                    continue
-                else:
-                    logging.error(f"Ошибка редактирования сообщения: {e}")
-                    return text
+# Доступные голоса для Pollinations.ai
+VOICES = ["Alloy", "Echo", "Fable", "Nova", "Onyx", "Shimmer", "Coral", "Verse", "Ballad", "Ash", "Sage", "Amuch", "Dan"]
+
+FORMAT_MODEL = "openai"
+AUDIO_MODEL = "openai-audio"
+AUDIO_SYSTEM_PROMPT = "You are a text-to-speech system. Read the provided text exactly as it is written, without summarizing, paraphrasing, or modifying it in any way."
+FORMAT_SYSTEM_PROMPT = "You are an assistant that formats text for better readability in Telegram using HTML. Add logical paragraphs, <b>bold</b>, <i>italic</i>, <code>monospace</code>, <u>underline</u>, and emojis where appropriate. Ensure the text is properly formatted and does not exceed 4096 characters. Return only the formatted text."
+# Длинный текст озвучивается кусками до TTS_CHUNK_CHARS символов, по границам
+# предложений; одновременно для одного текста — не больше TTS_CONCURRENCY запросов
+TTS_CHUNK_CHARS = 1000
+TTS_CONCURRENCY = 3
+
+# Запросы к API, которые уже выполняются: ключ кэша -> задача (для озвучки —
+# AudioGeneration). Повторный запрос того же текста присоединяется к ней, а не
+# идёт в API ещё раз.
+_format_inflight = {}
+_audio_generations = {}
+
+def _shared_request(inflight, key, coro_factory):
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(coro_factory())
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    # shield: отмена одного из ожидающих не прерывает общий запрос
+    return asyncio.shield(task)
+
+def format_cache_key(text):
+    # Модель и промпт входят в ключ, поэтому их изменение делает старые записи недоступными
+    return content_key(FORMAT_MODEL, FORMAT_SYSTEM_PROMPT, text)
+
+@timed(AI_REQUEST_SECONDS, operation='format')
+async def _post_formatting(text):
+    """Запрос к API форматирования; при ошибке или некорректном ответе бросает исключение."""
     payload = {
-        "model": "openai",
+        "model": FORMAT_MODEL,
         "messages": [
             {
                 "role": "system",
-                "content": "You are an assistant that formats text for better readability in Telegram using HTML. Add logical paragraphs, <b>bold</b>, <i>italic</i>, <code>monospace</code>, <u>underline</u>, and emojis where appropriate. Ensure the text is properly formatted and does not exceed 4096 characters. Return only the formatted text."
+                "content": FORMAT_SYSTEM_PROMPT
             },
             {
                 "role": "user",
@@ -40,71 +60,287 @@ async def format_text_with_ai(text, chat_id, bot):
             }
         ]
     }
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(TEXT_API_URL, json=payload) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    formatted_text = data['choices'][0]['message']['content']
-                    logging.info(f"Длина отформатированного текста: {len(formatted_text)} символов")
-                    if len(formatted_text) > 4096:
-                        formatted_text = formatted_text[:4096]
-                        logging.warning("Текст обрезан до 4096 символов")
-                    return formatted_text
-                else:
-                    logging.error(f"Ошибка форматирования текста: {response.status}")
-                    return text
-        except Exception as e:
-            logging.error(f"Ошибка подключения к API форматирования: {e}")
-            return text
-
-async def generate_audio(text, voice="alloy", chat_id=None, bot=None):
+    data = await api_client.post_json("format", TEXT_API_URL, payload)
+    formatted_text = data['choices'][0]['message']['content']
+    if not isinstance(formatted_text, str) or not formatted_text.strip():
+        raise ValueError("пустой текст в ответе")
+    return formatted_text
+
+async def _request_formatting(text, cache_key):
+    """Форматирует текст через API и кэширует результат; при ошибке возвращает None."""
     try:
-        if chat_id and bot:
-            msg = await bot.send_message(chat_id, "Подождите пожалуйста, генерируем аудио... (10 сек)")  # Уменьшено до 10 секунд
-            last_text = "Подождите пожалуйста, генерируем аудио... (10 сек)"
-            for i in range(29, -1, -1):
-                new_text = f"Подождите пожалуйста, генерируем аудио... ({i} сек)"
-                if new_text != last_text:
-                    try:
-                        await asyncio.sleep(1)
-                        await bot.edit_message_text(
-                            text=new_text,
-                            chat_id=chat_id,
-                            message_id=msg.message_id
-                        )
-                        last_text = new_text
-                    except TelegramBadRequest as e:
-                        if "message is not modified" in str(e):
-                            logging.warning(f"Пропущено редактирование сообщения для аудио: текст не изменился ({i} сек)")
-                            continue
-                        else:
-                            logging.error(f"Ошибка редактирования сообщения для аудио: {e}")
-                            return None
-        payload = {
-            "model": "openai-audio",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are a text-to-speech system. Read the provided text exactly as it is written, without summarizing, paraphrasing, or modifying it in any way."
-                },
-                {
-                    "role": "user",
-                    "content": text
-                }
-            ],
-            "voice": voice.lower()
-        }
-        logging.info(f"Отправка запроса на {AUDIO_API_URL} с голосом {voice}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(AUDIO_API_URL, json=payload) as response:
-                if response.status == 200:
-                    audio_bytes = await response.read()
-                    logging.info(f"Аудио успешно сгенерировано, размер: {len(audio_bytes)} байт")
-                    return audio_bytes
-                else:
-                    logging.error(f"Ошибка API: {response.status}, ответ: {await response.text()}")
-                    return None
+        formatted_text = await _post_formatting(text)
+    except CircuitOpenError as e:
+        logging.warning(f"Форматирование пропущено: {e}")
+        return None
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        logging.error(f"API форматирования вернул некорректный ответ: {e!r}")
+        return None
+    except Exception as e:
+        logging.error(f"Ошибка форматирования текста: {e}")
+        return None
+    logging.info(f"Длина отформатированного текста: {len(formatted_text)} символов")
+    if len(formatted_text) > 4096:
+        formatted_text = formatted_text[:4096]
+        logging.warning("Текст обрезан до 4096 символов")
+    await formatted_text_cache.put(cache_key, formatted_text)
+    return formatted_text
+
+async def warm_formatting(text):
+    """Заполняет кэш форматирования без сообщений пользователю (для предзагрузки)."""
+    cache_key = format_cache_key(text)
+    if await formatted_text_cache.get(cache_key, record=False) is not None:
+        return
+    await _shared_request(_format_inflight, cache_key, lambda: _request_formatting(text, cache_key))
+
+async def format_text_with_ai(text, chat_id=None, bot=None):
+    cache_key = format_cache_key(text)
+    cached = await formatted_text_cache.get(cache_key)
+    if cached is not None:
+        logging.info(f"Отформатированный текст взят из кэша ({len(cached)} символов)")
+        return cached
+    if cache_key in _format_inflight:
+        logging.info("Форматирование этого текста уже выполняется, ожидаем результат")
+        formatted_text = await _shared_request(_format_inflight, cache_key, lambda: _request_formatting(text, cache_key))
+        return formatted_text or text
+    if api_client.breaker("format").state == "open":
+        logging.warning("API форматирования недоступен, отправляем текст без форматирования")
+        return text
+    async with ProgressMessage(bot, chat_id, "Подождите пожалуйста, готовим лучший формат текста для вас"):
+        formatted_text = await _shared_request(_format_inflight, cache_key, lambda: _request_formatting(text, cache_key))
+    return formatted_text or text
+
+def split_for_speech(text):
+    """Куски текста для отдельных запросов озвучки."""
+    return list(iter_text_parts(text, TTS_CHUNK_CHARS)) or [text]
+
+def _strip_id3(audio):
+    """Убирает тег ID3v2 из начала MP3, чтобы куски склеивались в один поток кадров."""
+    if len(audio) < 10 or audio[:3] != b'ID3':
+        return audio
+    size = (audio[6] << 21) | (audio[7] << 14) | (audio[8] << 7) | audio[9]
+    footer = 10 if audio[5] & 0x10 else 0
+    return audio[10 + size + footer:]
+
+async def _synthesize(text, voice, on_chunk=None):
+    payload = {
+        "model": AUDIO_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": AUDIO_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": text
+            }
+        ],
+        "voice": voice.lower()
+    }
+    if on_chunk is None:
+        return await api_client.post_bytes("audio", AUDIO_API_URL, payload)
+    return await api_client.post_stream("audio", AUDIO_API_URL, payload, on_chunk)
+
+@timed(AI_REQUEST_SECONDS, operation='audio')
+async def _synthesize_chunks(chunks, voice, on_chunk=None, on_part=None):
+    """Озвучивает куски параллельно и возвращает их аудио по порядку.
+
+    Первый кусок передаётся в on_chunk по мере ответа API, остальные —
+    целиком, как только готовы все предыдущие. on_part() вызывается после
+    каждого куска. При ошибке любого куска остальные запросы отменяются.
+    """
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+
+    async def synthesize(index, chunk):
+        async with semaphore:
+            return await _synthesize(chunk, voice, on_chunk if index == 0 else None)
+
+    tasks = [asyncio.create_task(synthesize(index, chunk)) for index, chunk in enumerate(chunks)]
+    parts = []
+    try:
+        for index, task in enumerate(tasks):
+            audio = await task
+            if index:
+                audio = _strip_id3(audio)
+                if on_chunk is not None:
+                    on_chunk(audio)
+            if on_part is not None:
+                on_part()
+            parts.append(audio)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Забираем результаты, чтобы ошибки отменённых кусков не попадали в журнал asyncio
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return parts
+
+async def generate_audio(text, voice="alloy", chat_id=None, bot=None, on_chunk=None, on_part=None):
+    try:
+        if api_client.breaker("audio").state == "open":
+            raise CircuitOpenError("API audio временно недоступен")
+        chunks = split_for_speech(text)
+        logging.info(f"Отправка запроса на {AUDIO_API_URL} с голосом {voice}, кусков: {len(chunks)}")
+        async with ProgressMessage(bot, chat_id, "Подождите пожалуйста, генерируем аудио"):
+            parts = await _synthesize_chunks(chunks, voice, on_chunk, on_part)
+        audio_bytes = b''.join(parts)
+        logging.info(f"Аудио успешно сгенерировано, размер: {len(audio_bytes)} байт")
+        return audio_bytes
+    except CircuitOpenError as e:
+        logging.warning(f"Генерация аудио пропущена: {e}")
+        return None
     except Exception as e:
         logging.error(f"Ошибка генерации аудио: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def audio_cache_key(text, voice):
+    return content_key(AUDIO_MODEL, voice.lower(), text)
+
+class AudioGeneration:
+    """Озвучка, которая сейчас генерируется.
+
+    Байты копятся в памяти по мере ответа API, поэтому читатели (например,
+    веб-приложение) могут начать воспроизведение до окончания генерации.
+    part_ends — границы уже озвученных кусков из parts_total в buffer.
+    task возвращает аудио целиком или None при ошибке.
+    """
+
+    def __init__(self, parts_total=1):
+        self.buffer = bytearray()
+        self.parts_total = parts_total
+        self.part_ends = []
+        self.done = False
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def append(self, chunk):
+        self.buffer += chunk
+        self._wake()
+
+    def end_part(self):
+        self.part_ends.append(len(self.buffer))
+        self._wake()
+
+    def finish(self):
+        self.done = True
+        self._wake()
+
+    def _wake(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def iter_chunks(self, offset=0):
+        """Отдаёт аудио с offset, дожидаясь новых байт, пока генерация не закончится."""
+        while True:
+            if offset < len(self.buffer):
+                chunk = bytes(self.buffer[offset:offset + STREAM_CHUNK_SIZE])
+                offset += len(chunk)
+                yield chunk
+            elif self.done:
+                return
+            else:
+                await self._changed.wait()
+
+    async def iter_parts(self):
+        """Отдаёт аудио каждого куска целиком, как только он озвучен."""
+        index, start = 0, 0
+        while True:
+            if index < len(self.part_ends):
+                end = self.part_ends[index]
+                index += 1
+                yield bytes(self.buffer[start:end])
+                start = end
+            elif self.done:
+                return
+            else:
+                await self._changed.wait()
+
+async def _generate_and_cache_audio(text, voice, key, generation):
+    audio = None
+    try:
+        audio = await generate_audio(text, voice, on_chunk=generation.append, on_part=generation.end_part)
+        if audio:
+            await audio_cache.put(key, audio)
+    finally:
+        generation.finish()
+    return audio
+
+def _audio_generation(text, voice, key):
+    generation = _audio_generations.get(key)
+    if generation is None:
+        generation = AudioGeneration(len(split_for_speech(text)))
+        generation.task = asyncio.create_task(_generate_and_cache_audio(text, voice, key, generation))
+        generation.task.add_done_callback(lambda _: _audio_generations.pop(key, None))
+        _audio_generations[key] = generation
+    return generation
+
+def stream_audio(text, voice):
+    """Запускает генерацию озвучки или присоединяется к идущей; None, если API недоступен."""
+    key = audio_cache_key(text, voice)
+    if key not in _audio_generations and api_client.breaker("audio").state == "open":
+        return None
+    return _audio_generation(text, voice, key)
+
+async def warm_audio(text, voice):
+    """Генерирует и кэширует озвучку без сообщений пользователю (для предзагрузки)."""
+    key = audio_cache_key(text, voice)
+    if await audio_cache.contains(key):
+        return
+    # shield: отмена предзагрузки не прерывает генерацию, которую ждут другие
+    await asyncio.shield(_audio_generation(text, voice, key).task)
+
+async def send_audio_cached(bot, chat_id, text, voice, reply_markup=None):
+    """Отправляет озвучку текста, по возможности без генерации и повторной загрузки.
+
+    Сначала пробует переслать аудио по сохранённому file_id, затем отправляет
+    файл из дискового кэша, и только потом генерирует аудио заново. Длинный
+    текст при генерации отправляется по кускам (см. _send_audio_parts).
+    Возвращает True, если аудио отправлено.
+    """
+    key = audio_cache_key(text, voice)
+    cached = await audio_cache.get(key)
+    audio = None
+    if cached:
+        if cached["file_id"]:
+            try:
+                await bot.send_audio(chat_id, cached["file_id"], reply_markup=reply_markup)
+                logging.info(f"Аудио для {chat_id} отправлено по file_id из кэша")
+                return True
+            except TelegramBadRequest as e:
+                logging.warning(f"file_id из кэша не принят Telegram: {e}")
+                audio = await audio_cache.load_audio(key)
+        else:
+            audio = cached["audio"]
+    if audio is None:
+        if key in _audio_generations:
+            logging.info("Озвучка этого текста уже генерируется, ожидаем результат")
+        generation = _audio_generation(text, voice, key)
+        if generation.parts_total > 1:
+            return await _send_audio_parts(bot, chat_id, generation, reply_markup)
+        async with ProgressMessage(bot, chat_id, "Подождите пожалуйста, генерируем аудио"):
+            audio = await asyncio.shield(generation.task)
+        if not audio:
+            return False
+    message = await bot.send_audio(chat_id, BufferedInputFile(audio, filename="audio.mp3"), reply_markup=reply_markup)
+    if message.audio:
+        await audio_cache.set_file_id(key, message.audio.file_id)
+    return True
+
+async def _send_audio_parts(bot, chat_id, generation, reply_markup=None):
+    """Отправляет озвучку отдельными файлами по кускам: первый — как только готов, остальные по порядку.
+
+    Склеенное аудио целиком сохраняет в кэш сама генерация, поэтому
+    повторный запрос получит его одним файлом. Возвращает True, если
+    отправлены все куски.
+    """
+    total = generation.parts_total
+    parts = generation.iter_parts()
+    async with ProgressMessage(bot, chat_id, "Подождите пожалуйста, генерируем аудио"):
+        part = await anext(parts, None)
+    sent = 0
+    while part is not None:
+        sent += 1
+        await bot.send_audio(chat_id, BufferedInputFile(part, filename=f"audio_{sent}.mp3"), title=f"Часть {sent} из {total}",
+                             reply_markup=reply_markup if sent == total else None)
+        part = await anext(parts, None)
+    logging.info(f"Аудио для {chat_id} отправлено по частям: {sent} из {total}")
+    return sent == total
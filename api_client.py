@@ -0,0 +1,208 @@
+import aiohttp
+import asyncio
+import logging
+import random
+import time
+
+# Пул соединений с API
+MAX_CONNECTIONS = 32
+KEEPALIVE_TIMEOUT = 60
+# Общий лимит одновременных запросов и лимиты по операциям
+GLOBAL_CONCURRENCY = 16
+ENDPOINT_CONCURRENCY = {"format": 8, "audio": 8}
+# Таймауты операций (в секундах)
+ENDPOINT_TIMEOUTS = {"format": 60, "audio": 120}
+DEFAULT_TIMEOUT = 60
+# Повторы при 429/5xx и сетевых ошибках
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Автомат защиты: после стольких ошибок подряд запросы не отправляются reset_timeout секунд
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+# Размер куска при потоковом чтении ответа
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class APIError(Exception):
+    def __init__(self, status, message=''):
+        super().__init__(f"API вернул {status}: {message}")
+        self.status = status
+
+
+class CircuitOpenError(Exception):
+    """API признан недоступным, запрос не отправлялся."""
+
+
+class StreamInterruptedError(Exception):
+    """Ответ оборвался после того, как часть тела уже была передана получателю."""
+
+
+class CircuitBreaker:
+    """Автомат защиты API.
+
+    После reset_timeout автомат переходит в half-open и пропускает один
+    пробный запрос; остальные отклоняются, пока проба не завершится.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def check(self):
+        """Разрешает запрос или бросает CircuitOpenError; True, если запрос пробный.
+
+        Пробный запрос должен вызвать release_probe() по завершении.
+        """
+        state = self.state
+        if state == "open" or (state == "half-open" and self.probing):
+            raise CircuitOpenError(f"API {self.name} временно недоступен")
+        if state == "half-open":
+            self.probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        self.probing = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f"API {self.name} снова доступен")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logging.warning(f"API {self.name} отключен на {self.reset_timeout} сек после {self.failures} ошибок подряд")
+            self.opened_at = time.monotonic()
+
+
+class PollinationsClient:
+    """Общий клиент API Pollinations на всё время работы бота.
+
+    Держит пул keep-alive соединений, ограничивает число одновременных
+    запросов, повторяет запросы при 429/5xx с экспоненциальной задержкой и
+    случайным разбросом, а при череде ошибок перестаёт обращаться к API,
+    чтобы обработчики сразу переходили к запасному варианту.
+    """
+
+    def __init__(self):
+        self._session = None
+        self._global_semaphore = asyncio.Semaphore(GLOBAL_CONCURRENCY)
+        self._endpoint_semaphores = {name: asyncio.Semaphore(limit) for name, limit in ENDPOINT_CONCURRENCY.items()}
+        self._breakers = {}
+        self.in_flight = 0
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def breaker(self, endpoint):
+        if endpoint not in self._breakers:
+            self._breakers[endpoint] = CircuitBreaker(endpoint)
+        return self._breakers[endpoint]
+
+    def _endpoint_semaphore(self, endpoint):
+        if endpoint not in self._endpoint_semaphores:
+            self._endpoint_semaphores[endpoint] = asyncio.Semaphore(GLOBAL_CONCURRENCY)
+        return self._endpoint_semaphores[endpoint]
+
+    async def post_json(self, endpoint, url, payload):
+        return await self._request(endpoint, url, payload, lambda response: response.json(content_type=None))
+
+    async def post_bytes(self, endpoint, url, payload):
+        return await self._request(endpoint, url, payload, lambda response: response.read())
+
+    async def post_stream(self, endpoint, url, payload, on_chunk):
+        """Как post_bytes, но передаёт тело ответа в on_chunk кусками по мере получения.
+
+        Повтор возможен, только пока не получено ни одного куска: ответ,
+        оборвавшийся посередине, завершается StreamInterruptedError.
+        Возвращает тело целиком.
+        """
+        async def read(response):
+            body = bytearray()
+            try:
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    body += chunk
+                    on_chunk(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if body:
+                    raise StreamInterruptedError(f"ответ API {endpoint} оборвался после {len(body)} байт: {e}") from e
+                raise
+            return bytes(body)
+        return await self._request(endpoint, url, payload, read)
+
+    async def _request(self, endpoint, url, payload, read):
+        breaker = self.breaker(endpoint)
+        probe = breaker.check()
+        try:
+            return await self._send(breaker, endpoint, url, payload, read)
+        finally:
+            # Проба, прерванная отменой или неожиданной ошибкой, не должна
+            # навсегда закрыть API для остальных запросов
+            if probe:
+                breaker.release_probe()
+
+    async def _send(self, breaker, endpoint, url, payload, read):
+        session = await self.start()
+        timeout = aiohttp.ClientTimeout(total=ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                async with self._global_semaphore, self._endpoint_semaphore(endpoint):
+                    self.in_flight += 1
+                    try:
+                        async with session.post(url, json=payload, timeout=timeout) as response:
+                            if response.status == 200:
+                                result = await read(response)
+                                breaker.record_success()
+                                return result
+                            error = APIError(response.status, await response.text())
+                            if response.status not in RETRY_STATUSES:
+                                breaker.record_success()
+                                raise error
+                            retry_after = response.headers.get('Retry-After')
+                    finally:
+                        self.in_flight -= 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            breaker.record_failure()
+            if attempt == MAX_RETRIES or breaker.state == "open":
+                raise error
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(int(retry_after), RETRY_MAX_DELAY))
+            logging.warning(f"Запрос к API {endpoint} не удался ({error}), повтор {attempt + 1}/{MAX_RETRIES} через {delay:.1f} сек")
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "breakers": {name: breaker.state for name, breaker in self._breakers.items()},
+        }
+
+
+api_client = PollinationsClient()
@@ -0,0 +1,103 @@
+"""Размер базы и время чтения частей с сжатием текста и без него.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_compression.py [--books 20] [--chars 2000000] [--methods none zlib zstd]
+
+Для каждого способа хранения создаётся отдельная база с одинаковыми
+книгами, после VACUUM измеряется размер файла и среднее время
+get_part_text по случайным частям. zstd пропускается, если пакет
+zstandard не установлен. Текст генерируется из небольшого словаря, поэтому
+сжимается лучше настоящих книг: на реальных текстах ждите примерно 2.5–3x.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+import database
+from utils import split_text_into_parts
+
+WORDS = (
+    "и в не он на я что тот быть с а весь это как она по но они к у ты из мы за вы так же от сказать "
+    "этот который мочь человек о один ещё бы такой только себя своё какой когда уже для вот кто да "
+    "говорить год знать мой до или если время рука нет самый ни стать большой даже другой наш свой "
+    "ну под где дело есть сам раз чтобы два там чем глаз жизнь первый день тут во ничто потом очень "
+    "со хотеть ли при голова надо без видеть идти теперь тоже стоять друг дом сейчас можно после "
+    "слово здесь думать место спросить через лицо что-то тогда ведь хороший каждый новый жить должный"
+).split()
+
+
+def make_book(seed, chars):
+    rng = random.Random(seed)
+    paragraphs = []
+    size = 0
+    while size < chars:
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(5, 18))]
+            sentences.append(' '.join(words).capitalize() + rng.choice('.!?'))
+        paragraph = ' '.join(sentences)
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return '\n\n'.join(paragraphs)
+
+
+async def run(method, books, tmp, iterations):
+    compression.TEXT_COMPRESSION = method
+    database.DB_PATH = os.path.join(tmp, f'bench_{method}.db')
+    await database.init_db()
+    started = time.perf_counter()
+    totals = []
+    for book_id, parts in enumerate(books, 1):
+        await database.add_book_with_parts(1, f'book {book_id}', parts)
+        totals.append(len(parts))
+    write_time = time.perf_counter() - started
+    rng = random.Random(0)
+    targets = []
+    for _ in range(iterations):
+        book_id = rng.randint(1, len(totals))
+        targets.append((book_id, rng.randint(1, totals[book_id - 1])))
+    started = time.perf_counter()
+    for book_id, part_number in targets:
+        await database.get_part_text(book_id, part_number)
+    read_time = (time.perf_counter() - started) / iterations
+    await database.close_db()
+    conn = sqlite3.connect(database.DB_PATH)
+    conn.execute('VACUUM')
+    conn.close()
+    return os.path.getsize(database.DB_PATH), write_time, read_time
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=20)
+    parser.add_argument('--chars', type=int, default=2_000_000, help="размер одной книги в символах")
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--methods', nargs='+', default=['none', 'zlib', 'zstd'])
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    books = [split_text_into_parts(make_book(seed, args.chars)) for seed in range(args.books)]
+    text_bytes = sum(len(part.encode('utf-8')) for parts in books for part in parts)
+    print(f"Книг: {args.books}, частей: {sum(map(len, books))}, текста: {text_bytes / 2**20:.1f} МБ")
+    print(f"{'способ':>8} {'размер базы, МБ':>16} {'запись, с':>10} {'get_part_text, мкс':>20}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for method in args.methods:
+            if method == 'zstd' and compression.zstandard is None:
+                print(f"{method:>8} пропущен: пакет zstandard не установлен")
+                continue
+            size, write_time, read_time = await run(method, books, tmp, args.iterations)
+            print(f"{method:>8} {size / 2**20:>16.1f} {write_time:>10.2f} {read_time * 1e6:>20.1f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
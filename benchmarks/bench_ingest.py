@@ -0,0 +1,351 @@
+"""Бенчмарк загрузки книг: извлечение текста, разбиение на части и запись в базу.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_ingest.py [--formats pdf epub docx html txt] [--sizes 0.01 1 10]
+        [--output ingest_results.json] [--baseline baseline.json] [--threshold 0.2]
+
+Для каждого формата и размера (примерный объём текста в МБ, до 100)
+генерируется файл с детерминированным текстом: он строится из словаря
+генератором с фиксированным seed. Файлы кэшируются в --fixtures-dir.
+Текст PDF латинский — стандартный шрифт Helvetica не содержит кириллицы,
+остальные форматы — на русском. Отдельно замеряются три этапа:
+
+    extract — функция extract_text_from_* для формата;
+    split   — split_text_into_parts над извлечённым текстом;
+    ingest  — запись готовых частей в базу пачками, как в ingest.import_book.
+
+Каждый замер выполняется в отдельном процессе, поэтому пиковый RSS
+(ru_maxrss) относится к одному этапу; в него входит и сам интерпретатор с
+импортами. Скорость (МБ/с) везде считается по объёму текста в UTF-8, а
+не по размеру файла: EPUB и DOCX сжаты. Из --repeat повторов берётся
+лучшее время. Результаты пишутся
+в JSON (--output). С --baseline они сравниваются с сохранённым ранее
+файлом: этап, который стал медленнее или требует больше памяти больше чем
+на --threshold, помечается как регрессия, и скрипт завершается с кодом 1.
+Чтобы обновить базовую линию, сохраните файл результатов как baseline.
+На 100 МБ извлечение PDF (pdfplumber) занимает десятки минут.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import EXTRACTORS
+
+STAGES = ('extract', 'split', 'ingest')
+FORMATS = ('pdf', 'epub', 'docx', 'html', 'txt')
+
+RUSSIAN_WORDS = (
+    "и в не он на я что тот быть с а весь это как она по но они к у ты из мы за вы так же от сказать "
+    "этот который мочь человек о один ещё бы такой только себя своё какой когда уже для вот кто да "
+    "говорить год знать мой до или если время рука нет самый ни стать большой даже другой наш свой "
+    "ну под где дело есть сам раз чтобы два там чем глаз жизнь первый день тут во ничто потом очень "
+    "книга глава страница читать дорога окно город вечер утро письмо история голос свет ночь дом"
+).split()
+LATIN_WORDS = (
+    "the of and to in a is that for it as was with be by on not he this are or his from at which but "
+    "have an they you were her she there been one all we their has would when if so no will more out "
+    "book chapter page reading road window city evening morning letter story voice light night house"
+).split()
+
+# Длина строки и число строк на странице PDF
+PDF_LINE_CHARS = 90
+PDF_LINES_PER_PAGE = 55
+# Объём текста одной главы EPUB
+EPUB_CHAPTER_CHARS = 100_000
+
+
+def generate_paragraphs(size_mb, words, seed):
+    """Абзацы общим объёмом около size_mb МБ в UTF-8; одинаковые при одинаковом seed."""
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    size = 0
+    while size < target:
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 18)))
+            sentences.append(sentence.capitalize() + rng.choice('.!?'))
+        paragraph = ' '.join(sentences)
+        size += len(paragraph.encode('utf-8')) + 2
+        yield paragraph
+
+
+def _pdf_escape(line):
+    return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def _pdf_lines(paragraphs):
+    for paragraph in paragraphs:
+        line = ''
+        for word in paragraph.split():
+            if line and len(line) + 1 + len(word) > PDF_LINE_CHARS:
+                yield line
+                line = word
+            else:
+                line = f'{line} {word}' if line else word
+        if line:
+            yield line
+        yield ''
+
+
+def write_pdf(path, paragraphs):
+    """Простой PDF со шрифтом Helvetica: объекты пишутся по мере генерации страниц."""
+    with open(path, 'wb') as f:
+        offsets = []
+
+        def write_object(number, body):
+            while len(offsets) < number:
+                offsets.append(0)
+            offsets[number - 1] = f.tell()
+            f.write(f'{number} 0 obj\n'.encode() + body + b'\nendobj\n')
+
+        f.write(b'%PDF-1.4\n')
+        write_object(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+        page_numbers = []
+        next_number = 4
+        lines = _pdf_lines(paragraphs)
+        while True:
+            page_lines = [line for _, line in zip(range(PDF_LINES_PER_PAGE), lines)]
+            if not page_lines:
+                break
+            content = 'BT /F1 10 Tf 12 TL 50 770 Td ' + ' '.join(f'({_pdf_escape(line)}) Tj T*' for line in page_lines) + ' ET'
+            stream = content.encode('latin-1')
+            write_object(next_number + 1, b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+            write_object(next_number, (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {next_number + 1} 0 R '
+                                       f'/Resources << /Font << /F1 3 0 R >> >> >>').encode())
+            page_numbers.append(next_number)
+            next_number += 2
+        kids = ' '.join(f'{number} 0 R' for number in page_numbers)
+        write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(page_numbers)} >>'.encode())
+        write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        xref = f.tell()
+        f.write(f'xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n'.encode())
+        f.write(''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode())
+        f.write(f'trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
+
+
+def write_epub(path, paragraphs):
+    from ebooklib import epub
+    book = epub.EpubBook()
+    book.set_identifier('bench-ingest')
+    book.set_title('Бенчмарк загрузки')
+    book.set_language('ru')
+    chapters = []
+    body, size = [], 0
+    for paragraph in list(paragraphs) + [None]:
+        if paragraph is not None:
+            body.append(f'<p>{paragraph}</p>')
+            size += len(paragraph)
+        if body and (paragraph is None or size >= EPUB_CHAPTER_CHARS):
+            chapter = epub.EpubHtml(title=f'Глава {len(chapters) + 1}', file_name=f'chapter_{len(chapters) + 1}.xhtml', lang='ru')
+            chapter.content = f'<html><body><h1>Глава {len(chapters) + 1}</h1>{"".join(body)}</body></html>'
+            book.add_item(chapter)
+            chapters.append(chapter)
+            body, size = [], 0
+    book.toc = chapters
+    book.spine = ['nav'] + chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(path, book)
+
+
+def write_docx(path, paragraphs):
+    from docx import Document
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def write_html(path, paragraphs):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Бенчмарк</title></head><body><article>\n')
+        for paragraph in paragraphs:
+            f.write(f'<p>{paragraph}</p>\n')
+        f.write('</article></body></html>\n')
+
+
+def write_txt(path, paragraphs):
+    with open(path, 'w', encoding='utf-8') as f:
+        for paragraph in paragraphs:
+            f.write(paragraph + '\n\n')
+
+
+WRITERS = {'pdf': write_pdf, 'epub': write_epub, 'docx': write_docx, 'html': write_html, 'txt': write_txt}
+
+
+def fixture_path(fixtures_dir, fmt, size_mb, seed):
+    path = os.path.join(fixtures_dir, f'book_{size_mb:g}mb_seed{seed}.{fmt}')
+    if not os.path.exists(path):
+        words = LATIN_WORDS if fmt == 'pdf' else RUSSIAN_WORDS
+        started = time.perf_counter()
+        tmp_path = path + '.tmp'
+        WRITERS[fmt](tmp_path, generate_paragraphs(size_mb, words, seed))
+        os.replace(tmp_path, path)
+        print(f"  создан {os.path.basename(path)}: {os.path.getsize(path) / 2**20:.2f} МБ за {time.perf_counter() - started:.1f} с", flush=True)
+    return path
+
+
+def _peak_rss_mb():
+    # На Linux ru_maxrss в КБ, на macOS — в байтах
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+async def _ingest_parts(db_path, parts):
+    import database
+    from ingest import INGEST_BATCH_SIZE
+    database.DB_PATH = db_path
+    await database.init_db()
+    started = time.perf_counter()
+    book_id = await database.create_book(1, 'бенчмарк')
+    written = 0
+    for offset in range(0, len(parts), INGEST_BATCH_SIZE):
+        written += await database.add_parts(book_id, written + 1, parts[offset:offset + INGEST_BATCH_SIZE])
+    await database.set_book_status(book_id, database.BOOK_READY)
+    elapsed = time.perf_counter() - started
+    await database.close_db()
+    return elapsed
+
+
+def run_stage(stage, fmt, path, text_path, work_dir):
+    """Один замер в отдельном процессе: {seconds, text_bytes, parts, peak_rss_mb}."""
+    logging.disable(logging.WARNING)
+    from utils import split_text_into_parts
+    if stage == 'extract':
+        started = time.perf_counter()
+        text = EXTRACTORS['.' + fmt](path)
+        seconds = time.perf_counter() - started
+        with open(text_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return {"seconds": seconds, "text_bytes": len(text.encode('utf-8')), "parts": None, "peak_rss_mb": _peak_rss_mb()}
+    with open(text_path, encoding='utf-8') as f:
+        text = f.read()
+    text_bytes = len(text.encode('utf-8'))
+    if stage == 'split':
+        started = time.perf_counter()
+        parts = split_text_into_parts(text)
+        seconds = time.perf_counter() - started
+    else:
+        parts = split_text_into_parts(text)
+        del text
+        db_path = os.path.join(work_dir, 'ingest.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        seconds = asyncio.run(_ingest_parts(db_path, parts))
+    return {"seconds": seconds, "text_bytes": text_bytes, "parts": len(parts), "peak_rss_mb": _peak_rss_mb()}
+
+
+def measure(stage, fmt, path, text_path, work_dir, repeat):
+    best = None
+    for _ in range(repeat):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_stage, stage, fmt, path, text_path, work_dir).result()
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    seconds = max(best["seconds"], 1e-9)
+    return {
+        "seconds": round(best["seconds"], 6),
+        "file_mb": round(os.path.getsize(path) / 2**20, 4),
+        "text_mb": round(best["text_bytes"] / 2**20, 4),
+        "mb_per_s": round(best["text_bytes"] / 2**20 / seconds, 3),
+        "parts": best["parts"],
+        "parts_per_s": round(best["parts"] / seconds, 1) if best["parts"] is not None else None,
+        "peak_rss_mb": round(best["peak_rss_mb"], 1),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Регрессии относительно baseline: строки с замедлением или ростом памяти больше threshold."""
+    previous = {(row["format"], row["size_mb"], row["stage"]): row for row in baseline["results"]}
+    regressions = []
+    for row in results:
+        old = previous.get((row["format"], row["size_mb"], row["stage"]))
+        if old is None:
+            continue
+        speed = row["mb_per_s"] / old["mb_per_s"] if old["mb_per_s"] else 1.0
+        memory = row["peak_rss_mb"] / old["peak_rss_mb"] if old["peak_rss_mb"] else 1.0
+        row["speed_vs_baseline"] = round(speed, 3)
+        row["rss_vs_baseline"] = round(memory, 3)
+        if speed < 1 - threshold or memory > 1 + threshold:
+            regressions.append(row)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS), choices=FORMATS)
+    parser.add_argument('--sizes', nargs='+', type=float, default=[0.01, 1, 10], help="объём текста в МБ")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--fixtures-dir', default=os.path.join(tempfile.gettempdir(), 'bench_ingest_fixtures'))
+    parser.add_argument('--output', default='ingest_results.json')
+    parser.add_argument('--baseline', help="файл результатов предыдущего запуска для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.2, help="допустимое ухудшение, доля")
+    args = parser.parse_args()
+    if 'extract' not in args.stages:
+        # Остальным этапам нужен извлечённый текст
+        args.stages = ['extract'] + args.stages
+    os.makedirs(args.fixtures_dir, exist_ok=True)
+
+    results = []
+    print(f"{'формат':>6} {'МБ':>6} {'этап':>8} {'время, с':>9} {'МБ/с':>8} {'частей/с':>10} {'RSS, МБ':>8}")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size_mb in args.sizes:
+            for fmt in args.formats:
+                path = fixture_path(args.fixtures_dir, fmt, size_mb, args.seed)
+                text_path = os.path.join(work_dir, f'{fmt}_{size_mb:g}.txt')
+                for stage in STAGES:
+                    if stage not in args.stages:
+                        continue
+                    row = {"format": fmt, "size_mb": size_mb, "stage": stage}
+                    row.update(measure(stage, fmt, path, text_path, work_dir, args.repeat))
+                    results.append(row)
+                    parts_rate = f"{row['parts_per_s']:.0f}" if row["parts_per_s"] is not None else '-'
+                    print(f"{fmt:>6} {size_mb:>6g} {stage:>8} {row['seconds']:>9.3f} {row['mb_per_s']:>8.2f} {parts_rate:>10} {row['peak_rss_mb']:>8.1f}", flush=True)
+
+    report = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["baseline"] = args.baseline
+        report["regressions"] = [(row["format"], row["size_mb"], row["stage"]) for row in regressions]
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+    if args.baseline:
+        if not regressions:
+            print(f"Регрессий относительно {args.baseline} нет (порог {args.threshold:.0%})")
+        for row in regressions:
+            print(f"РЕГРЕССИЯ {row['format']} {row['size_mb']:g} МБ {row['stage']}: скорость x{row['speed_vs_baseline']}, память x{row['rss_vs_baseline']}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
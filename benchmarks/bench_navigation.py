@@ -0,0 +1,90 @@
+"""Замер времени навигационных запросов в зависимости от размера таблицы parts.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_navigation.py [--sizes 10000 100000 1000000 3000000] [--no-indexes]
+
+Для каждого размера таблица parts дополняется «чужими» книгами до нужного
+числа строк, после чего измеряется среднее время get_part_text и
+get_total_parts для одной и той же книги. С индексами из миграций время
+get_part_text остаётся практически постоянным; с --no-indexes растёт
+линейно. get_total_parts читает манифест книги и от размера parts не зависит.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+TARGET_BOOK_ID = 1
+TARGET_PARTS = 500
+FILLER_PARTS_PER_BOOK = 1000
+BATCH_SIZE = 100_000
+
+
+def grow_parts_table(path, target_rows, current_rows, next_book_id):
+    conn = sqlite3.connect(path)
+    text = 'x' * 64
+    book_id = next_book_id
+    part_number = 1
+    while current_rows < target_rows:
+        batch = []
+        for _ in range(min(BATCH_SIZE, target_rows - current_rows)):
+            batch.append((book_id, part_number, text))
+            part_number += 1
+            if part_number > FILLER_PARTS_PER_BOOK:
+                book_id += 1
+                part_number = 1
+        conn.executemany('INSERT INTO parts (content_id, part_number, text) VALUES (?, ?, ?)', batch)
+        conn.commit()
+        current_rows += len(batch)
+    conn.close()
+    return current_rows, book_id + 1
+
+
+async def measure(iterations):
+    started = time.perf_counter()
+    for i in range(iterations):
+        await database.get_part_text(TARGET_BOOK_ID, i % TARGET_PARTS + 1)
+    part_text = (time.perf_counter() - started) / iterations
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await database.get_total_parts(TARGET_BOOK_ID)
+    total_parts = (time.perf_counter() - started) / iterations
+    return part_text, total_parts
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000, 3_000_000])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--no-indexes', action='store_true', help="удалить индексы после миграций")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, 'bench.db')
+        await database.init_db()
+        if args.no_indexes:
+            async with database.get_pool().write() as db:
+                await db.execute('DROP INDEX IF EXISTS idx_parts_book_part')
+        await database.add_book_with_parts(1, 'target', (f'part {n}' for n in range(1, TARGET_PARTS + 1)))
+        rows, next_book_id = TARGET_PARTS, TARGET_BOOK_ID + 1
+
+        print(f"{'строк в parts':>14} {'get_part_text, мкс':>20} {'get_total_parts, мкс':>22}")
+        for size in sorted(args.sizes):
+            rows, next_book_id = grow_parts_table(database.DB_PATH, size, rows, next_book_id)
+            part_text, total_parts = await measure(args.iterations)
+            print(f"{rows:>14} {part_text * 1e6:>20.1f} {total_parts * 1e6:>22.1f}")
+        await database.close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
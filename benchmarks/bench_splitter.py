@@ -0,0 +1,111 @@
+"""Микробенчмарк разбиения текста на части на входах 10–50 МБ.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_splitter.py [--sizes 10 25 50] [--legacy]
+
+Для каждого размера генерируется детерминированный текст двух видов:
+с абзацами и «как из PDF» — длинные строки без переводов строк. Печатается
+время и пропускная способность iter_text_parts и потокового PartSplitter,
+а также проверяется, что ни одна часть после HTML-экранирования не
+превышает лимит Telegram. Перед замерами проверяется, что разбиение
+продвигается по тексту, который сильно растёт при экранировании (&, <),
+и что части не теряют символов. С --legacy для сравнения замеряется прежний
+квадратичный алгоритм (на 50 МБ он работает очень долго).
+"""
+import argparse
+import html
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import iter_text_parts, PartSplitter, TELEGRAM_MESSAGE_LIMIT
+
+WORDS = ("книга", "чтение", "глава", "страница", "абзац", "reading", "chapter", "<tag>", "A&B", "слово.", "вопрос?")
+FEED_CHUNK = 64 * 1024
+# Входы, у которых окно после HTML-экранирования в разы длиннее лимита
+ESCAPE_HEAVY = ('&' * 5000, 'a&' * 3000, '<' * 3000 + ' ' + 'a' * 3000, '<>' * 20000)
+
+
+def generate_text(size_mb, paragraphs, seed=42):
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    pieces, length = [], 0
+    while length < target:
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 25)))
+        if paragraphs and rng.random() < 0.15:
+            sentence += '\n\n'
+        else:
+            sentence += ' '
+        pieces.append(sentence)
+        length += len(sentence)
+    return ''.join(pieces)
+
+
+def legacy_split(text, max_chars=4000):
+    parts = []
+    while len(text) > max_chars:
+        split_index = text.rfind('\n', 0, max_chars)
+        if split_index == -1 or split_index == 0:
+            split_index = max_chars
+        parts.append(text[:split_index].strip())
+        text = text[split_index:].strip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def streaming_split(text):
+    splitter = PartSplitter()
+    parts = []
+    for offset in range(0, len(text), FEED_CHUNK):
+        parts.extend(splitter.feed(text[offset:offset + FEED_CHUNK]))
+    parts.extend(splitter.finish())
+    return parts
+
+
+def run(name, func, text, size_mb):
+    started = time.perf_counter()
+    parts = list(func(text))
+    elapsed = time.perf_counter() - started
+    longest = max(len(html.escape(part, quote=False)) for part in parts)
+    status = 'OK' if longest <= TELEGRAM_MESSAGE_LIMIT else 'ПРЕВЫШЕН ЛИМИТ'
+    print(f"{name:>16} {size_mb:>6} МБ {elapsed:>9.3f} с {size_mb / elapsed:>9.1f} МБ/с {len(parts):>8} частей  макс. {longest} ({status})")
+    return parts
+
+
+def check_escape_heavy():
+    """Проверяет, что разбиение завершается и не теряет текст на входах из ESCAPE_HEAVY."""
+    for text in ESCAPE_HEAVY:
+        for name, func in (("iter_text_parts", iter_text_parts), ("PartSplitter", streaming_split)):
+            parts = list(func(text))
+            longest = max(len(html.escape(part, quote=False)) for part in parts)
+            assert longest <= TELEGRAM_MESSAGE_LIMIT, f"{name}: часть длиннее лимита ({longest})"
+            assert ''.join(parts).replace(' ', '') == text.replace(' ', ''), f"{name}: потерян текст"
+    print(f"Входы с экранированием ({len(ESCAPE_HEAVY)}): OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 25, 50], help="размеры входа в МБ")
+    parser.add_argument('--legacy', action='store_true', help="замерить и прежний алгоритм")
+    args = parser.parse_args()
+
+    check_escape_heavy()
+    for paragraphs, kind in ((True, "с абзацами"), (False, "без переводов строк")):
+        print(f"Текст {kind}:")
+        for size_mb in args.sizes:
+            text = generate_text(size_mb, paragraphs)
+            parts = run("iter_text_parts", iter_text_parts, text, size_mb)
+            streamed = run("PartSplitter", streaming_split, text, size_mb)
+            if streamed != parts:
+                print("    ВНИМАНИЕ: потоковое разбиение отличается от разбиения целиком")
+            if args.legacy:
+                run("legacy", legacy_split, text, size_mb)
+
+
+if __name__ == '__main__':
+    main()
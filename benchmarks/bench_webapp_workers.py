@@ -0,0 +1,150 @@
+"""Нагрузочный тест веб-приложения, запущенного отдельно от бота несколькими процессами.
+
+Запуск из корня репозитория:
+
+    python benchmarks/bench_webapp_workers.py [--workers 1 2 4] [--users 1000] [--duration 10]
+
+Создаётся временная база с книгами и пользователями, затем для каждого
+числа процессов поднимается uvicorn webapp:app --workers N, и несколько
+процессов-клиентов в течение --duration секунд шлют смесь запросов:
+текущий фрагмент, часть книги по неизменяемому адресу и сохранение позиции
+(запись в базу). Выводятся запросов в секунду, p50/p95 задержки и число
+ошибок. Все процессы пишут в одну базу в режиме WAL; прирост пропускной
+способности с числом процессов ограничен числом ядер (os.cpu_count()),
+клиенты тоже занимают процессор.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import aiohttp
+
+import database
+
+PARTS_PER_BOOK = 50
+# Доля запросов каждого вида: текущий фрагмент, часть книги, запись позиции
+REQUEST_MIX = (('part', 0.6), ('book_part', 0.3), ('position', 0.1))
+
+
+async def populate(users):
+    await database.init_db()
+    book_id = await database.add_book_with_parts(1, 'книга', [f'Фрагмент {n}. ' + 'текст ' * 600 for n in range(1, PARTS_PER_BOOK + 1)])
+    await database.update_users_data({chat_id: {"current_book_id": book_id, "current_part": 1} for chat_id in range(1, users + 1)})
+    await database.close_db()
+    return book_id
+
+
+async def wait_ready(base_url, book_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f'{base_url}/api/books/{book_id}/parts/1') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("веб-приложение не запустилось")
+            await asyncio.sleep(0.2)
+
+
+async def client(base_url, book_id, users, duration, concurrency, seed):
+    rng = random.Random(seed)
+    kinds, weights = zip(*REQUEST_MIX)
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def worker(session):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            chat_id = rng.randint(1, users)
+            part_number = rng.randint(1, PARTS_PER_BOOK)
+            kind = rng.choices(kinds, weights)[0]
+            started = time.perf_counter()
+            try:
+                if kind == 'part':
+                    request = session.get(f'{base_url}/api/part/{chat_id}')
+                elif kind == 'book_part':
+                    request = session.get(f'{base_url}/api/books/{book_id}/parts/{part_number}')
+                else:
+                    request = session.post(f'{base_url}/api/position/{chat_id}/{part_number}')
+                async with request as response:
+                    body = await response.json()
+                    ok = response.status == 200 and body.get("status") in ("OK", "success")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def run_client(base_url, book_id, users, duration, concurrency, seed):
+    return asyncio.run(client(base_url, book_id, users, duration, concurrency, seed))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def measure(workers, args, tmp, book_id, port):
+    env = dict(os.environ, DB_PATH=os.path.join(tmp, 'bot.db'))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'webapp:app', '--app-dir', ROOT, '--port', str(port),
+         '--workers', str(workers), '--log-level', 'warning', '--no-access-log'],
+        cwd=tmp, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        asyncio.run(wait_ready(base_url, book_id))
+        jobs = [(base_url, book_id, args.users, args.duration, args.concurrency, seed) for seed in range(args.clients)]
+        with multiprocessing.get_context('spawn').Pool(args.clients) as pool:
+            results = pool.starmap(run_client, jobs)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    latencies = sorted(latency for result, _ in results for latency in result)
+    errors = sum(errors for _, errors in results)
+    return len(latencies) / args.duration, percentile(latencies, 0.5), percentile(latencies, 0.95), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=2, help="число процессов-клиентов")
+    parser.add_argument('--concurrency', type=int, default=32, help="одновременных запросов на клиента")
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, 'bot.db')
+        book_id = asyncio.run(populate(args.users))
+        print(f"Ядер: {os.cpu_count()}, пользователей: {args.users}, клиентов: {args.clients} x {args.concurrency}")
+        print(f"{'процессов':>10} {'запросов/с':>11} {'p50, мс':>9} {'p95, мс':>9} {'ошибок':>7}")
+        for workers in args.workers:
+            rps, p50, p95, errors = measure(workers, args, tmp, book_id, args.port)
+            print(f"{workers:>10} {rps:>11.0f} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {errors:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Локальные заменители API Pollinations и Telegram Bot API для нагрузочных тестов.
+
+Запуск из корня репозитория:
+
+    python benchmarks/fake_services.py [--pollinations-port 8082] [--telegram-port 8081]
+        [--format-latency 1.5] [--audio-latency 4] [--error-rate 0.02] [--telegram-latency 0.05]
+
+Бот направляется на них переменными окружения:
+
+    POLLINATIONS_TEXT_URL=http://127.0.0.1:8082/ POLLINATIONS_AUDIO_URL=http://127.0.0.1:8082/
+    TELEGRAM_API_URL=http://127.0.0.1:8081
+
+Pollinations отвечает так же, как text.pollinations.ai на запросы
+ai_utils.py: JSON chat completions для форматирования и MP3-байты потоком
+для модели озвучки. Задержка каждого ответа случайна в пределах ±50% от
+заданной, а с вероятностью --error-rate возвращается 503. Telegram
+отвечает на методы, которые вызывает бот, правдоподобными объектами
+Message и с вероятностью --telegram-error-rate — ошибкой 429 с
+retry_after. load_test.py запускает оба сервиса в своём процессе и
+слушает отправленные ботом сообщения через TelegramFake.listeners.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+AUDIO_MODEL = "openai-audio"
+# Размер поддельного MP3 на символ текста и размер куска при потоковой отдаче
+AUDIO_BYTES_PER_CHAR = 40
+AUDIO_CHUNKS = 8
+FORMAT_PREFIX = "Please format the following text: "
+# Методы Bot API, которые возвращают сообщение
+MESSAGE_METHODS = {'sendmessage', 'sendaudio', 'senddocument', 'editmessagetext'}
+
+
+class PollinationsFake:
+    def __init__(self, format_latency=1.5, audio_latency=4.0, error_rate=0.0, seed=None):
+        self.format_latency = format_latency
+        self.audio_latency = audio_latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = {"format": 0, "audio": 0, "errors": 0}
+
+    def _delay(self, latency):
+        return latency * self.rng.uniform(0.5, 1.5)
+
+    async def handle(self, request):
+        payload = await request.json()
+        kind = "audio" if payload.get("model") == AUDIO_MODEL else "format"
+        self.requests[kind] += 1
+        if self.rng.random() < self.error_rate:
+            self.requests["errors"] += 1
+            await asyncio.sleep(self._delay(0.1))
+            return web.Response(status=503, text="Service Unavailable")
+        text = payload["messages"][-1]["content"]
+        if kind == "format":
+            await asyncio.sleep(self._delay(self.format_latency))
+            content = text[len(FORMAT_PREFIX):] if text.startswith(FORMAT_PREFIX) else text
+            return web.json_response({
+                "id": "fake",
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"<b>📖</b> {content}"}}],
+            })
+        # Аудио отдаётся частями: первая через четверть задержки, остальные равномерно
+        delay = self._delay(self.audio_latency)
+        size = max(1024, len(text) * AUDIO_BYTES_PER_CHAR)
+        chunk = b'\xff\xfb\x90\x00' + bytes(size // AUDIO_CHUNKS)
+        response = web.StreamResponse(headers={"Content-Type": "audio/mpeg"})
+        await asyncio.sleep(delay / 4)
+        await response.prepare(request)
+        for _ in range(AUDIO_CHUNKS):
+            await response.write(chunk)
+            await asyncio.sleep(delay * 3 / 4 / AUDIO_CHUNKS)
+        await response.write_eof()
+        return response
+
+    def app(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post('/', self.handle)
+        app.router.add_post('/openai', self.handle)
+        return app
+
+
+class TelegramFake:
+    """Bot API по адресам /bot{token}/{method}; запоминает отправленные ботом сообщения.
+
+    listeners — функции listener(method, chat_id, fields), которые
+    вызываются для каждого вызова метода с chat_id.
+    """
+
+    def __init__(self, latency=0.05, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.listeners = []
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def _message(self, chat_id, fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private", "first_name": "Test"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot"},
+        }
+        if "text" in fields:
+            message["text"] = fields["text"]
+        if "audio" in fields:
+            audio = fields["audio"]
+            file_id = audio if isinstance(audio, str) else f"fake-audio-{next(self._file_ids)}"
+            message["audio"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 1}
+        return message
+
+    async def handle(self, request):
+        method = request.match_info['method'].lower()
+        fields = {}
+        for name, value in (await request.post()).items():
+            fields[name] = value if isinstance(value, str) else value.file.read()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        chat_id = fields.get("chat_id")
+        if method in MESSAGE_METHODS and self.rng.random() < self.error_rate:
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        for listener in self.listeners:
+            listener(method, chat_id, fields)
+        if method in MESSAGE_METHODS:
+            result = self._message(chat_id, fields)
+        elif method == 'getme':
+            result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+        elif method == 'getupdates':
+            result = []
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+async def start_site(app, port, host='127.0.0.1'):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pollinations-port', type=int, default=8082)
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--format-latency', type=float, default=1.5)
+    parser.add_argument('--audio-latency', type=float, default=4.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    pollinations = PollinationsFake(args.format_latency, args.audio_latency, args.error_rate)
+    telegram = TelegramFake(args.telegram_latency, args.telegram_error_rate)
+    runners = [
+        await start_site(pollinations.app(), args.pollinations_port),
+        await start_site(telegram.app(), args.telegram_port),
+    ]
+    print(f"Pollinations: http://127.0.0.1:{args.pollinations_port}/, Telegram: http://127.0.0.1:{args.telegram_port}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(json.dumps({"pollinations": pollinations.requests, "telegram": telegram.calls}, ensure_ascii=False), flush=True)
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
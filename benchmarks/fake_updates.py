@@ -0,0 +1,85 @@
+"""Отправка поддельных обновлений Telegram на вебхук бота.
+
+Запуск из корня репозитория (бот запущен с WEBHOOK_URL):
+
+    python benchmarks/fake_updates.py [--url http://127.0.0.1:8000/telegram/webhook] [--updates 1000] [--chats 50] [--text /start]
+
+Шлёт --updates сообщений с текстом --text от --chats пользователей, не
+более --concurrency запросов одновременно, так же, как их прислал бы
+Telegram (JSON обновления и заголовок с секретом вебхука). Выводит число
+принятых и отклонённых обновлений (503 — очередь бота переполнена),
+запросов в секунду и задержку ответа вебхука. Ответы бота уходят в
+настоящий Bot API, поэтому для чатов-заглушек они завершатся ошибкой —
+это не мешает измерять приём и обработку обновлений.
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+import aiohttp
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Test"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000/telegram/webhook')
+    parser.add_argument('--secret', default=None, help="значение WEBHOOK_SECRET бота")
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--text', default='/start')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--first-chat-id', type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    update_ids = itertools.count(int(time.time()))
+    counts = {"accepted": 0, "rejected": 0, "errors": 0}
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(session, n):
+        update = make_update(next(update_ids), args.first_chat_id + n % args.chats, args.text)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.post(args.url, json=update, headers=headers) as response:
+                    status = response.status
+            except aiohttp.ClientError:
+                counts["errors"] += 1
+                return
+            latencies.append(time.perf_counter() - started)
+        if status == 200:
+            counts["accepted"] += 1
+        elif status == 503:
+            counts["rejected"] += 1
+        else:
+            counts["errors"] += 1
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, n) for n in range(args.updates)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+
+    print(f"Принято: {counts['accepted']}, отклонено: {counts['rejected']}, ошибок: {counts['errors']}")
+    print(f"{args.updates / elapsed:.0f} обновлений/с, ответ вебхука p50 {percentile(0.5):.1f} мс, p95 {percentile(0.95):.1f} мс")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
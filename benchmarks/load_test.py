@@ -0,0 +1,306 @@
+"""Сквозной нагрузочный тест бота на локальных заменителях Pollinations и Telegram.
+
+Запуск из корня репозитория:
+
+    python benchmarks/load_test.py [--users 2000] [--duration 60] [--think-time 20]
+        [--format-latency 1.5] [--audio-latency 4] [--error-rate 0.02] [--output load_results.json]
+
+Создаётся временная база с книгой из --parts фрагментов и --users
+пользователями, у которых она выбрана с случайного фрагмента. Бот
+запускается отдельным процессом в режиме вебхука, а API Pollinations и
+Telegram ему подменяют серверы из fake_services.py (POLLINATIONS_*_URL и
+TELEGRAM_API_URL), работающие в процессе теста. Каждый пользователь в
+течение --duration секунд после паузы со средним --think-time секунд
+(экспоненциальное распределение) нажимает одну из кнопок:
+
+    next     — «Вперед»;
+    read     — «Читать сейчас»;
+    voice    — «Озвучить текст» у последнего полученного фрагмента.
+
+Обновление отправляется на вебхук бота (при 503 — повторно через секунду),
+и действие считается выполненным, когда бот отправит пользователю ответ:
+аудио или сообщение, которое не является статусом «Подождите...».
+Задержка — время от отправки обновления до этого ответа. Выводятся число
+действий, p50/p95/p99 задержки, пропускная способность, тайм-ауты
+(--timeout) и ошибки по каждому виду действий, а также счётчики запросов
+к заменителям. Очередь отправки бота ограничивает исходящие сообщения
+30 в секунду (outbox.GLOBAL_RATE), поэтому при тысячах пользователей
+задержка растёт и из-за неё, а не только из-за API. Журнал бота остаётся
+в bot.log во временном каталоге, его путь выводится в конце.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import aiohttp
+
+import database
+from fake_services import PollinationsFake, TelegramFake, start_site
+
+ACTIONS = {'next': "Вперед", 'read': "Читать сейчас", 'voice': None}
+# Доля действий каждого вида
+ACTION_MIX = (('next', 0.5), ('read', 0.2), ('voice', 0.3))
+WEBHOOK_PATH = '/telegram/webhook'
+WEBHOOK_SECRET = 'load-test'
+PROGRESS_PREFIX = "Подождите"
+FIRST_CHAT_ID = 10_000_000
+VOICE_CALLBACK = re.compile(r'"(voice_\d+_\d+)"')
+
+
+async def populate(users, parts):
+    await database.init_db()
+    book_id = await database.add_book_with_parts(1, 'книга', [f'Фрагмент {n}. ' + 'Текст для чтения вслух. ' * 60 for n in range(1, parts + 1)])
+    rng = random.Random(0)
+    await database.update_users_data({
+        FIRST_CHAT_ID + n: {"current_book_id": book_id, "current_part": rng.randint(1, parts)} for n in range(users)
+    })
+    await database.close_db()
+
+
+def make_message(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Test"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+def make_callback(update_id, chat_id, data):
+    user = {"id": chat_id, "is_bot": False, "first_name": "Test"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": "Test"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+                "text": "фрагмент",
+            },
+        },
+    }
+
+
+class Replies:
+    """Ждёт итогового ответа бота каждому пользователю; подключается к TelegramFake.listeners."""
+
+    def __init__(self):
+        self.waiting = {}
+        self.voice_callbacks = {}
+
+    def __call__(self, method, chat_id, fields):
+        if chat_id is None:
+            return
+        chat_id = int(chat_id)
+        match = VOICE_CALLBACK.search(fields.get("reply_markup", ""))
+        if match:
+            self.voice_callbacks[chat_id] = match.group(1)
+        if method == 'sendaudio' or (method == 'sendmessage' and not fields.get("text", "").startswith(PROGRESS_PREFIX)):
+            future = self.waiting.pop(chat_id, None)
+            if future is not None and not future.done():
+                future.set_result(method)
+
+    def expect(self, chat_id):
+        future = self.waiting[chat_id] = asyncio.get_running_loop().create_future()
+        return future
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {action: [] for action in ACTIONS}
+        self.timeouts = dict.fromkeys(ACTIONS, 0)
+        self.errors = dict.fromkeys(ACTIONS, 0)
+        self.rejected = 0
+
+
+async def simulate_user(session, url, chat_id, replies, stats, update_ids, args, deadline, rng):
+    kinds, weights = zip(*ACTION_MIX)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+    # Пользователи начинают не одновременно
+    await asyncio.sleep(rng.uniform(0, args.think_time))
+    while time.monotonic() < deadline:
+        action = rng.choices(kinds, weights)[0]
+        callback = replies.voice_callbacks.get(chat_id)
+        if action == 'voice' and callback is None:
+            action = 'next'
+        if action == 'voice':
+            update = make_callback(next(update_ids), chat_id, callback)
+        else:
+            update = make_message(next(update_ids), chat_id, ACTIONS[action])
+        reply = replies.expect(chat_id)
+        started = time.perf_counter()
+        try:
+            while True:
+                async with session.post(url, json=update, headers=headers) as response:
+                    status = response.status
+                if status != 503:
+                    break
+                stats.rejected += 1
+                await asyncio.sleep(1)
+            if status != 200:
+                raise aiohttp.ClientResponseError(None, (), status=status)
+            await asyncio.wait_for(reply, args.timeout)
+            stats.latencies[action].append(time.perf_counter() - started)
+        except asyncio.TimeoutError:
+            stats.timeouts[action] += 1
+        except aiohttp.ClientError:
+            stats.errors[action] += 1
+        finally:
+            replies.waiting.pop(chat_id, None)
+        await asyncio.sleep(rng.expovariate(1 / args.think_time))
+
+
+async def wait_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError("бот завершился при запуске, см. bot.log")
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("бот не запустился")
+            await asyncio.sleep(0.5)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def summarize(stats, elapsed):
+    report = {}
+    for action in ACTIONS:
+        latencies = sorted(stats.latencies[action])
+        report[action] = {
+            "completed": len(latencies),
+            "timeouts": stats.timeouts[action],
+            "errors": stats.errors[action],
+            "per_second": len(latencies) / elapsed,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        }
+    return report
+
+
+async def run(args, tmp):
+    pollinations = PollinationsFake(args.format_latency, args.audio_latency, args.error_rate, seed=1)
+    telegram = TelegramFake(args.telegram_latency, args.telegram_error_rate, seed=2)
+    replies = Replies()
+    telegram.listeners.append(replies)
+    runners = [
+        await start_site(pollinations.app(), args.pollinations_port),
+        await start_site(telegram.app(), args.telegram_port),
+    ]
+    base_url = f'http://127.0.0.1:{args.bot_port}'
+    env = dict(
+        os.environ,
+        DB_PATH=os.path.join(tmp, 'bot.db'),
+        BOT_HTTP_PORT=str(args.bot_port),
+        WEBHOOK_URL=base_url,
+        WEBHOOK_SECRET=WEBHOOK_SECRET,
+        RUN_SCHEDULER='0',
+        TELEGRAM_API_URL=f'http://127.0.0.1:{args.telegram_port}',
+        POLLINATIONS_TEXT_URL=f'http://127.0.0.1:{args.pollinations_port}/',
+        POLLINATIONS_AUDIO_URL=f'http://127.0.0.1:{args.pollinations_port}/',
+    )
+    with open(os.path.join(tmp, 'bot.log'), 'wb') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bot.py')], cwd=tmp, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        await wait_ready(f'{base_url}/metrics', process)
+        stats = Stats()
+        update_ids = itertools.count(1)
+        rng = random.Random(args.seed)
+        started = time.monotonic()
+        deadline = started + args.duration
+        connector = aiohttp.TCPConnector(limit=args.connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*(
+                simulate_user(session, base_url + WEBHOOK_PATH, FIRST_CHAT_ID + n, replies, stats, update_ids, args, deadline,
+                              random.Random(rng.random()))
+                for n in range(args.users)
+            ))
+        elapsed = time.monotonic() - started
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        for runner in runners:
+            await runner.cleanup()
+    return summarize(stats, elapsed), stats.rejected, pollinations.requests, telegram.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--think-time', type=float, default=20, help="средняя пауза пользователя между нажатиями, с")
+    parser.add_argument('--timeout', type=float, default=120, help="сколько ждать ответа бота, с")
+    parser.add_argument('--parts', type=int, default=200)
+    parser.add_argument('--format-latency', type=float, default=1.5)
+    parser.add_argument('--audio-latency', type=float, default=4.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов Pollinations с ошибкой 503")
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0, help="доля ответов Telegram с ошибкой 429")
+    parser.add_argument('--connections', type=int, default=100, help="одновременных запросов к вебхуку")
+    parser.add_argument('--bot-port', type=int, default=8780)
+    parser.add_argument('--telegram-port', type=int, default=8781)
+    parser.add_argument('--pollinations-port', type=int, default=8782)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="записать результаты в JSON")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    tmp = tempfile.mkdtemp(prefix='load_test_')
+    database.DB_PATH = os.path.join(tmp, 'bot.db')
+    asyncio.run(populate(args.users, args.parts))
+    print(f"Пользователей: {args.users}, длительность: {args.duration:.0f} с, пауза: {args.think_time:.0f} с")
+    report, rejected, pollinations_requests, telegram_calls = asyncio.run(run(args, tmp))
+
+    print(f"{'действие':>9} {'выполнено':>10} {'в секунду':>10} {'p50, с':>8} {'p95, с':>8} {'p99, с':>8} {'тайм-аутов':>11} {'ошибок':>7}")
+    for action, row in report.items():
+        print(f"{action:>9} {row['completed']:>10} {row['per_second']:>10.1f} {row['p50']:>8.2f} {row['p95']:>8.2f} "
+              f"{row['p99']:>8.2f} {row['timeouts']:>11} {row['errors']:>7}")
+    print(f"Отклонено вебхуком (503): {rejected}")
+    print(f"Pollinations: {json.dumps(pollinations_requests)}")
+    print(f"Telegram: {json.dumps(telegram_calls)}")
+    print(f"Журнал бота: {os.path.join(tmp, 'bot.log')}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"users": args.users, "duration": args.duration, "actions": report, "rejected": rejected,
+                       "pollinations": pollinations_requests, "telegram": telegram_calls}, f, ensure_ascii=False, indent=2)
+    # База и кэш аудио не нужны, журнал оставляем для разбора
+    shutil.rmtree(os.path.join(tmp, 'audio_cache'), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
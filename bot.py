@@ -1,31 +1,41 @@
 import logging
 import asyncio
+import os
+import signal
 import aiohttp
-from io import BytesIO
-import pdfplumber
-import ebooklib
-from ebooklib import epub
-from docx import Document
 import requests
-from bs4 import BeautifulSoup
 import trafilatura
 import uvicorn
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Request, Response
 from config import API_TOKEN
 from datetime import datetime, timedelta
 import base64
 import io
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command, StateFilter
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
-import chardet
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from keyboard_handlers import register_keyboard_handlers
-from database import init_db, add_book, add_part, get_books, update_user_data, get_books_count, delete_book, get_user_data, get_part_text, get_total_parts
-from ai_utils import generate_audio, format_text_with_ai
-from utils import get_main_keyboard, split_text_into_parts, get_manage_upload_keyboard
-from states import ScheduleForm, set_schedule
+from database import init_db, close_db, delete_interrupted_imports, add_book_with_parts, get_books, get_books_count, delete_book, get_part_text, get_book_manifest, BOOK_IMPORTING, BookNotFoundError
+from ai_utils import send_audio_cached, format_text_with_ai, VOICES
+from utils import get_main_keyboard, split_text_into_parts, get_manage_upload_keyboard, part_label, normalize_url
+from states import ScheduleForm
+from scheduler import DeliveryScheduler, SCHEDULE_RELOAD_INTERVAL
+from prefetch import prefetcher
+from progress import ProgressMessage
+from api_client import api_client
+from extraction import extraction_executor, get_extension, ExtractionError, TextDecodeError
+from ingest import import_book, add_known_book, file_content_hash, EmptyBookError
+from cache import formatted_text_cache, audio_cache, content_key
+from outbox import send_queue, INTERACTIVE, BULK
+from inbox import update_queue
+from fsm_storage import DatabaseStorage
+from metrics import Gauge, HandlerMetricsMiddleware, TelegramMetricsMiddleware, render as render_metrics
+from sessions import sessions
+from webapp import router as webapp_router
 
 # Настройка логирования
 logging.basicConfig(
@@ -37,78 +47,117 @@ logging.basicConfig(
     ]
 )
 
-# Инициализация бота и диспетчера
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+# Веб-приложение можно запускать отдельно от бота несколькими процессами:
+# uvicorn webapp:app --workers N. Тогда бот запускается с SEPARATE_WEBAPP=1
+# и обслуживает на BOT_HTTP_PORT только свои служебные маршруты.
+SEPARATE_WEBAPP = os.getenv('SEPARATE_WEBAPP') == '1'
+BOT_HTTP_PORT = int(os.getenv('BOT_HTTP_PORT', '8000'))
+
+# С WEBHOOK_URL бот получает обновления вебхуком по адресу WEBHOOK_URL +
+# WEBHOOK_PATH, и несколько процессов бота за балансировщиком могут делить
+# нагрузку; без него — long polling. Отправку по расписанию при нескольких
+# процессах должен выполнять только один из них, у остальных RUN_SCHEDULER=0.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = '/telegram/webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+RUN_SCHEDULER = os.getenv('RUN_SCHEDULER', '1') == '1'
+# Свой сервер Bot API (например, benchmarks/fake_services.py) вместо api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Инициализация бота и диспетчера. В режиме вебхука шаги диалогов хранятся
+# в базе: следующее сообщение пользователя может попасть в другой процесс.
+bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
+# Общий лимит отправки и замер времени действуют на все вызовы бота, а не
+# только на очередь; замер внутренний, ожидание лимита в него не входит
+bot.session.middleware(send_queue.middleware())
+bot.session.middleware(TelegramMetricsMiddleware())
+dp = Dispatcher(storage=DatabaseStorage() if WEBHOOK_URL else MemoryStorage())
+for observer in (dp.message, dp.callback_query):
+    observer.middleware(HandlerMetricsMiddleware())
 
 # Настройка FastAPI для веб-приложения
 app = FastAPI()
-
-@app.get("/webapp")
-async def webapp():
-    logging.info("Запрос к веб-приложению")
-    return FileResponse("webapp.html")
-
-# Доступные голоса для Pollinations.ai
-VOICES = ["Alloy", "Echo", "Fable", "Nova", "Onyx", "Shimmer", "Coral", "Verse", "Ballad", "Ash", "Sage", "Amuch", "Dan"]
-
-# Функции извлечения текста из файлов
-def extract_text_from_pdf(file_bytes):
-    text = ''
-    with pdfplumber.open(BytesIO(file_bytes.getvalue())) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text(layout=True) or ''
-            text += page_text + '\n\n'
-    return text.strip()
-
-def extract_text_from_epub(file_bytes):
-    book = epub.read_epub(BytesIO(file_bytes.getvalue()))
-    text = ''
-    for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-        soup = BeautifulSoup(item.get_content(), 'html.parser')
-        for p in soup.find_all(['p', 'div']):
-            paragraph = p.get_text().strip()
-            if paragraph:
-                text += paragraph + '\n\n'
-    return text.strip()
-
-def extract_text_from_txt(file_bytes):
-    raw_data = file_bytes.getvalue()
-    detected = chardet.detect(raw_data)
-    encoding = detected['encoding'] or 'utf-8'
-    try:
-        return raw_data.decode(encoding).strip()
-    except UnicodeDecodeError:
-        logging.error(f"Не удалось декодировать файл с кодировкой {encoding}")
-        return None
-
-def extract_text_from_html(file_bytes):
-    soup = BeautifulSoup(file_bytes.getvalue(), 'html.parser')
-    text = ''
-    for p in soup.find_all(['p', 'div', 'article']):
-        paragraph = p.get_text().strip()
-        if paragraph:
-            text += paragraph + '\n\n'
-    return text.strip()
-
-def extract_text_from_docx(file_bytes):
-    doc = Document(BytesIO(file_bytes.getvalue()))
-    text = ''
-    for para in doc.paragraphs:
-        if para.text.strip():
-            text += para.text + '\n\n'
-    return text.strip()
+if not SEPARATE_WEBAPP:
+    app.include_router(webapp_router)
+
+@app.get("/api/stats")
+async def stats():
+    return {
+        "prefetch": prefetcher.stats(),
+        "formatted_cache": formatted_text_cache.stats(),
+        "audio_cache": audio_cache.stats(),
+        "api": api_client.stats(),
+        "scheduler": scheduler.stats(),
+        "outbox": send_queue.stats(),
+        "sessions": sessions.stats(),
+        "updates": update_queue.stats(),
+    }
+
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Показатели состояния считаются только при запросе /metrics
+Gauge('ai_requests_in_flight', 'Запросы к API Pollinations, ожидающие ответа', lambda: api_client.in_flight)
+Gauge('scheduled_users', 'Пользователи с расписанием отправки', lambda: scheduler.stats()["scheduled_users"])
+Gauge('cache_entries', 'Записей в кэше', lambda: {
+    ("formatted_text",): formatted_text_cache.entries or 0,
+    ("audio",): audio_cache.entries or 0,
+    ("sessions",): sessions.stats()["sessions"],
+}, ('cache',))
+Gauge('cache_bytes', 'Размер кэша в байтах', lambda: {
+    ("formatted_text",): formatted_text_cache.total_bytes or 0,
+    ("audio",): audio_cache.total_bytes or 0,
+}, ('cache',))
+Gauge('send_queue_depth', 'Сообщений в очереди отправки', lambda: send_queue.stats()["queue_depth"])
+Gauge('update_queue_pending', 'Обновлений Telegram, ожидающих обработки', lambda: update_queue.stats()["pending"])
+
+if WEBHOOK_URL:
+    @app.post(WEBHOOK_PATH)
+    async def telegram_webhook(request: Request):
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        if not update_queue.submit(update):
+            # Очередь переполнена или бот останавливается: Telegram повторит доставку позже
+            return Response(status_code=503)
+        return Response(status_code=200)
 
 # Запуск бота
 async def on_startup():
     await init_db()
+    if RUN_SCHEDULER:
+        # Загрузки остальных процессов бота могут ещё идти, поэтому прерванные
+        # загрузки удаляет только основной процесс
+        await delete_interrupted_imports()
+    if SEPARATE_WEBAPP or WEBHOOK_URL:
+        sessions.share()
+    sessions.start()
+    await api_client.start()
+    extraction_executor.start()
+    send_queue.start()
+    if RUN_SCHEDULER:
+        # Расписания, заданные через другие процессы бота, подхватываются из базы
+        await scheduler.start(SCHEDULE_RELOAD_INTERVAL if WEBHOOK_URL else None)
     logging.info("Бот запущен")
 
+# Остановка бота
+async def on_shutdown():
+    await update_queue.stop()
+    await scheduler.stop()
+    await send_queue.stop()
+    await prefetcher.close()
+    await api_client.close()
+    extraction_executor.shutdown()
+    await sessions.stop()
+    await close_db()
+    logging.info("Бот остановлен")
+
 # Команда /start
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     await message.answer("Добро пожаловать в бот для чтения! Загрузите файл книги или отправьте ссылку, чтобы начать.", reply_markup=get_main_keyboard())
-    await update_user_data(message.chat.id, {})
+    await sessions.update(message.chat.id, {})
     logging.info(f"Пользователь {message.chat.id} запустил бота")
 
 # Обработка загрузки документов
@@ -119,36 +168,60 @@ async def handle_document(message: types.Message):
         await message.answer("У вас уже есть 5 книг. Пожалуйста, удалите одну из них, чтобы добавить новую.", reply_markup=get_main_keyboard())
         return
     document = message.document
-    file_info = await bot.get_file(document.file_id)
-    file_bytes = await bot.download_file(file_info.file_path)
     file_name = document.file_name.lower()
-    
-    if file_name.endswith('.pdf'):
-        text = extract_text_from_pdf(file_bytes)
-    elif file_name.endswith('.epub'):
-        text = extract_text_from_epub(file_bytes)
-    elif file_name.endswith('.txt'):
-        text = extract_text_from_txt(file_bytes)
-        if text is None:
-            await message.answer("Не удалось прочитать текстовый файл. Проверьте кодировку.", reply_markup=get_main_keyboard())
-            return
-    elif file_name.endswith('.html'):
-        text = extract_text_from_html(file_bytes)
-    elif file_name.endswith('.docx'):
-        text = extract_text_from_docx(file_bytes)
-    else:
+    if get_extension(file_name) is None:
         await message.answer("Неподдерживаемый формат файла. Поддерживаются: PDF, EPUB, TXT, HTML, DOCX.", reply_markup=get_main_keyboard())
         logging.warning(f"Пользователь {message.chat.id} отправил неподдерживаемый файл: {file_name}")
         return
-    
-    parts = split_text_into_parts(text)
-    logging.info(f"Книга {file_name} разделена на {len(parts)} частей")
-    book_id = await add_book(message.chat.id, file_name)
-    for i, part in enumerate(parts, 1):
-        await add_part(book_id, i, part)
-    await update_user_data(message.chat.id, {"current_book_id": book_id, "current_part": 1})
-    await message.answer("Книга обработана и выбрана. Используйте кнопки 'Вперед' или 'Назад' для чтения или настройте расписание с помощью /schedule.", reply_markup=get_main_keyboard())
-    logging.info(f"Пользователь {message.chat.id} загрузил и выбрал книгу: {file_name}")
+    chat_id = message.chat.id
+    first_parts_book_id = None
+
+    async def on_first_parts(book_id):
+        nonlocal first_parts_book_id
+        first_parts_book_id = book_id
+        prefetcher.cancel(chat_id)
+        await sessions.update(chat_id, {"current_book_id": book_id, "current_part": 1})
+        await message.answer("Первые фрагменты книги готовы и книга выбрана — можно начинать читать кнопкой 'Вперед'. Остальная часть книги продолжает загружаться.", reply_markup=get_main_keyboard())
+
+    async with ProgressMessage(bot, chat_id, "Обрабатываем книгу"):
+        file_info = await bot.get_file(document.file_id)
+        file_bytes = await bot.download_file(file_info.file_path)
+        data = file_bytes.getvalue()
+        content_hash = await asyncio.to_thread(file_content_hash, data)
+        book_id = await add_known_book(chat_id, file_name, content_hash)
+        if book_id is not None:
+            logging.info(f"Файл {file_name} уже загружался, текст не извлекается повторно")
+        else:
+            chunks = extraction_executor.stream(file_name, data)
+            try:
+                book_id, total_parts = await import_book(chat_id, file_name, chunks, on_first_parts=on_first_parts, content_hash=content_hash)
+            except Exception as e:
+                if isinstance(e, TextDecodeError):
+                    reply = "Не удалось прочитать текстовый файл. Проверьте кодировку."
+                elif isinstance(e, BookNotFoundError):
+                    logging.warning(f"Загрузка {file_name} для {chat_id} прервана: книга удалена")
+                    reply = "Загрузка книги прервалась. Пожалуйста, отправьте файл ещё раз."
+                elif isinstance(e, (ExtractionError, EmptyBookError)):
+                    logging.error(f"Не удалось извлечь текст из {file_name} для {chat_id}: {e}")
+                    reply = "Не удалось обработать файл. Попробуйте другой файл."
+                else:
+                    logging.exception(f"Ошибка загрузки {file_name} для {chat_id}")
+                    reply = "Не удалось обработать файл. Попробуйте другой файл."
+                if first_parts_book_id is not None:
+                    # Книга, выбранная по первым фрагментам, удалена вместе с неудачной загрузкой
+                    user_data = await sessions.get(chat_id)
+                    if user_data and user_data.get('current_book_id') == first_parts_book_id:
+                        await sessions.update(chat_id, {"current_book_id": None, "current_part": None})
+                    reply += " Уже загруженные фрагменты этой книги удалены."
+                await message.answer(reply, reply_markup=get_main_keyboard())
+                return
+    if first_parts_book_id is not None:
+        await message.answer(f"Книга полностью загружена: {total_parts} фрагментов.", reply_markup=get_main_keyboard())
+    else:
+        prefetcher.cancel(chat_id)
+        await sessions.update(chat_id, {"current_book_id": book_id, "current_part": 1})
+        await message.answer("Книга обработана и выбрана. Используйте кнопки 'Вперед' или 'Назад' для чтения или настройте расписание с помощью /schedule.", reply_markup=get_main_keyboard())
+    logging.info(f"Пользователь {chat_id} загрузил и выбрал книгу: {file_name}")
 
 # Обработка ссылок
 @dp.message(lambda message: message.text and message.text.startswith('http'))
@@ -158,18 +231,21 @@ async def handle_link(message: types.Message):
         await message.answer("У вас уже есть 5 книг. Пожалуйста, удалите одну из них, чтобы добавить новую.", reply_markup=get_main_keyboard())
         return
     url = message.text
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            html = await response.text()
-    text = trafilatura.extract(html)
+    async with ProgressMessage(bot, message.chat.id, "Загружаем страницу"):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                html = await response.text()
+        text = trafilatura.extract(html)
     if text:
-        formatted_text = await format_text_with_ai(text, message.chat.id, bot)
-        parts = split_text_into_parts(formatted_text)
-        logging.info(f"Ссылка {url} разделена на {len(parts)} частей")
-        book_id = await add_book(message.chat.id, url)
-        for i, part in enumerate(parts, 1):
-            await add_part(book_id, i, part)
-        await update_user_data(message.chat.id, {"current_book_id": book_id, "current_part": 1})
+        content_hash = content_key('url', normalize_url(url), text)
+        book_id = await add_known_book(message.chat.id, url, content_hash)
+        if book_id is None:
+            formatted_text = await format_text_with_ai(text, message.chat.id, bot)
+            parts = split_text_into_parts(formatted_text)
+            logging.info(f"Ссылка {url} разделена на {len(parts)} частей")
+            book_id = await add_book_with_parts(message.chat.id, url, parts, content_hash=content_hash)
+        prefetcher.cancel(message.chat.id)
+        await sessions.update(message.chat.id, {"current_book_id": book_id, "current_part": 1})
         await message.answer("Ссылка обработана и книга выбрана. Используйте кнопки 'Вперед' или 'Назад' для чтения или настройте расписание с помощью /schedule.", reply_markup=get_main_keyboard())
         logging.info(f"Пользователь {message.chat.id} обработал и выбрал ссылку: {url}")
     else:
@@ -220,8 +296,8 @@ async def process_interval(message: types.Message, state: FSMContext):
             data = await state.get_data()
             start_time = data['start_time']
             end_time = data['end_time']
-            await set_schedule(message.chat.id, start_time, end_time, interval, bot, send_daily_part)
-            await message.answer(f"Расписание установлено: фрагменты будут отправляться с {start_time} до {end_time} каждые {interval} часов.", reply_markup=get_main_keyboard())
+            await scheduler.set(message.chat.id, start_time, end_time, interval)
+            await message.answer(f"Расписание установлено: фрагменты будут отправляться с {start_time} до {end_time} каждые {interval} часов. Отменить расписание можно командой /cancelschedule.", reply_markup=get_main_keyboard())
             await state.clear()
             logging.info(f"Пользователь {message.chat.id} установил расписание")
         else:
@@ -229,6 +305,15 @@ async def process_interval(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Неверный формат. Введите число (в часах).", reply_markup=get_main_keyboard())
 
+# Команда /cancelschedule
+@dp.message(Command("cancelschedule"))
+async def cmd_cancel_schedule(message: types.Message):
+    if await scheduler.cancel(message.chat.id):
+        await message.answer("Расписание отменено.", reply_markup=get_main_keyboard())
+    else:
+        await message.answer("У вас нет активного расписания.", reply_markup=get_main_keyboard())
+    logging.info(f"Пользователь {message.chat.id} отменил расписание")
+
 # Команда /selectbook
 @dp.message(Command("selectbook"))
 async def cmd_selectbook(message: types.Message):
@@ -246,7 +331,8 @@ async def cmd_selectbook(message: types.Message):
 async def process_book_choice(callback_query: types.CallbackQuery):
     book_id = int(callback_query.data.split('_')[1])
     chat_id = callback_query.from_user.id
-    await update_user_data(chat_id, {"current_book_id": book_id, "current_part": 1})
+    await sessions.update(chat_id, {"current_book_id": book_id, "current_part": 1})
+    prefetcher.cancel(chat_id)
     await callback_query.message.answer("Книга выбрана. Используйте кнопки 'Вперед' или 'Назад' для чтения.", reply_markup=get_main_keyboard())
     await callback_query.answer()
 
@@ -267,6 +353,7 @@ async def process_delete_book(callback_query: types.CallbackQuery):
     book_id = int(callback_query.data.split('_')[1])
     chat_id = callback_query.from_user.id
     await delete_book(book_id, chat_id)
+    prefetcher.cancel(chat_id)
     await callback_query.message.answer("Книга удалена.", reply_markup=get_main_keyboard())
     await callback_query.answer()
 
@@ -291,7 +378,7 @@ async def cmd_setvoice(message: types.Message):
 @dp.callback_query(lambda c: c.data in VOICES)
 async def process_voice_choice(callback_query: types.CallbackQuery):
     voice = callback_query.data
-    await update_user_data(callback_query.from_user.id, {"preferred_voice": voice})
+    await sessions.update(callback_query.from_user.id, {"preferred_voice": voice})
     await callback_query.message.answer(f"Голос установлен: {voice}.", reply_markup=get_main_keyboard())
     await callback_query.answer()
     logging.info(f"Пользователь {callback_query.from_user.id} установил голос {voice}")
@@ -299,7 +386,7 @@ async def process_voice_choice(callback_query: types.CallbackQuery):
 # Команда /tts
 @dp.message(Command("tts"))
 async def cmd_tts(message: types.Message):
-    user_data = await get_user_data(message.chat.id)
+    user_data = await sessions.get(message.chat.id)
     if user_data and user_data.get('current_book_id'):
         book_id, current_part, voice = user_data['current_book_id'], user_data['current_part'], user_data.get('preferred_voice')
         if not voice:
@@ -307,10 +394,7 @@ async def cmd_tts(message: types.Message):
             return
         text = await get_part_text(book_id, current_part)
         if text:
-            audio = await generate_audio(text, voice, chat_id=message.chat.id, bot=bot)
-            if audio:
-                audio_file = BufferedInputFile(audio, filename="audio.mp3")
-                await message.answer_audio(audio_file, reply_markup=get_main_keyboard())
+            if await send_audio_cached(bot, message.chat.id, text, voice, reply_markup=get_main_keyboard()):
                 logging.info(f"Пользователь {message.chat.id} запросил TTS для фрагмента {current_part} книги {book_id}")
             else:
                 await message.answer("Не удалось сгенерировать аудио.", reply_markup=get_main_keyboard())
@@ -334,74 +418,110 @@ async def handle_webapp_data(message: types.Message):
 # Обработчик кнопки "Озвучить текст"
 @dp.callback_query(lambda c: c.data.startswith('voice_'))
 async def voice_text_callback(callback_query: types.CallbackQuery):
-    from database import get_part_text, get_user_data
+    from database import get_part_text
     await callback_query.answer()  # Отвечаем на callback немедленно
     _, book_id, part_number = callback_query.data.split('_')
     book_id = int(book_id)
     part_number = int(part_number)
     chat_id = callback_query.from_user.id
-    user_data = await get_user_data(chat_id)
+    user_data = await sessions.get(chat_id)
     voice = user_data.get('preferred_voice') or "Alloy" if user_data else "Alloy"
     text = await get_part_text(book_id, part_number)
     logging.info(f"Запрошен текст части {part_number} для книги {book_id}: {'найден' if text else 'не найден'}")
     if text:
-        audio_bytes = await generate_audio(text, voice, chat_id=chat_id, bot=bot)
-        if audio_bytes:
-            audio_file = BufferedInputFile(audio_bytes, filename="audio.mp3")
-            await bot.send_audio(chat_id, audio_file)
-        else:
+        if not await send_audio_cached(bot, chat_id, text, voice):
             await bot.send_message(chat_id, "Не удалось сгенерировать аудио.")
     else:
         await bot.send_message(chat_id, "Текст не найден.")
 
-# Функция для отправки ежедневного фрагмента
-async def send_daily_part(chat_id, bot):
-    user_data = await get_user_data(chat_id)
+# Функция для отправки ежедневного фрагмента.
+# Сообщения идут через очередь отправки: по расписанию — с приоритетом BULK
+# и без сообщений о ходе форматирования, по кнопке — с приоритетом INTERACTIVE.
+async def send_daily_part(chat_id, bot, priority=INTERACTIVE):
+    user_data = await sessions.get(chat_id)
     logging.info(f"User data for {chat_id}: {user_data}")
     if user_data and user_data.get('current_book_id'):
         book_id, current_part = user_data['current_book_id'], user_data['current_part']
         text = await get_part_text(book_id, current_part)
-        total_parts = await get_total_parts(book_id)
+        manifest = await get_book_manifest(book_id)
+        total_parts = manifest["total_parts"] if manifest else 0
+        importing = bool(manifest) and manifest["status"] == BOOK_IMPORTING
         if text:
-            formatted_text = await format_text_with_ai(text, chat_id, bot)
+            formatted_text = await format_text_with_ai(text, chat_id, bot if priority == INTERACTIVE else None)
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=f"Фрагмент {current_part} из {total_parts}", callback_data="dummy")],
+                [InlineKeyboardButton(text=part_label(current_part, total_parts, importing), callback_data="dummy")],
                 [InlineKeyboardButton(text="Озвучить текст", callback_data=f"voice_{book_id}_{current_part}")]
             ])
             try:
-                await bot.send_message(chat_id, formatted_text, reply_markup=keyboard, parse_mode='HTML')
+                await send_queue.send(bot.send_message, chat_id, formatted_text, reply_markup=keyboard, parse_mode='HTML', priority=priority)
                 logging.info(f"Отправлен фрагмент {current_part} книги {book_id} пользователю {chat_id}")
             except Exception as e:
                 logging.error(f"Ошибка при отправке сообщения: {e}")
-                await bot.send_message(chat_id, "Произошла ошибка при отправке текста.", reply_markup=get_main_keyboard())
-            if await get_part_text(book_id, current_part + 1):
-                await update_user_data(chat_id, {"current_part": current_part + 1})
+                await send_queue.send(bot.send_message, chat_id, "Произошла ошибка при отправке текста.", reply_markup=get_main_keyboard(), priority=priority)
+            # Рассылка по расписанию не предзагружает: следующий фрагмент придёт
+            # только через несколько часов, а озвучку могут так и не запросить
+            if priority == INTERACTIVE:
+                prefetcher.on_part_served(chat_id, book_id, current_part, total_parts, user_data.get('preferred_voice'))
+            if importing or current_part < total_parts:
+                await sessions.update(chat_id, {"current_part": current_part + 1})
             else:
                 logging.info(f"Книга {book_id} завершена для пользователя {chat_id}")
-                await update_user_data(chat_id, {"current_book_id": None, "current_part": None})
-                await bot.send_message(chat_id, "Вы закончили книгу! Выберите новую с помощью /selectbook.", reply_markup=get_main_keyboard())
+                await sessions.update(chat_id, {"current_book_id": None, "current_part": None})
+                await send_queue.send(bot.send_message, chat_id, "Вы закончили книгу! Выберите новую с помощью /selectbook.", reply_markup=get_main_keyboard(), priority=priority)
+        elif importing:
+            await send_queue.send(bot.send_message, chat_id, "Этот фрагмент ещё загружается, попробуйте через несколько секунд.", reply_markup=get_main_keyboard(), priority=priority)
         else:
             logging.warning(f"Не найдена книга или фрагмент для пользователя {chat_id}")
-            await bot.send_message(chat_id, "Книга или фрагмент не найдены.", reply_markup=get_main_keyboard())
+            await send_queue.send(bot.send_message, chat_id, "Книга или фрагмент не найдены.", reply_markup=get_main_keyboard(), priority=priority)
     else:
         logging.warning(f"Нет выбранной книги для пользователя {chat_id}")
-        await bot.send_message(chat_id, "Книга не выбрана. Используйте /selectbook.", reply_markup=get_main_keyboard())
+        await send_queue.send(bot.send_message, chat_id, "Книга не выбрана. Используйте /selectbook.", reply_markup=get_main_keyboard(), priority=priority)
 
 # Регистрация обработчиков кнопок
 register_keyboard_handlers(dp, bot)
 
+# Планировщик отправки фрагментов по расписанию
+scheduler = DeliveryScheduler(lambda chat_id: send_daily_part(chat_id, bot, BULK))
+
 # Запуск веб-приложения
 async def start_webapp():
-    config = uvicorn.Config(app, host="0.0.0.0", port=8000, workers=1)
+    config = uvicorn.Config(app, host="0.0.0.0", port=BOT_HTTP_PORT, workers=1)
     server = uvicorn.Server(config)
     await server.serve()
 
-# Основная функция
-async def main():
-    await on_startup()
+def _log_exit_signal(signum, frame):
+    # uvicorn, остановившись по сигналу, посылает его процессу ещё раз;
+    # к этому моменту main() уже сама завершает работу
+    logging.info(f"Получен сигнал {signal.Signals(signum).name}, бот завершает работу")
+
+async def run_webhook():
+    update_queue.start(lambda update: dp.feed_update(bot, update))
+    await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    logging.info(f"Бот получает обновления через вебхук {WEBHOOK_URL + WEBHOOK_PATH}")
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, _log_exit_signal)
+    # uvicorn по SIGTERM/SIGINT перестаёт принимать запросы и дожидается
+    # текущих; принятые обновления дообрабатываются в on_shutdown()
+    await start_webapp()
+
+async def run_polling():
+    # Вебхук, оставшийся от запуска в режиме вебхука, мешает getUpdates
+    await bot.delete_webhook()
     webapp_task = asyncio.create_task(start_webapp())
     await dp.start_polling(bot)
     await webapp_task
 
+# Основная функция
+async def main():
+    await on_startup()
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        await on_shutdown()
+
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
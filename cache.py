@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import logging
+import os
+import database
+
+# Максимальный суммарный размер кэша отформатированного текста (в байтах UTF-8)
+FORMATTED_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Каталог и лимит размера дискового кэша аудио
+AUDIO_CACHE_DIR = 'audio_cache'
+AUDIO_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+
+def content_key(*parts):
+    """SHA-256 от набора строк; используется как ключ кэшей."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class FormattedTextCache:
+    """LRU-кэш результатов format_text_with_ai, хранящийся в таблице formatted_cache."""
+
+    def __init__(self, max_bytes=FORMATTED_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.entries = None
+        self.total_bytes = None
+        self._lock = asyncio.Lock()
+
+    async def _load_size(self):
+        if self.total_bytes is None:
+            self.entries, self.total_bytes = await database.get_formatted_cache_size()
+
+    async def get(self, key, record=True):
+        text = await database.get_formatted_cache(key)
+        if record:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return text
+
+    async def put(self, key, text):
+        size = len(text.encode('utf-8'))
+        async with self._lock:
+            await self._load_size()
+            if not await database.put_formatted_cache(key, text, size):
+                return
+            self.entries += 1
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                evicted, freed = await database.evict_formatted_cache(self.total_bytes - self.max_bytes)
+                self.entries -= evicted
+                self.total_bytes -= freed
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.entries,
+            "bytes": self.total_bytes,
+        }
+
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Один и тот же файл могут одновременно записывать бот и процессы веб-приложения
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class AudioCache:
+    """Дисковый LRU-кэш сгенерированного аудио с file_id, полученными от Telegram.
+
+    Метаданные хранятся в таблице audio_cache, сами MP3 — в каталоге directory.
+    """
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+        self.entries = None
+        self.total_bytes = None
+        self._lock = asyncio.Lock()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.mp3")
+
+    async def _load_size(self):
+        if self.total_bytes is None:
+            self.entries, self.total_bytes = await database.get_audio_cache_size()
+
+    async def get(self, key):
+        """Возвращает {"file_id", "audio"} для закэшированного аудио или None.
+
+        Если file_id уже известен, файл с диска не читается и audio равно None.
+        """
+        entry = await database.get_audio_cache(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry["file_id"]:
+            self.file_id_hits += 1
+            return {"file_id": entry["file_id"], "audio": None}
+        try:
+            audio = await asyncio.to_thread(_read_file, entry["path"])
+        except FileNotFoundError:
+            logging.warning(f"Файл аудиокэша {entry['path']} не найден")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"file_id": None, "audio": audio}
+
+    async def contains(self, key):
+        return await database.get_audio_cache(key) is not None
+
+    async def find_file(self, key):
+        """Путь к MP3 в кэше без чтения файла или None, если аудио нет на диске."""
+        entry = await database.get_audio_cache(key)
+        if entry is None or not os.path.exists(entry["path"]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["path"]
+
+    async def load_audio(self, key):
+        """Читает MP3 с диска, например когда file_id перестал действовать."""
+        try:
+            return await asyncio.to_thread(_read_file, self.path_for(key))
+        except FileNotFoundError:
+            return None
+
+    async def put(self, key, audio):
+        path = self.path_for(key)
+        await asyncio.to_thread(_write_file, path, audio)
+        async with self._lock:
+            await self._load_size()
+            if not await database.put_audio_cache(key, path, len(audio)):
+                return
+            self.entries += 1
+            self.total_bytes += len(audio)
+            if self.total_bytes > self.max_bytes:
+                paths, freed = await database.evict_audio_cache(self.total_bytes - self.max_bytes)
+                await asyncio.to_thread(_remove_files, paths)
+                self.entries -= len(paths)
+                self.total_bytes -= freed
+
+    async def set_file_id(self, key, file_id):
+        await database.set_audio_file_id(key, file_id)
+
+    def stats(self):
+        total = self.hits + self.file_id_hits + self.misses
+        return {
+            "hits": self.hits,
+            "file_id_hits": self.file_id_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.file_id_hits) / total if total else 0.0,
+            "entries": self.entries,
+            "bytes": self.total_bytes,
+        }
+
+
+formatted_text_cache = FormattedTextCache()
+audio_cache = AudioCache()
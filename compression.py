@@ -0,0 +1,49 @@
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Способ хранения текста частей в колонке parts.codec
+CODEC_PLAIN = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+# Алгоритм сжатия новых частей: zlib, zstd (нужен пакет zstandard) или none
+TEXT_COMPRESSION = os.getenv('TEXT_COMPRESSION', 'zlib')
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+# Текст короче этого не сжимается: выигрыш меньше накладных расходов
+MIN_COMPRESS_BYTES = 256
+
+_zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if zstandard else None
+_zstd_decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+
+def compress_text(text, method=None):
+    """(codec, данные) для записи в parts; если сжатие не уменьшает размер, текст хранится как есть."""
+    method = method or TEXT_COMPRESSION
+    data = text.encode('utf-8')
+    if method == 'none' or len(data) < MIN_COMPRESS_BYTES:
+        return CODEC_PLAIN, text
+    if method == 'zstd' and _zstd_compressor is not None:
+        codec, compressed = CODEC_ZSTD, _zstd_compressor.compress(data)
+    else:
+        codec, compressed = CODEC_ZLIB, zlib.compress(data, ZLIB_LEVEL)
+    if len(compressed) >= len(data):
+        return CODEC_PLAIN, text
+    return codec, compressed
+
+
+def decompress_text(codec, data):
+    if data is None or codec == CODEC_PLAIN:
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data).decode('utf-8')
+    if codec == CODEC_ZSTD:
+        if _zstd_decompressor is None:
+            raise RuntimeError("часть сжата zstd, но пакет zstandard не установлен")
+        return _zstd_decompressor.decompress(data).decode('utf-8')
+    raise ValueError(f"неизвестный способ хранения текста: {codec}")
@@ -1,14 +1,203 @@
+import asyncio
+import os
+import sqlite3
+import time
 import aiosqlite
 import logging
+from contextlib import asynccontextmanager
+from compression import compress_text, decompress_text, CODEC_PLAIN
+from metrics import timed, DB_QUERY_SECONDS
 
-async def init_db():
-    async with aiosqlite.connect('bot.db') as db:
-        await db.execute('''CREATE TABLE IF NOT EXISTS books (
+DB_PATH = os.getenv('DB_PATH', 'bot.db')
+# Количество соединений только для чтения в пуле
+READ_POOL_SIZE = 4
+# Размер кэша подготовленных выражений sqlite3 на соединение
+STATEMENT_CACHE_SIZE = 256
+
+# Сколько ждать, пока другой процесс освободит базу, прежде чем вернуть ошибку (мс)
+BUSY_TIMEOUT_MS = 5000
+# Автоматический checkpoint: журнал WAL переносится в базу, когда в нём
+# набирается столько страниц (по 4 КБ)
+WAL_AUTOCHECKPOINT_PAGES = 1000
+# До какого размера обрезается файл журнала после checkpoint
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+PRAGMAS = (
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}',
+    # В режиме WAL потеря питания может откатить последние транзакции,
+    # но не повредит базу; fsync при каждом commit не нужен
+    'PRAGMA synchronous = NORMAL',
+    f'PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT_PAGES}',
+    f'PRAGMA journal_size_limit = {JOURNAL_SIZE_LIMIT}',
+)
+
+
+class ConnectionPool:
+    """Долгоживущие соединения с bot.db: одно для записи и несколько для чтения.
+
+    База работает в режиме WAL: читатели не ждут писателя, поэтому бот и
+    несколько процессов веб-приложения могут открыть её одновременно.
+    Записи внутри процесса идут по очереди через _write_lock, а между
+    процессами — через блокировку SQLite, которую берёт BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, path, read_pool_size=READ_POOL_SIZE):
+        self.path = path
+        self.read_pool_size = read_pool_size
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all = []
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        self._all.append(conn)
+        return conn
+
+    async def open(self):
+        self._writer = await self._connect()
+        # Режим журнала хранится в самой базе; повторное включение ничего не меняет
+        async with self._writer.execute('PRAGMA journal_mode = WAL') as cursor:
+            journal_mode = (await cursor.fetchone())[0]
+        if journal_mode.lower() != 'wal':
+            logging.warning(f"Не удалось включить WAL для {self.path}, режим журнала: {journal_mode}")
+        for _ in range(self.read_pool_size):
+            self._readers.put_nowait(await self._connect())
+        logging.info(f"Открыт пул соединений к {self.path}: 1 на запись, {self.read_pool_size} на чтение")
+
+    async def close(self):
+        for conn in self._all:
+            await conn.close()
+        self._all.clear()
+        self._writer = None
+        self._readers = asyncio.Queue()
+        logging.info(f"Пул соединений к {self.path} закрыт")
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def checkpoint(self, mode='PASSIVE'):
+        """Переносит журнал WAL в базу; (занято ли, страниц в журнале, перенесено страниц)."""
+        async with self._write_lock:
+            async with self._writer.execute(f'PRAGMA wal_checkpoint({mode})') as cursor:
+                return tuple(await cursor.fetchone())
+
+    @asynccontextmanager
+    async def write(self):
+        """Транзакция на соединении записи: commit при успехе, rollback при ошибке.
+
+        Блокировка записи берётся сразу (BEGIN IMMEDIATE), поэтому чтения
+        внутри транзакции не могут устареть из-за записи другого процесса.
+        """
+        async with self._write_lock:
+            try:
+                await self._writer.execute('BEGIN IMMEDIATE')
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+
+_pool = None
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("База данных не инициализирована: вызовите init_db()")
+    return _pool
+
+
+# Скорость чтения и озвучки для оценки длительности книги (слов в минуту)
+READING_WORDS_PER_MINUTE = 180
+AUDIO_WORDS_PER_MINUTE = 150
+# Сколько манифестов книг держать в памяти
+MANIFEST_CACHE_SIZE = 1024
+# Сколько частей сжимать за один шаг миграции
+COMPRESS_BATCH_SIZE = 500
+
+
+def part_stats(text):
+    """(число символов, число слов) части."""
+    return len(text), len(text.split())
+
+
+async def _backfill_book_manifest(db):
+    async with db.execute('SELECT id FROM books') as cursor:
+        book_ids = [row[0] for row in await cursor.fetchall()]
+    for book_id in book_ids:
+        async with db.execute('SELECT id, text FROM parts WHERE book_id = ? ORDER BY part_number', (book_id,)) as cursor:
+            parts = await cursor.fetchall()
+        rows = []
+        offset = words = 0
+        for part_id, text in parts:
+            char_count, word_count = part_stats(text or '')
+            rows.append((char_count, word_count, offset, part_id))
+            offset += char_count
+            words += word_count
+        await db.executemany('UPDATE parts SET char_count = ?, word_count = ?, char_offset = ? WHERE id = ?', rows)
+        await db.execute('UPDATE books SET total_parts = ?, total_chars = ?, total_words = ? WHERE id = ?',
+                         (len(parts), offset, words, book_id))
+
+
+async def _add_part_codec_column(db):
+    # Повторный запуск миграции 9 после сбоя не должен падать на уже добавленном столбце
+    async with db.execute('PRAGMA table_info(parts)') as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if 'codec' not in columns:
+        await db.execute('ALTER TABLE parts ADD COLUMN codec INTEGER NOT NULL DEFAULT 0')
+
+
+async def _compress_existing_parts(db):
+    """Сжимает части пачками, фиксируя каждую пачку отдельной транзакцией.
+
+    Так блокировка записи не держится на всё время сжатия большой базы.
+    Несжатые части выбираются по codec, поэтому после сбоя сжатие
+    продолжается с оставшихся частей.
+    """
+    last_id = 0
+    compressed = 0
+    while True:
+        async with db.execute('SELECT id, text FROM parts WHERE id > ? AND codec = ? ORDER BY id LIMIT ?',
+                              (last_id, CODEC_PLAIN, COMPRESS_BATCH_SIZE)) as cursor:
+            batch = await cursor.fetchall()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        rows = []
+        for part_id, text in batch:
+            codec, data = compress_text(text or '')
+            if codec != CODEC_PLAIN:
+                rows.append((data, codec, part_id))
+        await db.executemany('UPDATE parts SET text = ?, codec = ? WHERE id = ?', rows)
+        compressed += len(rows)
+        await db.commit()
+        await db.execute('BEGIN IMMEDIATE')
+    logging.info(f"Сжато частей: {compressed}")
+
+
+# Миграции схемы в порядке применения: (версия, описание, шаги).
+# Шаг — SQL-строка или async-функция, получающая соединение записи.
+# Применённые версии записываются в schema_version.
+MIGRATIONS = [
+    (1, "исходная схема", (
+        '''CREATE TABLE IF NOT EXISTS books (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             title TEXT
-        )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS users (
+        )''',
+        '''CREATE TABLE IF NOT EXISTS users (
             chat_id INTEGER PRIMARY KEY,
             current_book_id INTEGER,
             current_part INTEGER,
@@ -16,89 +205,543 @@ async def init_db():
             schedule_end_time TEXT,
             schedule_interval INTEGER,
             preferred_voice TEXT
-        )''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS parts (
+        )''',
+        '''CREATE TABLE IF NOT EXISTS parts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             book_id INTEGER,
             part_number INTEGER,
             text TEXT
+        )''',
+    )),
+    (2, "уникальный индекс частей по (book_id, part_number)", (
+        'DELETE FROM parts WHERE id NOT IN (SELECT MIN(id) FROM parts GROUP BY book_id, part_number)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_parts_book_part ON parts (book_id, part_number)',
+    )),
+    (3, "индекс книг по user_id", (
+        'CREATE INDEX IF NOT EXISTS idx_books_user ON books (user_id)',
+    )),
+    (4, "кэш отформатированного текста", (
+        '''CREATE TABLE IF NOT EXISTS formatted_cache (
+            key TEXT PRIMARY KEY,
+            text TEXT,
+            size INTEGER,
+            last_used REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_formatted_cache_last_used ON formatted_cache (last_used)',
+    )),
+    (5, "кэш аудио", (
+        '''CREATE TABLE IF NOT EXISTS audio_cache (
+            key TEXT PRIMARY KEY,
+            path TEXT,
+            size INTEGER,
+            file_id TEXT,
+            last_used REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_audio_cache_last_used ON audio_cache (last_used)',
+    )),
+    (6, "статус загрузки книги", (
+        "ALTER TABLE books ADD COLUMN status TEXT NOT NULL DEFAULT 'ready'",
+    )),
+    (7, "время следующей отправки по расписанию", (
+        'ALTER TABLE users ADD COLUMN schedule_next_run REAL',
+    )),
+    (8, "манифест книги: число частей, символов и слов", (
+        'ALTER TABLE books ADD COLUMN total_parts INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE books ADD COLUMN total_chars INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE books ADD COLUMN total_words INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE parts ADD COLUMN char_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE parts ADD COLUMN word_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE parts ADD COLUMN char_offset INTEGER NOT NULL DEFAULT 0',
+        _backfill_book_manifest,
+    )),
+    (9, "сжатие текста частей", (
+        _add_part_codec_column,
+        _compress_existing_parts,
+    )),
+    (10, "общее содержимое книг с одинаковым текстом", (
+        '''CREATE TABLE IF NOT EXISTS book_contents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content_hash TEXT
+        )''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_book_contents_hash ON book_contents (content_hash)',
+        'INSERT INTO book_contents (id) SELECT id FROM books',
+        'ALTER TABLE books ADD COLUMN content_id INTEGER',
+        'UPDATE books SET content_id = id',
+        'CREATE INDEX IF NOT EXISTS idx_books_content ON books (content_id)',
+        'ALTER TABLE parts RENAME COLUMN book_id TO content_id',
+    )),
+    (11, "состояния диалогов (FSM), общие для процессов бота", (
+        '''CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT
+        )''',
+    )),
+]
+
+BOOK_IMPORTING = 'importing'
+BOOK_READY = 'ready'
+
+
+class BookNotFoundError(Exception):
+    """Книги уже нет в базе: например, её загрузку удалили как прерванную."""
+
+
+async def _apply_migration(pool, version, description, steps):
+    """Применяет миграцию, если её ещё нет; False, если её уже применил другой процесс."""
+    async with pool.write() as db:
+        # Версия проверяется в той же транзакции: если бот и процессы
+        # веб-приложения стартуют одновременно, миграцию применит только один
+        async with db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version') as cursor:
+            if (await cursor.fetchone())[0] >= version:
+                return False
+        for step in steps:
+            if callable(step):
+                await step(db)
+            else:
+                await db.execute(step)
+        # OR IGNORE: миграцию, которая фиксирует работу по частям (сжатие), мог
+        # параллельно довести до конца и другой процесс
+        await db.execute('INSERT OR IGNORE INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+    return True
+
+
+async def _apply_migrations(pool):
+    async with pool.write() as db:
+        await db.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
         )''')
-        await db.commit()
-    logging.info("База данных инициализирована")
+    for version, description, steps in MIGRATIONS:
+        while True:
+            try:
+                applied = await _apply_migration(pool, version, description, steps)
+                break
+            except sqlite3.OperationalError as e:
+                # Долгую миграцию (например, сжатие частей) может выполнять другой процесс
+                if 'locked' not in str(e):
+                    raise
+                logging.info(f"База занята другим процессом, ждём перед миграцией {version}")
+        if applied:
+            logging.info(f"Применена миграция {version}: {description}")
+    return max(version for version, _, _ in MIGRATIONS)
 
-async def add_book(user_id, title):
-    async with aiosqlite.connect('bot.db') as db:
-        await db.execute('INSERT INTO books (user_id, title) VALUES (?, ?)', (user_id, title))
-        await db.commit()
-        cursor = await db.execute('SELECT last_insert_rowid()')
-        book_id = (await cursor.fetchone())[0]
-        logging.info(f"Добавлена книга {title} для user_id {user_id}, book_id: {book_id}")
-        return book_id
-
-async def add_part(book_id, part_number, text):
-    async with aiosqlite.connect('bot.db') as db:
-        await db.execute('INSERT INTO parts (book_id, part_number, text) VALUES (?, ?, ?)', (book_id, part_number, text))
-        await db.commit()
-        logging.info(f"Добавлена часть {part_number} для книги {book_id}")
 
+async def init_db():
+    global _pool
+    if _pool is None:
+        pool = ConnectionPool(DB_PATH)
+        await pool.open()
+        _pool = pool
+    version = await _apply_migrations(_pool)
+    logging.info(f"База данных инициализирована, версия схемы: {version}")
+
+
+async def close_db():
+    global _pool
+    if _pool is not None:
+        try:
+            # Обрезаем журнал, чтобы база на диске была полной; если её ещё
+            # читают другие процессы, checkpoint просто не завершится
+            await _pool.checkpoint('TRUNCATE')
+        except Exception as e:
+            logging.warning(f"Не удалось выполнить checkpoint при закрытии базы: {e}")
+        await _pool.close()
+        _pool = None
+
+
+async def _create_content(db, user_id, title, status):
+    cursor = await db.execute('INSERT INTO book_contents DEFAULT VALUES')
+    content_id = cursor.lastrowid
+    cursor = await db.execute('INSERT INTO books (user_id, title, status, content_id) VALUES (?, ?, ?, ?)',
+                              (user_id, title, status, content_id))
+    return cursor.lastrowid
+
+async def _claim_content_hash(db, book_id, content_hash):
+    # Если такой же текст успели загрузить параллельно, эта копия остаётся без хэша
+    await db.execute('''UPDATE book_contents SET content_hash = ?
+        WHERE id = (SELECT content_id FROM books WHERE id = ?)
+        AND NOT EXISTS (SELECT 1 FROM book_contents WHERE content_hash = ?)''', (content_hash, book_id, content_hash))
+
+async def _release_content(db, content_id):
+    """Удаляет части и содержимое, если на него больше не ссылается ни одна книга."""
+    async with db.execute('SELECT 1 FROM books WHERE content_id = ? LIMIT 1', (content_id,)) as cursor:
+        if await cursor.fetchone():
+            return False
+    await db.execute('DELETE FROM parts WHERE content_id = ?', (content_id,))
+    await db.execute('DELETE FROM book_contents WHERE id = ?', (content_id,))
+    return True
+
+@timed(DB_QUERY_SECONDS)
+async def add_book_with_parts(user_id, title, parts, content_hash=None):
+    """Добавляет книгу и все её части одной транзакцией.
+
+    При ошибке на любом шаге транзакция откатывается, и книга не остаётся
+    загруженной наполовину. content_hash позволяет потом найти этот текст
+    через find_book_content. Возвращает book_id новой книги.
+    """
+    started = time.perf_counter()
+    async with get_pool().write() as db:
+        book_id = await _create_content(db, user_id, title, BOOK_READY)
+        rows = await _insert_parts(db, book_id, 1, parts)
+        if content_hash:
+            await _claim_content_hash(db, book_id, content_hash)
+    elapsed = time.perf_counter() - started
+    rate = len(rows) / elapsed if elapsed > 0 else float('inf')
+    logging.info(f"Добавлена книга {title} для user_id {user_id}, book_id: {book_id}, частей: {len(rows)} за {elapsed:.3f} с ({rate:.0f} строк/с)")
+    return book_id
+
+@timed(DB_QUERY_SECONDS)
+async def create_book(user_id, title, status=BOOK_IMPORTING):
+    """Создаёт книгу без частей; части добавляются потом через add_parts."""
+    async with get_pool().write() as db:
+        book_id = await _create_content(db, user_id, title, status)
+    logging.info(f"Создана книга {title} для user_id {user_id}, book_id: {book_id}, статус: {status}")
+    return book_id
+
+@timed(DB_QUERY_SECONDS)
+async def find_book_content(content_hash):
+    """content_id полностью загруженного текста с таким хэшем или None."""
+    async with get_pool().read() as db:
+        async with db.execute('''SELECT c.id FROM book_contents c JOIN books b ON b.content_id = c.id
+            WHERE c.content_hash = ? AND b.status = ? LIMIT 1''', (content_hash, BOOK_READY)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+@timed(DB_QUERY_SECONDS)
+async def add_book_from_content(user_id, title, content_id):
+    """Добавляет в библиотеку пользователя книгу с уже загруженным текстом, не копируя части.
+
+    Манифест берётся у другой книги с тем же содержимым. Возвращает book_id
+    или None, если содержимое успели удалить.
+    """
+    async with get_pool().write() as db:
+        cursor = await db.execute('''INSERT INTO books (user_id, title, status, content_id, total_parts, total_chars, total_words)
+            SELECT ?, ?, ?, content_id, total_parts, total_chars, total_words FROM books
+            WHERE content_id = ? AND status = ? LIMIT 1''', (user_id, title, BOOK_READY, content_id, BOOK_READY))
+        book_id = cursor.lastrowid if cursor.rowcount else None
+    if book_id:
+        logging.info(f"Добавлена книга {title} для user_id {user_id}, book_id: {book_id}, содержимое {content_id} уже загружено")
+    return book_id
+
+@timed(DB_QUERY_SECONDS)
+async def set_book_content_hash(book_id, content_hash):
+    async with get_pool().write() as db:
+        await _claim_content_hash(db, book_id, content_hash)
+
+@timed(DB_QUERY_SECONDS)
+async def add_parts(book_id, first_part_number, parts):
+    """Добавляет пачку частей одной транзакцией, нумеруя их с first_part_number."""
+    async with get_pool().write() as db:
+        rows = await _insert_parts(db, book_id, first_part_number, parts)
+    return len(rows)
+
+def _prepare_parts(content_id, first_part_number, parts, offset):
+    rows = []
+    words = 0
+    for part_number, text in enumerate(parts, first_part_number):
+        char_count, word_count = part_stats(text)
+        codec, data = compress_text(text)
+        rows.append((content_id, part_number, data, codec, char_count, word_count, offset))
+        offset += char_count
+        words += word_count
+    return rows, offset, words
+
+async def _insert_parts(db, book_id, first_part_number, parts):
+    """Записывает части сжатыми вместе с их размерами и добавляет их к итогам в манифесте книги."""
+    async with db.execute('SELECT content_id, total_chars FROM books WHERE id = ?', (book_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        raise BookNotFoundError(f"книга {book_id} удалена")
+    content_id, offset = row
+    # zlib отпускает GIL, поэтому сжатие большой пачки не задерживает цикл событий
+    rows, offset, words = await asyncio.to_thread(_prepare_parts, content_id, first_part_number, parts, offset)
+    await db.executemany('INSERT INTO parts (content_id, part_number, text, codec, char_count, word_count, char_offset) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    await db.execute('UPDATE books SET total_parts = total_parts + ?, total_chars = ?, total_words = total_words + ? WHERE id = ?',
+                     (len(rows), offset, words, book_id))
+    return rows
+
+@timed(DB_QUERY_SECONDS)
+async def set_book_status(book_id, status):
+    async with get_pool().write() as db:
+        cursor = await db.execute('UPDATE books SET status = ? WHERE id = ?', (status, book_id))
+    if not cursor.rowcount:
+        raise BookNotFoundError(f"книга {book_id} удалена")
+    logging.info(f"Статус книги {book_id}: {status}")
+
+_manifest_cache = {}
+
+@timed(DB_QUERY_SECONDS)
+async def get_book_manifest(book_id):
+    """Манифест книги: статус, число частей, символов и слов, оценка времени чтения и озвучки.
+
+    Итоги записываются вместе с частями, поэтому навигации не нужно считать
+    части или читать их текст. Манифест загруженной книги кэшируется в
+    памяти и сбрасывается при удалении книги.
+    """
+    manifest = _manifest_cache.get(book_id)
+    if manifest is not None:
+        return manifest
+    async with get_pool().read() as db:
+        async with db.execute('SELECT title, status, content_id, total_parts, total_chars, total_words FROM books WHERE id = ?', (book_id,)) as cursor:
+            row = await cursor.fetchone()
+    if row is None:
+        return None
+    title, status, content_id, total_parts, total_chars, total_words = row
+    manifest = {
+        "title": title,
+        "content_id": content_id,
+        "status": status,
+        "total_parts": total_parts,
+        "total_chars": total_chars,
+        "total_words": total_words,
+        "reading_seconds": total_words * 60 / READING_WORDS_PER_MINUTE,
+        "audio_seconds": total_words * 60 / AUDIO_WORDS_PER_MINUTE,
+    }
+    if status == BOOK_READY:
+        # Манифест загружаемой книги ещё меняется, его не кэшируем
+        if len(_manifest_cache) >= MANIFEST_CACHE_SIZE:
+            del _manifest_cache[next(iter(_manifest_cache))]
+        _manifest_cache[book_id] = manifest
+    return manifest
+
+@timed(DB_QUERY_SECONDS)
+async def delete_interrupted_imports():
+    """Удаляет книги, загрузка которых прервалась (например, из-за перезапуска бота)."""
+    async with get_pool().write() as db:
+        async with db.execute('SELECT id, content_id FROM books WHERE status = ?', (BOOK_IMPORTING,)) as cursor:
+            rows = await cursor.fetchall()
+        book_ids = [(book_id,) for book_id, _ in rows]
+        await db.executemany('DELETE FROM books WHERE id = ?', book_ids)
+        for _, content_id in rows:
+            await _release_content(db, content_id)
+        await db.executemany('UPDATE users SET current_book_id = NULL, current_part = NULL WHERE current_book_id = ?', book_ids)
+    if book_ids:
+        logging.warning(f"Удалены незавершённые загрузки книг: {[book_id for book_id, in book_ids]}")
+    return len(book_ids)
+
+@timed(DB_QUERY_SECONDS)
 async def get_books(user_id):
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute('SELECT id, title FROM books WHERE user_id = ?', (user_id,))
-        books = await cursor.fetchall()
-        logging.info(f"Получен список книг для user_id {user_id}: {len(books)} книг")
-        return books
+    async with get_pool().read() as db:
+        async with db.execute('SELECT id, title FROM books WHERE user_id = ?', (user_id,)) as cursor:
+            books = await cursor.fetchall()
+    logging.info(f"Получен список книг для user_id {user_id}: {len(books)} книг")
+    return books
 
+@timed(DB_QUERY_SECONDS)
 async def get_part_text(book_id, part_number):
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute('SELECT text FROM parts WHERE book_id = ? AND part_number = ?', (book_id, part_number))
-        row = await cursor.fetchone()
-        logging.info(f"Запрошен текст части {part_number} для книги {book_id}: {'найден' if row else 'не найден'}")
-        return row[0] if row else None
+    async with get_pool().read() as db:
+        async with db.execute('''SELECT p.text, p.codec FROM books b
+            JOIN parts p ON p.content_id = b.content_id AND p.part_number = ? WHERE b.id = ?''', (part_number, book_id)) as cursor:
+            row = await cursor.fetchone()
+    logging.info(f"Запрошен текст части {part_number} для книги {book_id}: {'найден' if row else 'не найден'}")
+    return decompress_text(row[1], row[0]) if row else None
+
+@timed(DB_QUERY_SECONDS)
+async def get_parts_range(book_id, first_part_number, count):
+    """[(номер, текст)] частей с first_part_number по first_part_number + count - 1, которые уже есть."""
+    async with get_pool().read() as db:
+        async with db.execute('''SELECT p.part_number, p.text, p.codec FROM books b
+            JOIN parts p ON p.content_id = b.content_id AND p.part_number BETWEEN ? AND ?
+            WHERE b.id = ? ORDER BY p.part_number''', (first_part_number, first_part_number + count - 1, book_id)) as cursor:
+            rows = await cursor.fetchall()
+    return [(part_number, decompress_text(codec, text)) for part_number, text, codec in rows]
 
 async def get_total_parts(book_id):
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute('SELECT COUNT(*) FROM parts WHERE book_id = ?', (book_id,))
-        count = (await cursor.fetchone())[0]
-        logging.info(f"Общее количество частей для книги {book_id}: {count}")
-        return count
+    manifest = await get_book_manifest(book_id)
+    return manifest["total_parts"] if manifest else 0
 
+@timed(DB_QUERY_SECONDS)
 async def get_user_data(chat_id):
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute('SELECT current_book_id, current_part, preferred_voice FROM users WHERE chat_id = ?', (chat_id,))
-        row = await cursor.fetchone()
-        if row:
-            logging.info(f"Данные пользователя {chat_id}: book_id={row[0]}, part={row[1]}, voice={row[2]}")
-            return {"current_book_id": row[0], "current_part": row[1], "preferred_voice": row[2]}
-        logging.info(f"Данные пользователя {chat_id} не найдены")
-        return None
+    async with get_pool().read() as db:
+        async with db.execute('SELECT current_book_id, current_part, preferred_voice FROM users WHERE chat_id = ?', (chat_id,)) as cursor:
+            row = await cursor.fetchone()
+    if row:
+        logging.info(f"Данные пользователя {chat_id}: book_id={row[0]}, part={row[1]}, voice={row[2]}")
+        return {"current_book_id": row[0], "current_part": row[1], "preferred_voice": row[2]}
+    logging.info(f"Данные пользователя {chat_id} не найдены")
+    return None
 
-async def update_user_data(chat_id, data):
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute('SELECT 1 FROM users WHERE chat_id = ?', (chat_id,))
-        exists = await cursor.fetchone()
-        if exists:
-            for key, value in data.items():
-                query = f'UPDATE users SET {key} = ? WHERE chat_id = ?'
-                await db.execute(query, (value, chat_id))
-        else:
-            columns = ', '.join(['chat_id'] + list(data.keys()))
-            placeholders = ', '.join('?' * (len(data) + 1))
-            values = (chat_id, *data.values())
-            query = f'INSERT INTO users ({columns}) VALUES ({placeholders})'
-            await db.execute(query, values)
-        await db.commit()
-        logging.info(f"Обновлены данные пользователя {chat_id}: {data}")
+def _user_upsert_query(keys):
+    columns = ', '.join(('chat_id',) + keys)
+    placeholders = ', '.join('?' * (len(keys) + 1))
+    if not keys:
+        return f'INSERT OR IGNORE INTO users ({columns}) VALUES ({placeholders})'
+    assignments = ', '.join(f'{key} = excluded.{key}' for key in keys)
+    return f'INSERT INTO users ({columns}) VALUES ({placeholders}) ON CONFLICT (chat_id) DO UPDATE SET {assignments}'
+
+@timed(DB_QUERY_SECONDS)
+async def update_users_data(updates):
+    """Записывает изменения нескольких пользователей одной транзакцией; updates — {chat_id: data}."""
+    groups = {}
+    for chat_id, data in updates.items():
+        groups.setdefault(tuple(data), []).append((chat_id, *data.values()))
+    async with get_pool().write() as db:
+        for keys, rows in groups.items():
+            await db.executemany(_user_upsert_query(keys), rows)
+    logging.info(f"Сохранены данные пользователей: {len(updates)}")
 
+@timed(DB_QUERY_SECONDS)
 async def get_books_count(user_id):
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute('SELECT COUNT(*) FROM books WHERE user_id = ?', (user_id,))
-        count = (await cursor.fetchone())[0]
-        logging.info(f"Количество книг для user_id {user_id}: {count}")
-        return count
+    async with get_pool().read() as db:
+        async with db.execute('SELECT COUNT(*) FROM books WHERE user_id = ?', (user_id,)) as cursor:
+            count = (await cursor.fetchone())[0]
+    logging.info(f"Количество книг для user_id {user_id}: {count}")
+    return count
 
+@timed(DB_QUERY_SECONDS)
 async def delete_book(book_id, user_id):
-    async with aiosqlite.connect('bot.db') as db:
-        await db.execute('DELETE FROM books WHERE id = ? AND user_id = ?', (book_id, user_id))
-        await db.execute('DELETE FROM parts WHERE book_id = ?', (book_id,))
-        await db.commit()
-        logging.info(f"Удалена книга {book_id} для user_id {user_id}")
\ No newline at end of file
+    """Удаляет книгу из библиотеки; текст удаляется вместе с последней ссылающейся на него книгой."""
+    async with get_pool().write() as db:
+        async with db.execute('SELECT content_id FROM books WHERE id = ? AND user_id = ?', (book_id, user_id)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return
+        await db.execute('DELETE FROM books WHERE id = ?', (book_id,))
+        await _release_content(db, row[0])
+    _manifest_cache.pop(book_id, None)
+    logging.info(f"Удалена книга {book_id} для user_id {user_id}")
+
+@timed(DB_QUERY_SECONDS)
+async def get_formatted_cache(key):
+    async with get_pool().read() as db:
+        async with db.execute('SELECT text FROM formatted_cache WHERE key = ?', (key,)) as cursor:
+            row = await cursor.fetchone()
+    if row:
+        async with get_pool().write() as db:
+            await db.execute('UPDATE formatted_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+    return row[0] if row else None
+
+@timed(DB_QUERY_SECONDS)
+async def put_formatted_cache(key, text, size):
+    """Сохраняет запись в кэш; возвращает False, если ключ уже был в кэше."""
+    async with get_pool().write() as db:
+        cursor = await db.execute('INSERT OR IGNORE INTO formatted_cache (key, text, size, last_used) VALUES (?, ?, ?, ?)', (key, text, size, time.time()))
+        return cursor.rowcount > 0
+
+@timed(DB_QUERY_SECONDS)
+async def get_formatted_cache_size():
+    async with get_pool().read() as db:
+        async with db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM formatted_cache') as cursor:
+            return await cursor.fetchone()
+
+@timed(DB_QUERY_SECONDS)
+async def evict_formatted_cache(bytes_to_free):
+    """Удаляет давно не использованные записи, пока не освободится bytes_to_free байт."""
+    freed, evicted = 0, 0
+    async with get_pool().write() as db:
+        async with db.execute('SELECT key, size FROM formatted_cache ORDER BY last_used') as cursor:
+            keys = []
+            async for key, size in cursor:
+                if freed >= bytes_to_free:
+                    break
+                keys.append((key,))
+                freed += size
+        await db.executemany('DELETE FROM formatted_cache WHERE key = ?', keys)
+        evicted = len(keys)
+    logging.info(f"Из кэша форматирования удалено {evicted} записей, освобождено {freed} байт")
+    return evicted, freed
+
+@timed(DB_QUERY_SECONDS)
+async def get_audio_cache(key):
+    async with get_pool().read() as db:
+        async with db.execute('SELECT path, file_id FROM audio_cache WHERE key = ?', (key,)) as cursor:
+            row = await cursor.fetchone()
+    if row:
+        async with get_pool().write() as db:
+            await db.execute('UPDATE audio_cache SET last_used = ? WHERE key = ?', (time.time(), key))
+        return {"path": row[0], "file_id": row[1]}
+    return None
+
+@timed(DB_QUERY_SECONDS)
+async def put_audio_cache(key, path, size):
+    """Сохраняет запись об аудиофайле; возвращает False, если ключ уже был в кэше."""
+    async with get_pool().write() as db:
+        cursor = await db.execute('INSERT OR IGNORE INTO audio_cache (key, path, size, last_used) VALUES (?, ?, ?, ?)', (key, path, size, time.time()))
+        return cursor.rowcount > 0
+
+@timed(DB_QUERY_SECONDS)
+async def set_audio_file_id(key, file_id):
+    async with get_pool().write() as db:
+        await db.execute('UPDATE audio_cache SET file_id = ? WHERE key = ?', (file_id, key))
+
+@timed(DB_QUERY_SECONDS)
+async def get_audio_cache_size():
+    async with get_pool().read() as db:
+        async with db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_cache') as cursor:
+            return await cursor.fetchone()
+
+@timed(DB_QUERY_SECONDS)
+async def evict_audio_cache(bytes_to_free):
+    """Удаляет давно не использованные записи об аудио; возвращает пути удалённых файлов и число освобождённых байт."""
+    freed = 0
+    async with get_pool().write() as db:
+        async with db.execute('SELECT key, path, size FROM audio_cache ORDER BY last_used') as cursor:
+            evicted = []
+            async for key, path, size in cursor:
+                if freed >= bytes_to_free:
+                    break
+                evicted.append((key, path))
+                freed += size
+        await db.executemany('DELETE FROM audio_cache WHERE key = ?', [(key,) for key, _ in evicted])
+    logging.info(f"Из кэша аудио удалено {len(evicted)} записей, освобождено {freed} байт")
+    return [path for _, path in evicted], freed
+
+@timed(DB_QUERY_SECONDS)
+async def set_user_schedule(chat_id, start_time, end_time, interval, next_run):
+    async with get_pool().write() as db:
+        await db.execute('''INSERT INTO users (chat_id, schedule_start_time, schedule_end_time, schedule_interval, schedule_next_run)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                schedule_start_time = excluded.schedule_start_time,
+                schedule_end_time = excluded.schedule_end_time,
+                schedule_interval = excluded.schedule_interval,
+                schedule_next_run = excluded.schedule_next_run''',
+            (chat_id, start_time, end_time, interval, next_run))
+    logging.info(f"Сохранено расписание пользователя {chat_id}: {start_time}-{end_time} каждые {interval} ч")
+
+@timed(DB_QUERY_SECONDS)
+async def clear_user_schedule(chat_id):
+    """Удаляет расписание; False, если его не было."""
+    async with get_pool().write() as db:
+        cursor = await db.execute('''UPDATE users SET schedule_start_time = NULL, schedule_end_time = NULL,
+            schedule_interval = NULL, schedule_next_run = NULL WHERE chat_id = ? AND schedule_interval IS NOT NULL''', (chat_id,))
+    if cursor.rowcount:
+        logging.info(f"Удалено расписание пользователя {chat_id}")
+    return cursor.rowcount > 0
+
+@timed(DB_QUERY_SECONDS)
+async def get_schedules():
+    async with get_pool().read() as db:
+        async with db.execute('''SELECT chat_id, schedule_start_time, schedule_end_time, schedule_interval, schedule_next_run
+            FROM users WHERE schedule_interval IS NOT NULL''') as cursor:
+            return await cursor.fetchall()
+
+@timed(DB_QUERY_SECONDS)
+async def update_schedule_next_runs(next_runs):
+    """next_runs — список пар (chat_id, schedule_next_run)."""
+    async with get_pool().write() as db:
+        await db.executemany('UPDATE users SET schedule_next_run = ? WHERE chat_id = ?', [(next_run, chat_id) for chat_id, next_run in next_runs])
+
+@timed(DB_QUERY_SECONDS)
+async def get_fsm_record(key):
+    """(state, data в JSON) диалога или None, если записи нет."""
+    async with get_pool().read() as db:
+        async with db.execute('SELECT state, data FROM fsm_states WHERE key = ?', (key,)) as cursor:
+            return await cursor.fetchone()
+
+@timed(DB_QUERY_SECONDS)
+async def set_fsm_state(key, state):
+    async with get_pool().write() as db:
+        await db.execute('''INSERT INTO fsm_states (key, state) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET state = excluded.state''', (key, state))
+        # Пустые записи не храним
+        await db.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND (data IS NULL OR data = '{}')", (key,))
+
+@timed(DB_QUERY_SECONDS)
+async def set_fsm_data(key, data):
+    async with get_pool().write() as db:
+        await db.execute('''INSERT INTO fsm_states (key, data) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET data = excluded.data''', (key, data))
+        await db.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND (data IS NULL OR data = '{}')", (key,))
@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import pdfplumber
+import ebooklib
+from ebooklib import epub
+from docx import Document
+from bs4 import BeautifulSoup
+import chardet
+from metrics import EXTRACTION_SECONDS
+
+# Число процессов для извлечения текста
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', os.cpu_count() or 2))
+# Максимальное время одного задания (в секундах)
+EXTRACTION_TIMEOUT = int(os.getenv('EXTRACTION_TIMEOUT', 300))
+# Ограничение адресного пространства процесса-обработчика (в мегабайтах, 0 — без ограничения)
+EXTRACTION_MEMORY_LIMIT_MB = int(os.getenv('EXTRACTION_MEMORY_LIMIT_MB', 2048))
+# Сколько страниц PDF и документов EPUB обрабатывает одно задание
+PDF_PAGES_PER_JOB = 40
+EPUB_DOCUMENTS_PER_JOB = 20
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.epub', '.txt', '.html', '.docx')
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class TextDecodeError(ExtractionError):
+    pass
+
+
+def _open_source(source):
+    return BytesIO(source) if isinstance(source, bytes) else source
+
+def _read_source(source):
+    if isinstance(source, bytes):
+        return source
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+# Функции извлечения текста из файлов. Выполняются в процессах пула,
+# поэтому принимают байты или путь к файлу и не зависят от состояния бота.
+# iter_* отдают текст по частям (страница, абзац), extract_* собирают его целиком.
+def iter_text_from_pdf(source, start=0, end=None):
+    """Текст страниц [start, end) PDF по одной странице."""
+    pages = list(range(start + 1, end + 1)) if end is not None else None
+    with pdfplumber.open(_open_source(source), pages=pages) as pdf:
+        for page in pdf.pages:
+            yield page.extract_text(layout=True) or ''
+
+def count_pdf_pages(source):
+    with pdfplumber.open(_open_source(source)) as pdf:
+        return len(pdf.pages)
+
+def extract_pdf_pages(source, start, end):
+    return list(iter_text_from_pdf(source, start, end))
+
+def extract_text_from_pdf(source):
+    return '\n\n'.join(iter_text_from_pdf(source)).strip()
+
+def _epub_documents(source):
+    book = epub.read_epub(_open_source(source))
+    return list(book.get_items_of_type(ebooklib.ITEM_DOCUMENT))
+
+def iter_text_from_epub(source, start=0, end=None):
+    """Абзацы документов [start, end) EPUB по одному."""
+    for item in _epub_documents(source)[start:end]:
+        soup = BeautifulSoup(item.get_content(), 'html.parser')
+        for p in soup.find_all(['p', 'div']):
+            paragraph = p.get_text().strip()
+            if paragraph:
+                yield paragraph
+
+def count_epub_documents(source):
+    return len(_epub_documents(source))
+
+def extract_epub_documents(source, start, end):
+    return list(iter_text_from_epub(source, start, end))
+
+def extract_text_from_epub(source):
+    return '\n\n'.join(iter_text_from_epub(source))
+
+def iter_text_from_txt(source, chunk_chars=65536):
+    data = _read_source(source)
+    detected = chardet.detect(data)
+    encoding = detected['encoding'] or 'utf-8'
+    try:
+        text = data.decode(encoding).strip()
+    except UnicodeDecodeError:
+        raise TextDecodeError(f"не удалось декодировать файл с кодировкой {encoding}")
+    for offset in range(0, len(text), chunk_chars):
+        yield text[offset:offset + chunk_chars]
+
+def extract_text_from_txt(source):
+    try:
+        return ''.join(iter_text_from_txt(source))
+    except TextDecodeError as e:
+        logging.error(f"Не удалось прочитать текстовый файл: {e}")
+        return None
+
+def iter_text_from_html(source):
+    soup = BeautifulSoup(_read_source(source), 'html.parser')
+    for p in soup.find_all(['p', 'div', 'article']):
+        paragraph = p.get_text().strip()
+        if paragraph:
+            yield paragraph
+
+def extract_text_from_html(source):
+    return '\n\n'.join(iter_text_from_html(source))
+
+def iter_text_from_docx(source):
+    doc = Document(_open_source(source))
+    for para in doc.paragraphs:
+        if para.text.strip():
+            yield para.text
+
+def extract_text_from_docx(source):
+    return '\n\n'.join(iter_text_from_docx(source)).strip()
+
+def extract_chunks(extension, source):
+    """Все фрагменты текста файла списком; выполняется в процессе пула."""
+    chunks = list(CHUNK_ITERATORS[extension](source))
+    if extension == '.txt':
+        # Текст уже разрезан по длине, а не по абзацам
+        return chunks
+    return [chunk + '\n\n' for chunk in chunks]
+
+EXTRACTORS = {
+    '.pdf': extract_text_from_pdf,
+    '.epub': extract_text_from_epub,
+    '.txt': extract_text_from_txt,
+    '.html': extract_text_from_html,
+    '.docx': extract_text_from_docx,
+}
+
+CHUNK_ITERATORS = {
+    '.pdf': iter_text_from_pdf,
+    '.epub': iter_text_from_epub,
+    '.txt': iter_text_from_txt,
+    '.html': iter_text_from_html,
+    '.docx': iter_text_from_docx,
+}
+
+# Форматы, которые можно разбирать параллельно по диапазонам:
+# (число единиц, извлечение диапазона, единиц на задание)
+RANGE_EXTRACTORS = {
+    '.pdf': (count_pdf_pages, extract_pdf_pages, PDF_PAGES_PER_JOB),
+    '.epub': (count_epub_documents, extract_epub_documents, EPUB_DOCUMENTS_PER_JOB),
+}
+
+
+def get_extension(file_name):
+    for extension in SUPPORTED_EXTENSIONS:
+        if file_name.lower().endswith(extension):
+            return extension
+    return None
+
+
+def _limit_memory(limit_mb):
+    if not limit_mb:
+        return
+    try:
+        import resource
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError) as e:
+        logging.warning(f"Не удалось ограничить память процесса извлечения: {e}")
+
+
+class ExtractionExecutor:
+    """Пул процессов для извлечения текста из загруженных файлов.
+
+    Разбор документов занимает процессор надолго, поэтому выполняется вне
+    цикла событий бота. Большие PDF и EPUB разбиваются на диапазоны страниц
+    или документов, которые обрабатываются параллельно и отдаются по порядку.
+    """
+
+    def __init__(self, workers=EXTRACTION_WORKERS, timeout=EXTRACTION_TIMEOUT, memory_limit_mb=EXTRACTION_MEMORY_LIMIT_MB):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self._pool = None
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_limit_memory,
+                initargs=(self.memory_limit_mb,),
+            )
+            logging.info(f"Запущен пул извлечения текста: {self.workers} процессов")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def _restart(self, pool):
+        # Зависший процесс нельзя прервать через Future, поэтому пул пересоздаётся.
+        # Пул, который уже заменило другое задание, не трогаем. Задания,
+        # выполнявшиеся в старом пуле, получат BrokenProcessPool и повторятся в новом.
+        if self._pool is not pool:
+            return
+        self._pool = None
+        for process in list(getattr(pool, '_processes', {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+        self.start()
+
+    async def run(self, func, *args, extension=None):
+        """Выполняет func(*args) в пуле; время задания учитывается в метриках по имени func и extension.
+
+        Если пул перезапустили из-за другого задания (тайм-аут или падение
+        процесса), задание один раз повторяется в новом пуле.
+        """
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            for attempt in range(2):
+                self.start()
+                pool = self._pool
+                try:
+                    result = await asyncio.wait_for(loop.run_in_executor(pool, func, *args), self.timeout)
+                    status = 'ok'
+                    return result
+                except asyncio.TimeoutError:
+                    logging.error(f"Извлечение текста {func.__name__} не уложилось в {self.timeout} сек")
+                    self._restart(pool)
+                    raise ExtractionError("превышено время обработки")
+                except MemoryError:
+                    raise ExtractionError("превышен лимит памяти")
+                except BrokenProcessPool:
+                    if self._pool is pool or attempt:
+                        self._restart(pool)
+                        raise ExtractionError("процесс обработки аварийно завершился")
+                    logging.warning(f"Пул извлечения перезапущен из-за другого задания, повторяем {func.__name__}")
+        finally:
+            EXTRACTION_SECONDS.observe(time.perf_counter() - started, extractor=func.__name__, extension=extension or '', status=status)
+
+    async def stream(self, file_name, data):
+        """Асинхронно отдаёт текст файла в исходном порядке, одним куском на задание пула.
+
+        Форматы из RANGE_EXTRACTORS (PDF, EPUB) разбираются параллельно по
+        диапазонам, но в обработке одновременно не больше workers диапазонов,
+        поэтому память не растёт с размером книги. Остальные форматы
+        извлекаются одним заданием целиком и отдаются одним куском.
+        """
+        extension = get_extension(file_name)
+        if extension is None:
+            raise ExtractionError(f"неподдерживаемый формат файла: {file_name}")
+        with tempfile.NamedTemporaryFile(suffix=extension) as f:
+            f.write(data)
+            f.flush()
+            if extension not in RANGE_EXTRACTORS:
+                yield ''.join(await self.run(extract_chunks, extension, f.name, extension=extension))
+                return
+            count_units, extract_range, units_per_job = RANGE_EXTRACTORS[extension]
+            total_units = await self.run(count_units, f.name, extension=extension)
+            ranges = iter([(start, min(start + units_per_job, total_units)) for start in range(0, total_units, units_per_job)])
+            logging.info(f"Файл {file_name}: {total_units} единиц, по {units_per_job} на задание")
+            pending = deque()
+            try:
+                for start, end in islice(ranges, self.workers):
+                    pending.append(asyncio.ensure_future(self.run(extract_range, f.name, start, end, extension=extension)))
+                while pending:
+                    chunks = await pending.popleft()
+                    next_range = next(ranges, None)
+                    if next_range is not None:
+                        pending.append(asyncio.ensure_future(self.run(extract_range, f.name, *next_range, extension=extension)))
+                    yield ''.join(chunk + '\n\n' for chunk in chunks)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+extraction_executor = ExtractionExecutor()
@@ -0,0 +1,34 @@
+import json
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from database import get_fsm_record, set_fsm_state, set_fsm_data
+
+
+def _record_key(key):
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.business_connection_id}:{key.destiny}"
+
+
+class DatabaseStorage(BaseStorage):
+    """Хранилище состояний диалогов (FSM) в bot.db.
+
+    В режиме вебхука обновления одного пользователя могут обрабатываться
+    разными процессами, поэтому шаги диалога (например, настройка
+    расписания) хранятся в общей базе, а не в памяти процесса.
+    """
+
+    async def set_state(self, key, state=None):
+        await set_fsm_state(_record_key(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        record = await get_fsm_record(_record_key(key))
+        return record[0] if record else None
+
+    async def set_data(self, key, data):
+        await set_fsm_data(_record_key(key), json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key):
+        record = await get_fsm_record(_record_key(key))
+        return json.loads(record[1]) if record and record[1] else {}
+
+    async def close(self):
+        pass
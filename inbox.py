@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+# Сколько обновлений обрабатывается одновременно
+UPDATE_WORKERS = 16
+# Сколько принятых обновлений может ждать обработки; сверх этого вебхук
+# отвечает ошибкой, и Telegram повторит доставку позже
+MAX_PENDING_UPDATES = 1000
+# Сколько ждать обработки принятых обновлений при остановке (в секундах)
+DRAIN_TIMEOUT = 30
+
+
+def update_chat_key(update):
+    """Чат, к которому относится обновление; обновления без чата обрабатываются независимо."""
+    try:
+        event = update.event
+    except Exception:
+        return ('update', update.update_id)
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    if user is not None:
+        return user.id
+    return ('update', update.update_id)
+
+
+class UpdateQueue:
+    """Очередь входящих обновлений Telegram для режима вебхука.
+
+    Обновления обрабатываются пулом из workers задач, но обновления одного
+    чата — строго по очереди: у каждого чата своя очередь, и в общей очереди
+    готовых чатов он стоит не больше одного раза. После каждого обновления
+    чат встаёт в конец общей очереди, поэтому активный чат не занимает
+    обработчик надолго. Порядок соблюдается внутри одного процесса; при
+    нескольких процессах за балансировщиком обновления одного чата могут
+    попасть в разные процессы.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=MAX_PENDING_UPDATES):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._handler = None
+        self._ready = asyncio.Queue()
+        self._chats = {}
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._accepting = False
+        self._workers = []
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self, handler):
+        """handler(update) — корутина, обрабатывающая одно обновление."""
+        self._handler = handler
+        self._accepting = True
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=DRAIN_TIMEOUT):
+        """Перестаёт принимать обновления и дожидается обработки принятых (не дольше timeout секунд)."""
+        self._accepting = False
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не обработано обновлений при остановке: {self._pending}")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, update):
+        """Ставит обновление в очередь; False, если очередь переполнена или закрыта."""
+        if not self._accepting or self._pending >= self.max_pending:
+            self.rejected += 1
+            return False
+        key = update_chat_key(update)
+        self._pending += 1
+        self._idle.clear()
+        queue = self._chats.get(key)
+        if queue is None:
+            self._chats[key] = deque([(update, time.monotonic())])
+            self._ready.put_nowait(key)
+        else:
+            # Чат уже в общей очереди или обрабатывается
+            queue.append((update, time.monotonic()))
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            update, _ = queue[0]
+            try:
+                await self._handler(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                queue.popleft()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.set()
+
+    def stats(self):
+        oldest = min((queue[0][1] for queue in self._chats.values()), default=None)
+        return {
+            "pending": self._pending,
+            "chats": len(self._chats),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "oldest_wait": time.monotonic() - oldest if oldest is not None else 0.0,
+        }
+
+
+update_queue = UpdateQueue()
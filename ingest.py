@@ -0,0 +1,80 @@
+import hashlib
+import logging
+import time
+from database import create_book, add_parts, set_book_status, delete_book, find_book_content, add_book_from_content, set_book_content_hash, BOOK_READY
+from utils import PartSplitter
+
+# Сколько частей записывать в базу одной транзакцией
+INGEST_BATCH_SIZE = 50
+
+
+class EmptyBookError(Exception):
+    pass
+
+
+def file_content_hash(data):
+    """Хэш содержимого загруженного файла для поиска уже загруженных книг."""
+    digest = hashlib.sha256(b'file\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+async def add_known_book(user_id, title, content_hash):
+    """Добавляет книгу без извлечения и разбиения, если такой текст уже загружен.
+
+    Части не копируются: новая книга ссылается на то же содержимое.
+    Возвращает book_id или None, если текст с таким хэшем ещё не загружали.
+    """
+    if content_hash is None:
+        return None
+    content_id = await find_book_content(content_hash)
+    if content_id is None:
+        return None
+    return await add_book_from_content(user_id, title, content_id)
+
+
+async def import_book(user_id, title, chunks, on_first_parts=None, content_hash=None):
+    """Потоково разрезает текст на части и записывает их в базу по мере готовности.
+
+    chunks — асинхронный итератор кусков текста (см. ExtractionExecutor.stream).
+    Книга создаётся со статусом «загружается». Первая часть записывается
+    сразу, остальные — пачками по INGEST_BATCH_SIZE. Если после первой
+    записи приходит ещё кусок текста, вызывается on_first_parts(book_id),
+    и книгу уже можно читать. Несколько кусков приходят только для PDF и
+    EPUB, которые извлекаются по диапазонам страниц; только для них и
+    память ограничена, а TXT, DOCX и HTML извлекаются целиком одним
+    куском, и для них on_first_parts не вызывается. При ошибке книга
+    удаляется целиком.
+    content_hash сохраняется для add_known_book после успешной загрузки.
+    Возвращает (book_id, число частей).
+    """
+    started = time.perf_counter()
+    book_id = await create_book(user_id, title)
+    splitter = PartSplitter()
+    batch = []
+    written = 0
+    notified = False
+    try:
+        async for chunk in chunks:
+            if written and not notified and on_first_parts is not None:
+                notified = True
+                await on_first_parts(book_id)
+            batch.extend(splitter.feed(chunk))
+            if batch and (written == 0 or len(batch) >= INGEST_BATCH_SIZE):
+                written += await add_parts(book_id, written + 1, batch)
+                batch = []
+        batch.extend(splitter.finish())
+        if batch:
+            written += await add_parts(book_id, written + 1, batch)
+        if written == 0:
+            raise EmptyBookError("в файле не найден текст")
+        if content_hash:
+            await set_book_content_hash(book_id, content_hash)
+        await set_book_status(book_id, BOOK_READY)
+    except BaseException:
+        await delete_book(book_id, user_id)
+        raise
+    elapsed = time.perf_counter() - started
+    rate = written / elapsed if elapsed > 0 else float('inf')
+    logging.info(f"Книга {title} загружена: book_id {book_id}, частей: {written} за {elapsed:.3f} с ({rate:.0f} частей/с)")
+    return book_id, written
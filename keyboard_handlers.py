@@ -2,12 +2,14 @@ from aiogram import types, Dispatcher
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 import logging
-from database import get_user_data, get_part_text, get_total_parts, update_user_data
-from ai_utils import format_text_with_ai, generate_audio
-from utils import get_main_keyboard, get_manage_upload_keyboard
+from database import get_part_text, get_book_manifest, BOOK_IMPORTING
+from ai_utils import format_text_with_ai, send_audio_cached
+from utils import get_main_keyboard, get_manage_upload_keyboard, part_label
 from states import ScheduleForm
+from prefetch import prefetcher
+from outbox import send_queue
+from sessions import sessions
 import io
-from aiogram.types import BufferedInputFile
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -18,29 +20,34 @@ def register_keyboard_handlers(dp: Dispatcher, bot):
     async def cmd_next_part(message: types.Message):
         """Обработчик кнопки 'Вперед' для перехода к следующему фрагменту книги."""
         chat_id = message.chat.id
-        user_data = await get_user_data(chat_id)
+        user_data = await sessions.get(chat_id)
         logging.info(f"User data for {chat_id}: {user_data}")
         if user_data and user_data.get('current_book_id'):
             book_id, current_part = user_data['current_book_id'], user_data['current_part']
-            total_parts = await get_total_parts(book_id)
+            manifest = await get_book_manifest(book_id)
+            total_parts = manifest["total_parts"] if manifest else 0
+            importing = bool(manifest) and manifest["status"] == BOOK_IMPORTING
             logging.info(f"Книга {book_id}, текущая часть {current_part}/{total_parts}")
             text = await get_part_text(book_id, current_part)
             if text:
                 formatted_text = await format_text_with_ai(text, chat_id, bot)
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text=f"Фрагмент {current_part} из {total_parts}", callback_data="dummy")],
+                    [InlineKeyboardButton(text=part_label(current_part, total_parts, importing), callback_data="dummy")],
                     [InlineKeyboardButton(text="Озвучить текст", callback_data=f"voice_{book_id}_{current_part}")]
                 ])
                 try:
-                    await bot.send_message(chat_id, formatted_text, reply_markup=keyboard, parse_mode='HTML')
+                    await send_queue.send(bot.send_message, chat_id, formatted_text, reply_markup=keyboard, parse_mode='HTML')
                     logging.info(f"Пользователь {chat_id} просмотрел фрагмент {current_part}")
                 except Exception as e:
                     logging.error(f"Ошибка при отправке сообщения: {e}")
-                    await bot.send_message(chat_id, text, reply_markup=keyboard)
-                if await get_part_text(book_id, current_part + 1):
-                    await update_user_data(chat_id, {"current_part": current_part + 1})
+                    await send_queue.send(bot.send_message, chat_id, text, reply_markup=keyboard)
+                prefetcher.on_part_served(chat_id, book_id, current_part, total_parts, user_data.get('preferred_voice'))
+                if importing or current_part < total_parts:
+                    await sessions.update(chat_id, {"current_part": current_part + 1})
                 else:
                     await message.answer(f"Это последний фрагмент книги (всего {total_parts}). Выберите другую книгу с помощью /selectbook.", reply_markup=get_main_keyboard())
+            elif importing:
+                await message.answer("Этот фрагмент ещё загружается, попробуйте через несколько секунд.", reply_markup=get_main_keyboard())
             else:
                 await message.answer("Нет текущего фрагмента для чтения.", reply_markup=get_main_keyboard())
         else:
@@ -50,28 +57,31 @@ def register_keyboard_handlers(dp: Dispatcher, bot):
     async def cmd_prev_part(message: types.Message):
         """Обработчик кнопки 'Назад' для перехода к предыдущему фрагменту книги."""
         chat_id = message.chat.id
-        user_data = await get_user_data(chat_id)
+        user_data = await sessions.get(chat_id)
         logging.info(f"Нажата кнопка 'Назад' для {chat_id}, user_data: {user_data}")
         if user_data and user_data.get('current_book_id'):
             book_id, current_part = user_data['current_book_id'], user_data['current_part']
             prev_part = current_part - 1
-            total_parts = await get_total_parts(book_id)
+            manifest = await get_book_manifest(book_id)
+            total_parts = manifest["total_parts"] if manifest else 0
+            importing = bool(manifest) and manifest["status"] == BOOK_IMPORTING
             logging.info(f"Книга {book_id}, текущая часть {current_part}/{total_parts}")
             if prev_part >= 1:
                 text = await get_part_text(book_id, prev_part)
                 if text:
-                    await update_user_data(chat_id, {"current_part": prev_part})
+                    await sessions.update(chat_id, {"current_part": prev_part})
                     formatted_text = await format_text_with_ai(text, chat_id, bot)
                     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text=f"Фрагмент {prev_part} из {total_parts}", callback_data="dummy")],
+                        [InlineKeyboardButton(text=part_label(prev_part, total_parts, importing), callback_data="dummy")],
                         [InlineKeyboardButton(text="Озвучить текст", callback_data=f"voice_{book_id}_{prev_part}")]
                     ])
                     try:
-                        await bot.send_message(chat_id, formatted_text, reply_markup=keyboard, parse_mode='HTML')
+                        await send_queue.send(bot.send_message, chat_id, formatted_text, reply_markup=keyboard, parse_mode='HTML')
                         logging.info(f"Пользователь {chat_id} перешел к предыдущему фрагменту {prev_part}")
                     except Exception as e:
                         logging.error(f"Ошибка при отправке сообщения: {e}")
-                        await bot.send_message(chat_id, text, reply_markup=keyboard)
+                        await send_queue.send(bot.send_message, chat_id, text, reply_markup=keyboard)
+                    prefetcher.on_part_served(chat_id, book_id, prev_part, total_parts, user_data.get('preferred_voice'))
                 else:
                     await message.answer("Это первый фрагмент книги.", reply_markup=get_main_keyboard())
             else:
@@ -129,20 +139,16 @@ def register_keyboard_handlers(dp: Dispatcher, bot):
     @dp.callback_query(lambda c: c.data.startswith('voice_'))
     async def voice_text_callback(callback_query: types.CallbackQuery):
         """Обработчик кнопки 'Озвучить текст' для генерации и отправки аудио."""
-        from database import get_part_text, get_user_data
+        from database import get_part_text
         _, book_id, part_number = callback_query.data.split('_')
         book_id = int(book_id)
         part_number = int(part_number)
         chat_id = callback_query.from_user.id
-        user_data = await get_user_data(chat_id)
+        user_data = await sessions.get(chat_id)
         voice = user_data.get('preferred_voice') or "Alloy" if user_data else "Alloy"
         text = await get_part_text(book_id, part_number)
         if text:
-            audio_bytes = await generate_audio(text, voice, chat_id=chat_id, bot=bot)
-            if audio_bytes:
-                audio_file = BufferedInputFile(audio_bytes, filename="audio.mp3")
-                await bot.send_audio(chat_id, audio_file)
-            else:
+            if not await send_audio_cached(bot, chat_id, text, voice):
                 await bot.send_message(chat_id, "Не удалось сгенерировать аудио.")
         else:
             await bot.send_message(chat_id, "Текст не найден.")
@@ -0,0 +1,188 @@
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+# Границы корзин гистограмм задержки (в секундах)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Gauge:
+    """Значение, которое вычисляется только при запросе /metrics.
+
+    callback возвращает число или, если заданы labelnames, словарь
+    {кортеж значений меток: число}.
+    """
+
+    def __init__(self, name, help, callback, labelnames=()):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        values = self.callback()
+        if not self.labelnames:
+            values = {(): values}
+        for key, value in values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма задержек с метками.
+
+    observe() только увеличивает счётчик одной корзины, накопительные суммы
+    для формата Prometheus считаются при выдаче /metrics.
+    """
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            # [счётчики корзин (последняя — +Inf), сумма, количество]
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+def timed(histogram, **labels):
+    """Декоратор: время выполнения функции попадает в histogram.
+
+    Метка status принимает значения ok или error, остальные метки берутся
+    из labels, а не заданные — из имени функции.
+    """
+    def decorator(func):
+        values = {name: labels.get(name, func.__name__) for name in histogram.labelnames if name != 'status'}
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                status = 'error'
+                try:
+                    result = await func(*args, **kwargs)
+                    status = 'ok'
+                    return result
+                finally:
+                    histogram.observe(time.perf_counter() - started, status=status, **values)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                status = 'error'
+                try:
+                    result = func(*args, **kwargs)
+                    status = 'ok'
+                    return result
+                finally:
+                    histogram.observe(time.perf_counter() - started, status=status, **values)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Время вызовов database.py', ('query', 'status'))
+EXTRACTION_SECONDS = Histogram('extraction_seconds', 'Время заданий извлечения текста', ('extractor', 'extension', 'status'))
+TEXT_SPLIT_SECONDS = Histogram('text_split_seconds', 'Время разбиения текста на части', ('function', 'status'))
+AI_REQUEST_SECONDS = Histogram('ai_request_seconds', 'Время форматирования и озвучки текста', ('operation', 'status'))
+TELEGRAM_SEND_SECONDS = Histogram('telegram_send_seconds', 'Время вызовов Bot API', ('method', 'status'))
+HANDLER_SECONDS = Histogram('handler_seconds', 'Время обработчиков aiogram', ('handler', 'status'))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware aiogram: время каждого обработчика по его имени."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            result = await handler(event, data)
+            status = 'ok'
+            return result
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name, status=status)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого вызова Bot API, в том числе мимо очереди отправки."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            result = await make_request(bot, method)
+            status = 'ok'
+            return result
+        except TelegramRetryAfter:
+            status = 'retry_after'
+            raise
+        finally:
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, method=method.__api_method__, status=status)
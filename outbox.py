@@ -0,0 +1,248 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from collections import deque
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+# Приоритеты: ответы на действия пользователя отправляются раньше рассылки по расписанию
+INTERACTIVE = 0
+BULK = 1
+
+# Общий лимит Telegram на отправку сообщений в секунду
+GLOBAL_RATE = 30
+# Методы Bot API, на которые распространяется общий лимит
+RATE_LIMITED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+RATE_UNLIMITED_METHODS = {'sendChatAction'}
+# Минимальный промежуток между сообщениями в один чат (в секундах)
+CHAT_INTERVAL = 1.0
+# Сколько раз повторять отправку после ответа 429
+MAX_SEND_RETRIES = 5
+SEND_WORKERS = 8
+# Сколько последних задержек хранить для перцентилей
+LATENCY_WINDOW = 1000
+
+# Установлен в обработчиках SendQueue: повторы после 429 делает сама очередь
+_in_send_queue = contextvars.ContextVar('in_send_queue', default=False)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SendQueueClosedError(Exception):
+    """Очередь отправки остановлена, сообщение не отправлено."""
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: общий лимит на все отправки, а не только через SendQueue.
+
+    Ответы через message.answer, отправка аудио и правка статусных сообщений
+    идут мимо очереди, но тоже ждут токен общего bucket. После 429 такие
+    вызовы повторяются через retry_after (до MAX_SEND_RETRIES раз); вызовы
+    из SendQueue ошибку получают сразу, их откладывает сама очередь.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        limited = name.startswith(RATE_LIMITED_PREFIXES) and name not in RATE_UNLIMITED_METHODS
+        attempts = 0
+        while True:
+            if limited:
+                await self.bucket.acquire()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempts += 1
+                if _in_send_queue.get() or attempts > MAX_SEND_RETRIES:
+                    raise
+                logging.warning(f"Telegram просит подождать {e.retry_after} сек перед повтором {name}")
+                await asyncio.sleep(e.retry_after)
+
+
+class _Job:
+    __slots__ = ('method', 'chat_id', 'args', 'kwargs', 'priority', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, method, chat_id, args, kwargs, priority, future):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class SendQueue:
+    """Очередь исходящих сообщений Telegram с ограничением скорости.
+
+    Соблюдает общий лимит GLOBAL_RATE сообщений в секунду (token bucket)
+    и не чаще одного сообщения в CHAT_INTERVAL секунд в каждый чат. После
+    429 сообщение отправляется повторно через retry_after. Интерактивные
+    ответы обгоняют массовую рассылку по расписанию. Общий лимит
+    применяется в сессии бота (см. middleware()), поэтому его соблюдают и
+    вызовы мимо очереди.
+    """
+
+    def __init__(self, rate=GLOBAL_RATE, chat_interval=CHAT_INTERVAL, workers=SEND_WORKERS):
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self._queue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._chat_ready_at = {}
+        self._workers = []
+        # Отложенные сообщения (интервал чата или retry_after): задание -> таймер
+        self._delayed = {}
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def middleware(self):
+        """Middleware для bot.session, применяющий общий лимит ко всем отправкам бота."""
+        return RateLimitMiddleware(self.bucket)
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._queue.join()
+            if not self._delayed:
+                return
+            # Ждём ближайшее отложенное сообщение: оно вернётся в очередь
+            next_at = min(handle.when() for handle in self._delayed.values())
+            await asyncio.sleep(max(0, next_at - loop.time()))
+
+    async def stop(self, timeout=10):
+        """Дожидается отправки очереди и отложенных сообщений (не дольше timeout секунд).
+
+        Что не успело отправиться, завершается с SendQueueClosedError, чтобы
+        вызвавшие send() не ждали вечно.
+        """
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не отправлено сообщений при остановке: в очереди {self._queue.qsize()}, отложено {len(self._delayed)}")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        jobs = list(self._delayed)
+        for handle in self._delayed.values():
+            handle.cancel()
+        self._delayed.clear()
+        while not self._queue.empty():
+            jobs.append(self._queue.get_nowait()[2])
+            self._queue.task_done()
+        for job in jobs:
+            if not job.future.done():
+                self.failed += 1
+                job.future.set_exception(SendQueueClosedError("очередь отправки остановлена"))
+
+    async def send(self, method, chat_id, *args, priority=INTERACTIVE, **kwargs):
+        """Ставит вызов method(chat_id, *args, **kwargs) в очередь и возвращает его результат."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._put(_Job(method, chat_id, args, kwargs, priority, future))
+        return await future
+
+    def _put(self, job):
+        self._queue.put_nowait((job.priority, next(self._sequence), job))
+
+    def _put_later(self, job, delay):
+        def put():
+            del self._delayed[job]
+            self._put(job)
+        self._delayed[job] = asyncio.get_running_loop().call_later(delay, put)
+
+    async def _worker(self):
+        _in_send_queue.set(True)
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._process(job)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job):
+        if job.future.done():
+            return
+        wait = self._chat_ready_at.get(job.chat_id, 0) - time.monotonic()
+        if wait > 0:
+            # Чат ещё «остывает»: откладываем сообщение, не занимая обработчик
+            self._put_later(job, wait)
+            return
+        # Чат занимается до ожидания общего лимита в сессии бота, чтобы другой
+        # обработчик не отправил в него сообщение одновременно с этим
+        self._chat_ready_at[job.chat_id] = time.monotonic() + self.chat_interval
+        try:
+            result = await job.method(job.chat_id, *job.args, **job.kwargs)
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts > MAX_SEND_RETRIES:
+                self.failed += 1
+                job.future.set_exception(e)
+                return
+            self.retried += 1
+            self._chat_ready_at[job.chat_id] = time.monotonic() + e.retry_after
+            logging.warning(f"Telegram просит подождать {e.retry_after} сек перед отправкой в чат {job.chat_id}")
+            self._put_later(job, e.retry_after)
+            return
+        except Exception as e:
+            self.failed += 1
+            job.future.set_exception(e)
+            return
+        self.sent += 1
+        self._latencies.append(time.monotonic() - job.enqueued_at)
+        job.future.set_result(result)
+        if len(self._chat_ready_at) > 100_000:
+            now = time.monotonic()
+            self._chat_ready_at = {chat_id: ready_at for chat_id, ready_at in self._chat_ready_at.items() if ready_at > now}
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+        return {
+            "queue_depth": self._queue.qsize(),
+            "delayed": len(self._delayed),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+
+send_queue = SendQueue()
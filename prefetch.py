@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from database import get_part_text
+from ai_utils import warm_formatting, warm_audio
+
+# Сколько предзагрузок может выполняться одновременно
+PREFETCH_CONCURRENCY = 4
+# Предзагружать ли озвучку для пользователей с выбранным голосом
+PREFETCH_AUDIO = True
+
+
+class Prefetcher:
+    """Заранее готовит форматирование (и озвучку) следующего фрагмента книги.
+
+    На каждого пользователя приходится не больше одной задачи предзагрузки.
+    Новая задача или смена книги отменяют предыдущую. Уже отправленный в API
+    запрос при отмене доводится до конца, чтобы его результат попал в кэш.
+    """
+
+    def __init__(self, concurrency=PREFETCH_CONCURRENCY, prefetch_audio=PREFETCH_AUDIO):
+        self.prefetch_audio = prefetch_audio
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = {}
+        self._targets = {}
+        self._prefetched = {}
+        self.hits = 0
+        self.misses = 0
+
+    def on_part_served(self, chat_id, book_id, part_number, total_parts, voice=None):
+        """Вызывается после отправки фрагмента: учитывает попадание и ставит в очередь следующий."""
+        # Попадание: фрагмент уже подготовлен или его подготовка ещё идёт
+        running = chat_id in self._tasks and self._targets.get(chat_id) == (book_id, part_number)
+        if self._prefetched.get(chat_id) == (book_id, part_number) or running:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.cancel(chat_id)
+        next_part = part_number + 1
+        if total_parts and next_part > total_parts:
+            return
+        task = asyncio.create_task(self._prefetch(chat_id, book_id, next_part, voice if self.prefetch_audio else None))
+        self._tasks[chat_id] = task
+        self._targets[chat_id] = (book_id, next_part)
+        task.add_done_callback(lambda t: self._tasks.pop(chat_id, None) if self._tasks.get(chat_id) is t else None)
+
+    def cancel(self, chat_id):
+        """Отменяет предзагрузку пользователя, например при смене книги."""
+        task = self._tasks.pop(chat_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+        self._targets.pop(chat_id, None)
+        self._prefetched.pop(chat_id, None)
+
+    async def _prefetch(self, chat_id, book_id, part_number, voice):
+        try:
+            async with self._semaphore:
+                text = await get_part_text(book_id, part_number)
+                if not text:
+                    return
+                await warm_formatting(text)
+                if voice:
+                    await warm_audio(text, voice)
+            self._prefetched[chat_id] = (book_id, part_number)
+            logging.info(f"Предзагружен фрагмент {part_number} книги {book_id} для {chat_id}")
+        except asyncio.CancelledError:
+            logging.info(f"Предзагрузка фрагмента {part_number} книги {book_id} для {chat_id} отменена")
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка предзагрузки фрагмента {part_number} книги {book_id} для {chat_id}: {e}")
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "in_flight": len(self._tasks),
+        }
+
+
+prefetcher = Prefetcher()
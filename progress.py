@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from aiogram.exceptions import TelegramBadRequest
+
+# Как часто обновлять статусное сообщение (в секундах)
+PROGRESS_UPDATE_INTERVAL = 5
+
+
+class ProgressMessage:
+    """Статусное сообщение на время долгой операции.
+
+    Сообщение отправляется при входе в блок и раз в interval секунд
+    дополняется временем ожидания. При выходе из блока оно удаляется
+    сразу же, либо заменяется на final_text, если он задан через finish().
+    Без bot или chat_id ничего не отправляет, поэтому годится и для
+    фоновых задач::
+
+        async with ProgressMessage(bot, chat_id, "Готовим аудио") as progress:
+            audio = await request()
+    """
+
+    def __init__(self, bot, chat_id, text, interval=PROGRESS_UPDATE_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.interval = interval
+        self.final_text = None
+        self._message = None
+        self._updater = None
+        self._started = None
+
+    @property
+    def enabled(self):
+        return self.bot is not None and self.chat_id is not None
+
+    async def __aenter__(self):
+        self._started = time.monotonic()
+        if not self.enabled:
+            return self
+        try:
+            self._message = await self.bot.send_message(self.chat_id, f"{self.text}...")
+        except Exception as e:
+            logging.error(f"Не удалось отправить статусное сообщение: {e}")
+            return self
+        self._updater = asyncio.create_task(self._update_loop())
+        return self
+
+    async def _update_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            elapsed = int(time.monotonic() - self._started)
+            try:
+                await self.bot.edit_message_text(
+                    text=f"{self.text}... (прошло {elapsed} сек)",
+                    chat_id=self.chat_id,
+                    message_id=self._message.message_id
+                )
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logging.error(f"Ошибка редактирования статусного сообщения: {e}")
+                    return
+            except Exception as e:
+                logging.error(f"Ошибка редактирования статусного сообщения: {e}")
+                return
+
+    def finish(self, final_text):
+        """Заменить статус на final_text вместо удаления при выходе из блока."""
+        self.final_text = final_text
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._updater is not None:
+            self._updater.cancel()
+            try:
+                await self._updater
+            except asyncio.CancelledError:
+                pass
+        if self._message is None:
+            return False
+        try:
+            if self.final_text:
+                await self.bot.edit_message_text(text=self.final_text, chat_id=self.chat_id, message_id=self._message.message_id)
+            else:
+                await self.bot.delete_message(self.chat_id, self._message.message_id)
+        except Exception as e:
+            logging.warning(f"Не удалось убрать статусное сообщение: {e}")
+        logging.info(f"{self.text}: заняло {time.monotonic() - self._started:.1f} сек")
+        return False
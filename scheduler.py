@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from database import set_user_schedule, clear_user_schedule, get_schedules, update_schedule_next_runs
+
+# Сколько отправок по расписанию может выполняться одновременно
+DELIVERY_CONCURRENCY = 50
+# Пропущенная за время простоя отправка догоняется, только если она не старше этого (в секундах)
+CATCH_UP_WINDOW = 12 * 3600
+# Как часто перечитывать расписания из базы, если их меняют другие процессы бота (в секундах)
+SCHEDULE_RELOAD_INTERVAL = 30
+
+
+def _window_bounds(day, start_time, end_time):
+    start_h, start_m = map(int, start_time.split(':'))
+    end_h, end_m = map(int, end_time.split(':'))
+    window_start = day.replace(hour=start_h, minute=start_m, second=0, microsecond=0)
+    window_end = day.replace(hour=end_h, minute=end_m, second=0, microsecond=0)
+    if window_end < window_start:
+        window_end += timedelta(days=1)
+    return window_start, window_end
+
+
+def next_delivery(start_time, end_time, after):
+    """Ближайший момент не раньше after, когда можно отправлять фрагмент.
+
+    Если after попадает в окно отправки (в том числе начавшееся накануне
+    и переходящее через полночь), возвращается сам after, иначе — начало
+    следующего окна.
+    """
+    for days in (-1, 0, 1):
+        window_start, window_end = _window_bounds(after + timedelta(days=days), start_time, end_time)
+        if window_start <= after <= window_end:
+            return after
+        if after < window_start:
+            return window_start
+    window_start, _ = _window_bounds(after + timedelta(days=2), start_time, end_time)
+    return window_start
+
+
+class DeliveryScheduler:
+    """Отправка фрагментов по расписанию одним циклом на всех пользователей.
+
+    Расписания хранятся в таблице users и загружаются при запуске. Время
+    следующей отправки каждого пользователя лежит в куче, и цикл спит до
+    ближайшего из них. Замена или отмена расписания увеличивает поколение
+    записи пользователя, а устаревшие элементы кучи пропускаются.
+
+    Если бот запущен несколькими процессами, отправляет по расписанию только
+    один из них, а расписания, заданные в других процессах, он подхватывает,
+    перечитывая базу раз в reload_interval секунд.
+    """
+
+    def __init__(self, callback, concurrency=DELIVERY_CONCURRENCY):
+        self.callback = callback
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._schedules = {}
+        self._heap = []
+        self._generation = 0
+        self._wakeup = asyncio.Event()
+        self._loop_task = None
+        self._reload_task = None
+        # Изменение расписания в этом процессе не должно попасть между чтением базы и применением в reload()
+        self._change_lock = asyncio.Lock()
+        self._deliveries = set()
+        self.delivered = 0
+
+    @staticmethod
+    def _first_run(start_time, end_time, next_run, now):
+        if next_run is None or now - next_run > CATCH_UP_WINDOW:
+            return next_delivery(start_time, end_time, datetime.fromtimestamp(now)).timestamp()
+        return next_run
+
+    async def start(self, reload_interval=None):
+        now = time.time()
+        caught_up = 0
+        for chat_id, start_time, end_time, interval, next_run in await get_schedules():
+            first_run = self._first_run(start_time, end_time, next_run, now)
+            if first_run < now:
+                caught_up += 1
+            self._push(chat_id, start_time, end_time, interval, first_run)
+        logging.info(f"Загружено расписаний: {len(self._schedules)}, пропущенных отправок к догону: {caught_up}")
+        self._loop_task = asyncio.create_task(self._run())
+        if reload_interval:
+            self._reload_task = asyncio.create_task(self._reload_loop(reload_interval))
+
+    async def reload(self):
+        """Применяет расписания, созданные, изменённые или отменённые другими процессами."""
+        async with self._change_lock:
+            now = time.time()
+            rows = await get_schedules()
+            for chat_id, start_time, end_time, interval, next_run in rows:
+                schedule = self._schedules.get(chat_id)
+                if schedule is None or schedule[:3] != (start_time, end_time, interval):
+                    self._push(chat_id, start_time, end_time, interval, self._first_run(start_time, end_time, next_run, now))
+            for chat_id in self._schedules.keys() - {row[0] for row in rows}:
+                del self._schedules[chat_id]
+
+    async def _reload_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logging.error(f"Не удалось перечитать расписания: {e}")
+
+    async def stop(self):
+        if self._reload_task is not None:
+            self._reload_task.cancel()
+            await asyncio.gather(self._reload_task, return_exceptions=True)
+            self._reload_task = None
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+
+    def _push(self, chat_id, start_time, end_time, interval, next_run):
+        self._generation += 1
+        self._schedules[chat_id] = (start_time, end_time, interval, self._generation)
+        heapq.heappush(self._heap, (next_run, chat_id, self._generation))
+        self._wakeup.set()
+
+    async def set(self, chat_id, start_time, end_time, interval):
+        """Создаёт или заменяет расписание пользователя."""
+        next_run = next_delivery(start_time, end_time, datetime.now()).timestamp()
+        async with self._change_lock:
+            await set_user_schedule(chat_id, start_time, end_time, interval, next_run)
+            self._push(chat_id, start_time, end_time, interval, next_run)
+
+    async def cancel(self, chat_id):
+        """Отменяет расписание; возвращает False, если его не было."""
+        async with self._change_lock:
+            self._schedules.pop(chat_id, None)
+            # Расписание могло быть задано в другом процессе, поэтому ответ берём из базы
+            return await clear_user_schedule(chat_id)
+
+    def get(self, chat_id):
+        schedule = self._schedules.get(chat_id)
+        return schedule[:3] if schedule else None
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            next_run, chat_id, generation = heapq.heappop(self._heap)
+            schedule = self._schedules.get(chat_id)
+            if schedule is None or schedule[3] != generation:
+                continue
+            start_time, end_time, interval, _ = schedule
+            after = datetime.fromtimestamp(now) + timedelta(hours=interval)
+            following = next_delivery(start_time, end_time, after).timestamp()
+            heapq.heappush(self._heap, (following, chat_id, generation))
+            due.append((chat_id, following))
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self._pop_due(time.time())
+            if not due:
+                continue
+            try:
+                await update_schedule_next_runs(due)
+            except Exception as e:
+                logging.error(f"Не удалось сохранить время следующих отправок: {e}")
+            for chat_id, _ in due:
+                task = asyncio.create_task(self._deliver(chat_id))
+                self._deliveries.add(task)
+                task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id):
+        async with self._semaphore:
+            try:
+                await self.callback(chat_id)
+                self.delivered += 1
+            except Exception as e:
+                logging.error(f"Ошибка отправки по расписанию пользователю {chat_id}: {e}")
+
+    def stats(self):
+        return {
+            "scheduled_users": len(self._schedules),
+            "heap_size": len(self._heap),
+            "pending_deliveries": len(self._deliveries),
+            "delivered": self.delivered,
+        }
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from database import get_user_data, update_users_data
+
+# Сколько сессий пользователей держать в памяти
+SESSION_CACHE_SIZE = 10000
+# Как часто записывать изменённые позиции в базу (в секундах)
+SESSION_FLUSH_INTERVAL = 2
+# Сколько секунд сессия считается свежей, когда базу меняют и другие процессы
+SHARED_SESSION_TTL = 1
+
+SESSION_FIELDS = ("current_book_id", "current_part", "preferred_voice")
+
+
+class SessionCache:
+    """Текущая книга, фрагмент и голос пользователей в памяти.
+
+    Обработчики читают и меняют сессию без обращения к базе. Изменения
+    копятся в _dirty и записываются раз в flush_interval секунд одной
+    транзакцией; несколько переходов одного пользователя между записями
+    сливаются в одно изменение. Вытеснение из LRU не теряет данные: ещё не
+    записанные изменения лежат отдельно от самих сессий.
+
+    Если ту же базу меняют другие процессы (бот и веб-приложение запущены
+    отдельно), кэш переключается в общий режим методом share(): изменения
+    записываются сразу, а сессии перечитываются из базы через ttl секунд.
+    """
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE, flush_interval=SESSION_FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._sessions = OrderedDict()
+        self._loaded_at = {}
+        self._dirty = {}
+        self.ttl = None
+        self.write_through = False
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def share(self, ttl=SHARED_SESSION_TTL):
+        """Общий режим: база используется несколькими процессами."""
+        self.ttl = ttl
+        self.write_through = True
+
+    def start(self):
+        if self._flush_task is None and not self.write_through:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    def _remember(self, chat_id, session, loaded_at=None):
+        self._sessions[chat_id] = session
+        self._sessions.move_to_end(chat_id)
+        if loaded_at is not None:
+            self._loaded_at[chat_id] = loaded_at
+        while len(self._sessions) > self.max_size:
+            evicted, _ = self._sessions.popitem(last=False)
+            self._loaded_at.pop(evicted, None)
+
+    def _is_fresh(self, chat_id):
+        if chat_id not in self._sessions:
+            return False
+        return self.ttl is None or time.monotonic() - self._loaded_at.get(chat_id, 0) < self.ttl
+
+    async def get(self, chat_id):
+        """Данные пользователя в формате get_user_data или None, если пользователя нет."""
+        if self._is_fresh(chat_id):
+            self.hits += 1
+            self._sessions.move_to_end(chat_id)
+        else:
+            self.misses += 1
+            loaded_at = time.monotonic()
+            session = await get_user_data(chat_id)
+            if chat_id in self._dirty:
+                # Сессию вытеснили до записи изменений: они новее, чем строка в базе
+                session = dict(session or dict.fromkeys(SESSION_FIELDS), **self._dirty[chat_id])
+            if not self._is_fresh(chat_id):
+                self._remember(chat_id, session, loaded_at)
+        session = self._sessions[chat_id]
+        return dict(session) if session is not None else None
+
+    async def update(self, chat_id, data):
+        """Меняет сессию сразу, а запись в базу откладывает до ближайшего сброса.
+
+        В общем режиме изменение записывается в базу до возврата.
+        """
+        session = self._sessions.get(chat_id) if self._is_fresh(chat_id) else None
+        loaded_at = None
+        if session is None:
+            session = dict.fromkeys(SESSION_FIELDS)
+            if not self._is_fresh(chat_id):
+                loaded_at = time.monotonic()
+                stored = await get_user_data(chat_id)
+                if stored is not None:
+                    session.update(stored)
+                session.update(self._dirty.get(chat_id, {}))
+        session.update(data)
+        self._remember(chat_id, session, loaded_at)
+        self._dirty.setdefault(chat_id, {}).update(data)
+        if self.write_through:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                await update_users_data(dirty)
+                self.flushes += 1
+            except Exception as e:
+                logging.error(f"Не удалось сохранить сессии пользователей: {e}")
+                for chat_id, data in dirty.items():
+                    # Изменения, сделанные во время записи, новее неудавшихся
+                    self._dirty[chat_id] = dict(data, **self._dirty.get(chat_id, {}))
+                raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "pending_writes": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushes": self.flushes,
+            "shared": self.write_through,
+        }
+
+
+sessions = SessionCache()
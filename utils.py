@@ -1,4 +1,7 @@
+import re
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from aiogram import types
+from metrics import timed, TEXT_SPLIT_SECONDS
 
 def get_main_keyboard():
     keyboard = types.ReplyKeyboardMarkup(
@@ -23,14 +26,126 @@ def get_manage_upload_keyboard():
     )
     return keyboard
 
-def split_text_into_parts(text, max_chars=4000):
-    parts = []
-    while len(text) > max_chars:
-        split_index = text.rfind('\n', 0, max_chars)
-        if split_index == -1 or split_index == 0:
-            split_index = max_chars
-        parts.append(text[:split_index].strip())
-        text = text[split_index:].strip()
-    if text:
-        parts.append(text)
-    return parts
\ No newline at end of file
+def part_label(part_number, total_parts, importing=False):
+    if importing:
+        return f"Фрагмент {part_number} из {total_parts}+ (книга загружается)"
+    return f"Фрагмент {part_number} из {total_parts}"
+
+# Параметры ссылок, которые не меняют содержимое страницы
+_TRACKING_PARAMS = re.compile(r'^(utm_\w+|fbclid|gclid|yclid|ref)$', re.IGNORECASE)
+
+def normalize_url(url):
+    """Приводит ссылку к одному виду, чтобы одна и та же страница давала один ключ."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if parts.port and (parts.scheme, parts.port) not in (('http', 80), ('https', 443)):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not _TRACKING_PARAMS.match(key)))
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower(), host, path, query, ''))
+
+# Лимит длины сообщения Telegram и целевой размер части книги
+TELEGRAM_MESSAGE_LIMIT = 4096
+PART_MAX_CHARS = 4000
+
+_SENTENCE_END = re.compile(r'[.!?…]+["»”’)\]]*\s')
+_NON_SPACE = re.compile(r'\S')
+
+
+def _escaped_length(text, start, end):
+    """Длина text[start:end] после html.escape(quote=False), без копирования строки."""
+    return (end - start
+            + 3 * (text.count('<', start, end) + text.count('>', start, end))
+            + 4 * text.count('&', start, end))
+
+def _skip_space(text, pos):
+    match = _NON_SPACE.search(text, pos)
+    return match.start() if match else len(text)
+
+def _find_cut(text, start, max_chars):
+    """Позиция конца части, начинающейся со start.
+
+    Окно ограничено max_chars символами и лимитом Telegram после
+    HTML-экранирования. Внутри второй половины окна граница ищется по
+    убыванию предпочтения: абзац, строка, предложение, слово; если ничего
+    не нашлось, текст режется по краю окна.
+    """
+    end = min(start + max_chars, len(text))
+    excess = _escaped_length(text, start, end) - TELEGRAM_MESSAGE_LIMIT
+    if excess > 0:
+        # Каждый убранный символ укорачивает экранированный текст хотя бы на 1,
+        # поэтому end - excess укладывается в лимит; наибольший подходящий конец
+        # ищем двоичным поиском. Один символ после экранирования не длиннее
+        # пяти, так что часть всегда содержит хотя бы start + 1.
+        fits, too_long = max(start + 1, end - excess), end
+        while too_long - fits > 1:
+            middle = (fits + too_long) // 2
+            if _escaped_length(text, start, middle) <= TELEGRAM_MESSAGE_LIMIT:
+                fits = middle
+            else:
+                too_long = middle
+        end = fits
+    elif end == len(text):
+        return end
+    low = start + (end - start) // 2
+    for separator in ('\n\n', '\n'):
+        index = text.rfind(separator, low, end)
+        if index != -1:
+            return index
+    last_sentence = None
+    for last_sentence in _SENTENCE_END.finditer(text, low, end):
+        pass
+    if last_sentence is not None:
+        return last_sentence.end()
+    index = max(text.rfind(' ', low, end), text.rfind('\t', low, end))
+    if index != -1:
+        return index
+    return end
+
+def iter_text_parts(text, max_chars=PART_MAX_CHARS):
+    """Режет текст на части за один проход по смещениям, не копируя остаток текста."""
+    start = _skip_space(text, 0)
+    while start < len(text):
+        cut = _find_cut(text, start, max_chars)
+        part = text[start:cut].rstrip()
+        if part:
+            yield part
+        start = _skip_space(text, cut)
+
+@timed(TEXT_SPLIT_SECONDS)
+def split_text_into_parts(text, max_chars=PART_MAX_CHARS):
+    return list(iter_text_parts(text, max_chars))
+
+
+class PartSplitter:
+    """Потоковый вариант iter_text_parts: текст подаётся кусками через feed().
+
+    В буфере держится только ещё не разрезанный хвост текста, поэтому
+    память не зависит от размера книги. Части режутся так же, как при
+    разбиении всего текста сразу.
+    """
+
+    def __init__(self, max_chars=PART_MAX_CHARS):
+        self.max_chars = max_chars
+        self._buffer = ''
+
+    @timed(TEXT_SPLIT_SECONDS, function='PartSplitter.feed')
+    def feed(self, chunk):
+        """Добавляет кусок текста и возвращает готовые части."""
+        buffer = self._buffer + chunk
+        parts = []
+        start = _skip_space(buffer, 0)
+        # Режем, только пока впереди есть полное окно, иначе граница может выйти хуже
+        while len(buffer) - start > self.max_chars:
+            cut = _find_cut(buffer, start, self.max_chars)
+            part = buffer[start:cut].rstrip()
+            if part:
+                parts.append(part)
+            start = _skip_space(buffer, cut)
+        self._buffer = buffer[start:]
+        return parts
+
+    def finish(self):
+        """Возвращает части из остатка буфера."""
+        tail, self._buffer = self._buffer, ''
+        return split_text_into_parts(tail, self.max_chars)
@@ -1,100 +1,235 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import FileResponse, JSONResponse
-import aiosqlite
+from fastapi import FastAPI, APIRouter, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from database import init_db, close_db, get_books as db_get_books, get_part_text, get_parts_range, get_book_manifest, BOOK_IMPORTING
+from sessions import sessions
+from ai_utils import audio_cache_key, stream_audio, VOICES
+from cache import audio_cache
+from metrics import render as render_metrics
+from api_client import api_client
 import logging
+from contextlib import asynccontextmanager
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-app = FastAPI()
+# Маршруты веб-приложения. По умолчанию bot.py подключает их к своему
+# приложению, и бот с веб-приложением работают с одним кэшем сессий.
+# При отдельном запуске (uvicorn webapp:app --workers N, бот с
+# SEPARATE_WEBAPP=1) у каждого процесса свой кэш сессий, поэтому он
+# работает в общем режиме: изменения пишутся в базу сразу, а сессии
+# перечитываются через секунду.
+router = APIRouter()
 
-@app.get("/webapp")
+# Текст части книги никогда не меняется, поэтому её адрес кэшируется навсегда
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# Сколько частей можно запросить одним запросом диапазона
+RANGE_MAX_PARTS = 10
+DEFAULT_VOICE = "alloy"
+# Голоса принимаются только из списка бота: каждый новый голос — платная генерация и запись в кэше
+ALLOWED_VOICES = {voice.lower() for voice in VOICES}
+
+
+def _not_modified(request, etag, cache_control):
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    return None
+
+@router.get("/webapp")
 async def webapp():
     logging.info("Запрос к веб-приложению")
-    return await FileResponse("webapp.html")
+    return FileResponse("webapp.html")
 
-@app.get("/api/part/{chat_id}")
+@router.get("/api/part/{chat_id}")
 async def get_part(chat_id: int):
-    async with aiosqlite.connect('bot.db') as db:
-        try:
-            cursor = await db.execute('SELECT current_book_id, current_part FROM users WHERE chat_id = ?', (chat_id,))
-            row = await cursor.fetchone()
-            if row:
-                book_id, current_part = row
-                cursor = await db.execute('SELECT text FROM parts WHERE book_id = ? AND part_number = ?', (book_id, current_part))
-                part_row = await cursor.fetchone()
-                if part_row:
-                    logging.info(f"Отправлен фрагмент {current_part} книги {book_id} для {chat_id}")
-                    return {"status": "OK", "text": part_row[0]}
-                return {"status": "error", "text": "Нет текущего фрагмента"}
-            return {"status": "error", "text": "Книга не выбрана"}
-        except Exception as e:
-            logging.error(f"Ошибка при получении фрагмента для {chat_id}: {e}")
-            return {"status": "error", "text": "Ошибка сервера"}
-
-@app.post("/api/next/{chat_id}")
+    try:
+        user_data = await sessions.get(chat_id)
+        if user_data and user_data.get('current_book_id'):
+            book_id, current_part = user_data['current_book_id'], user_data['current_part']
+            text = await get_part_text(book_id, current_part)
+            if text:
+                manifest = await get_book_manifest(book_id)
+                logging.info(f"Отправлен фрагмент {current_part} книги {book_id} для {chat_id}")
+                return {
+                    "status": "OK",
+                    "text": text,
+                    "book_id": book_id,
+                    "part_number": current_part,
+                    "total_parts": manifest["total_parts"],
+                    "importing": manifest["status"] == BOOK_IMPORTING,
+                    "voice": (user_data.get('preferred_voice') or DEFAULT_VOICE).lower(),
+                }
+            return {"status": "error", "text": "Нет текущего фрагмента"}
+        return {"status": "error", "text": "Книга не выбрана"}
+    except Exception as e:
+        logging.error(f"Ошибка при получении фрагмента для {chat_id}: {e}")
+        return {"status": "error", "text": "Ошибка сервера"}
+
+@router.post("/api/next/{chat_id}")
 async def next_part(chat_id: int):
-    async with aiosqlite.connect('bot.db') as db:
-        try:
-            cursor = await db.execute('SELECT current_book_id, current_part FROM users WHERE chat_id = ?', (chat_id,))
-            row = await cursor.fetchone()
-            if row:
-                book_id, current_part = row
-                next_part = current_part + 1
-                cursor = await db.execute('SELECT part_id FROM parts WHERE book_id = ? AND part_number = ?', (book_id, next_part))
-                if await cursor.fetchone():
-                    await db.execute('UPDATE users SET current_part = ? WHERE chat_id = ?', (next_part, chat_id))
-                    await db.commit()
-                    logging.info(f"Пользователь {chat_id} перешёл к следующему фрагменту {next_part}")
-                    return {"status": "success"}
-                return {"status": "error", "message": "Это последний фрагмент"}
-            return {"status": "error", "message": "Книга не выбрана"}
-        except Exception as e:
-            logging.error(f"Ошибка при переходе к следующему фрагменту для {chat_id}: {e}")
-            return {"status": "error", "message": "Ошибка сервера"}
-
-@app.post("/api/prev/{chat_id}")
+    try:
+        user_data = await sessions.get(chat_id)
+        if user_data and user_data.get('current_book_id'):
+            book_id, current_part = user_data['current_book_id'], user_data['current_part']
+            next_part = current_part + 1
+            manifest = await get_book_manifest(book_id)
+            if manifest and next_part <= manifest["total_parts"]:
+                await sessions.update(chat_id, {"current_part": next_part})
+                logging.info(f"Пользователь {chat_id} перешёл к следующему фрагменту {next_part}")
+                return {"status": "success"}
+            return {"status": "error", "message": "Это последний фрагмент"}
+        return {"status": "error", "message": "Книга не выбрана"}
+    except Exception as e:
+        logging.error(f"Ошибка при переходе к следующему фрагменту для {chat_id}: {e}")
+        return {"status": "error", "message": "Ошибка сервера"}
+
+@router.post("/api/prev/{chat_id}")
 async def prev_part(chat_id: int):
-    async with aiosqlite.connect('bot.db') as db:
-        try:
-            cursor = await db.execute('SELECT current_book_id, current_part FROM users WHERE chat_id = ?', (chat_id,))
-            row = await cursor.fetchone()
-            if row:
-                book_id, current_part = row
-                prev_part = current_part - 1
-                if prev_part >= 1:
-                    await db.execute('UPDATE users SET current_part = ? WHERE chat_id = ?', (prev_part, chat_id))
-                    await db.commit()
-                    logging.info(f"Пользователь {chat_id} перешёл к предыдущему фрагменту {prev_part}")
-                    return {"status": "success"}
-                return {"status": "error", "message": "Это первый фрагмент"}
-            return {"status": "error", "message": "Книга не выбрана"}
-        except Exception as e:
-            logging.error(f"Ошибка при переходе к предыдущему фрагменту для {chat_id}: {e}")
-            return {"status": "error", "message": "Ошибка сервера"}
-
-@app.get("/api/books/{chat_id}")
+    try:
+        user_data = await sessions.get(chat_id)
+        if user_data and user_data.get('current_book_id'):
+            prev_part = user_data['current_part'] - 1
+            if prev_part >= 1:
+                await sessions.update(chat_id, {"current_part": prev_part})
+                logging.info(f"Пользователь {chat_id} перешёл к предыдущему фрагменту {prev_part}")
+                return {"status": "success"}
+            return {"status": "error", "message": "Это первый фрагмент"}
+        return {"status": "error", "message": "Книга не выбрана"}
+    except Exception as e:
+        logging.error(f"Ошибка при переходе к предыдущему фрагменту для {chat_id}: {e}")
+        return {"status": "error", "message": "Ошибка сервера"}
+
+@router.post("/api/position/{chat_id}/{part_number}")
+async def set_position(chat_id: int, part_number: int):
+    """Запоминает часть, открытую в веб-приложении; повторный запрос ничего не меняет."""
+    try:
+        user_data = await sessions.get(chat_id)
+        if user_data and user_data.get('current_book_id'):
+            manifest = await get_book_manifest(user_data['current_book_id'])
+            if manifest and 1 <= part_number <= manifest["total_parts"]:
+                await sessions.update(chat_id, {"current_part": part_number})
+                return {"status": "success"}
+            return {"status": "error", "message": "Нет такого фрагмента"}
+        return {"status": "error", "message": "Книга не выбрана"}
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении позиции {part_number} для {chat_id}: {e}")
+        return {"status": "error", "message": "Ошибка сервера"}
+
+@router.get("/api/books/{book_id}/parts/{part_number}")
+async def get_book_part(book_id: int, part_number: int, request: Request):
+    """Текст одной части. Адрес неизменяем: содержимое книги после загрузки не меняется."""
+    manifest = await get_book_manifest(book_id)
+    if manifest is None or not 1 <= part_number <= manifest["total_parts"]:
+        return JSONResponse({"status": "error", "text": "Фрагмент не найден"}, status_code=404)
+    etag = f'"{manifest["content_id"]}-{part_number}"'
+    not_modified = _not_modified(request, etag, IMMUTABLE_CACHE_CONTROL)
+    if not_modified is not None:
+        return not_modified
+    text = await get_part_text(book_id, part_number)
+    if text is None:
+        return JSONResponse({"status": "error", "text": "Фрагмент не найден"}, status_code=404)
+    return JSONResponse(
+        {"status": "OK", "book_id": book_id, "part_number": part_number, "text": text},
+        headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL},
+    )
+
+@router.get("/api/books/{book_id}/parts")
+async def get_book_parts(book_id: int, request: Request, start: int = 1, count: int = 5):
+    """Несколько частей подряд одним ответом — для предзагрузки в веб-приложении."""
+    manifest = await get_book_manifest(book_id)
+    if manifest is None:
+        return JSONResponse({"status": "error", "text": "Книга не найдена"}, status_code=404)
+    start = max(start, 1)
+    count = max(1, min(count, RANGE_MAX_PARTS))
+    importing = manifest["status"] == BOOK_IMPORTING
+    # Пока книга загружается, хвост диапазона может ещё появиться
+    complete = not importing or start + count - 1 <= manifest["total_parts"]
+    cache_control = IMMUTABLE_CACHE_CONTROL if complete else "no-cache"
+    etag = f'"{manifest["content_id"]}-{start}-{count}"'
+    if complete:
+        not_modified = _not_modified(request, etag, cache_control)
+        if not_modified is not None:
+            return not_modified
+    parts = await get_parts_range(book_id, start, count)
+    headers = {"Cache-Control": cache_control}
+    if complete:
+        headers["ETag"] = etag
+    return JSONResponse({
+        "status": "OK",
+        "book_id": book_id,
+        "total_parts": manifest["total_parts"],
+        "importing": importing,
+        "parts": [{"part_number": part_number, "text": text} for part_number, text in parts],
+    }, headers=headers)
+
+@router.get("/api/audio/{book_id}/{part_number}")
+async def get_audio(book_id: int, part_number: int, request: Request, voice: str = DEFAULT_VOICE):
+    """Озвучка части.
+
+    Готовый MP3 отдаётся из аудиокэша с поддержкой Range и условных запросов.
+    Если озвучки ещё нет, она запускается (или используется уже идущая
+    генерация), и байты отдаются потоком по мере получения от API, так что
+    воспроизведение начинается до окончания генерации.
+    """
+    voice = voice.lower()
+    if voice not in ALLOWED_VOICES:
+        return JSONResponse({"status": "error", "text": "Неизвестный голос"}, status_code=400)
+    text = await get_part_text(book_id, part_number)
+    if text is None:
+        return JSONResponse({"status": "error", "text": "Фрагмент не найден"}, status_code=404)
+    key = audio_cache_key(text, voice)
+    # Ключ строится из текста и голоса, поэтому аудио по нему никогда не меняется
+    etag = f'"{key}"'
+    not_modified = _not_modified(request, etag, IMMUTABLE_CACHE_CONTROL)
+    if not_modified is not None:
+        return not_modified
+    path = await audio_cache.find_file(key)
+    if path is not None:
+        return FileResponse(path, media_type="audio/mpeg", headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL})
+    generation = stream_audio(text, voice)
+    if generation is None:
+        return JSONResponse({"status": "error", "text": "Озвучка временно недоступна"}, status_code=503)
+    logging.info(f"Потоковая отдача озвучки части {part_number} книги {book_id}")
+    # Длина ещё неизвестна, поэтому Range не поддерживается, а ответ не кэшируется
+    return StreamingResponse(generation.iter_chunks(), media_type="audio/mpeg", headers={"Cache-Control": "no-store"})
+
+@router.get("/api/books/{chat_id}")
 async def get_books(chat_id: int):
-    async with aiosqlite.connect('bot.db') as db:
-        try:
-            cursor = await db.execute('SELECT book_id, title FROM books WHERE user_id = ?', (chat_id,))
-            books = await cursor.fetchall()
-            logging.info(f"Список книг отправлен для {chat_id}")
-            return [{"book_id": book_id, "title": title} for book_id, title in books]
-        except Exception as e:
-            logging.error(f"Ошибка при получении списка книг для {chat_id}: {e}")
-            return {"status": "error", "message": "Ошибка сервера"}
-
-@app.post("/api/select_book/{chat_id}/{book_id}")
+    try:
+        books = await db_get_books(chat_id)
+        logging.info(f"Список книг отправлен для {chat_id}")
+        return [{"book_id": book_id, "title": title} for book_id, title in books]
+    except Exception as e:
+        logging.error(f"Ошибка при получении списка книг для {chat_id}: {e}")
+        return {"status": "error", "message": "Ошибка сервера"}
+
+@router.post("/api/select_book/{chat_id}/{book_id}")
 async def select_book(chat_id: int, book_id: int):
-    async with aiosqlite.connect('bot.db') as db:
-        try:
-            cursor = await db.execute('SELECT book_id FROM books WHERE book_id = ? AND user_id = ?', (book_id, chat_id))
-            if await cursor.fetchone():
-                await db.execute('UPDATE users SET current_book_id = ?, current_part = 1 WHERE chat_id = ?', (book_id, chat_id))
-                await db.commit()
-                logging.info(f"Пользователь {chat_id} выбрал книгу {book_id}")
-                return {"status": "success"}
-            return {"status": "error", "message": "Книга не найдена"}
-        except Exception as e:
-            logging.error(f"Ошибка при выборе книги {book_id} для {chat_id}: {e}")
-            return {"status": "error", "message": "Ошибка сервера"}
\ No newline at end of file
+    try:
+        if any(book[0] == book_id for book in await db_get_books(chat_id)):
+            await sessions.update(chat_id, {"current_book_id": book_id, "current_part": 1})
+            logging.info(f"Пользователь {chat_id} выбрал книгу {book_id}")
+            return {"status": "success"}
+        return {"status": "error", "message": "Книга не найдена"}
+    except Exception as e:
+        logging.error(f"Ошибка при выборе книги {book_id} для {chat_id}: {e}")
+        return {"status": "error", "message": "Ошибка сервера"}
+
+@asynccontextmanager
+async def lifespan(app):
+    await init_db()
+    sessions.share()
+    sessions.start()
+    await api_client.start()
+    try:
+        yield
+    finally:
+        await api_client.close()
+        await sessions.stop()
+        await close_db()
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(router)
+
+# При запуске с --workers N у каждого процесса свои метрики
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")